@@ -16,6 +16,31 @@ class Settings(BaseSettings):
     MODEL_DIR: str = os.getenv("COSYVOICE_MODEL_DIR", "/data/models/cosyvoice")
     USE_VLLM: bool = True  # 是否启用 vLLM 加速
     FP16: bool = True  # 是否使用 FP16 推理
+    LOAD_INT8: bool = False  # 是否对 LLM 做动态 int8 量化 (仅 CPU 生效)
+    LOAD_ONNX: bool = False  # 是否使用 onnxruntime 运行 LLM (无法安装 vLLM 时使用, 首次加载自动导出)
+    LOAD_HIFT_ONNX: bool = False  # 是否使用 onnxruntime 运行声码器 (CPU 部署推荐, 首次加载自动导出)
+    FLOW_N_TIMESTEPS: int = 10  # flow matching 默认步数, 低延迟部署可设为 4-6
+    FLOW_SOLVER: str = "euler"  # flow matching ODE 求解器: euler, midpoint, heun, rk4, dpm_solver
+    FLOW_CFG_SKIP_STEPS: int = 0  # 最后若干步跳过 CFG 无条件分支, 这些步的 estimator 计算量减半, CFG 蒸馏模型可设为步数
+    STREAM_HOP_ADAPTIVE: bool = True  # 流式 hop 自适应: 首包使用最小 hop, 之后根据实测 RTF 和播放缓冲余量增大 hop, 关闭则固定最小 hop
+
+    # ========== CPU 推理配置 ==========
+    CPU_INTRA_OP_THREADS: int = 0  # 算子内并行线程数, <=0 使用 torch 默认值
+    CPU_INTER_OP_THREADS: int = 0  # 算子间并行线程数, <=0 使用 torch 默认值
+    CPU_NUMA_NODE: int = -1  # 绑定到指定 NUMA 节点的 CPU, <0 不绑定
+    PIPELINE_STAGE_THREADS: Dict[str, int] = {}  # 流式流水线各阶段 (token, token2mel, mel2wav) 的算子内线程数, 未指定则沿用全局设置
+    PIPELINE_QUEUE_SIZE: int = 2  # 流式流水线阶段间队列长度, 限制 token2mel 领先 mel2wav 的 chunk 数
+
+    # ========== 显存配置 ==========
+    MEMORY_HIGH_WATERMARK: float = 0.9  # 请求结束后显存缓存 (reserved) 超过总显存该比例时才释放缓存
+    MEMORY_MAX_FREE_CACHE_MB: int = 0  # 缓存中未使用的显存超过该值 (MB) 时释放缓存, <=0 不限制
+    MEMORY_RESERVE_MB: int = 0  # 启动时预留显存缓存 (MB), 避免首批请求反复 cudaMalloc, <=0 不预留
+
+    # ========== 声码器配置 ==========
+    HIFT_F0_DEVICE: str = "auto"  # CosyVoice3 f0 预测设备: cpu 或 auto (与声码器同设备, fp32 运行, 启动时与 cpu 比对精度, 超出容差退回 cpu)
+    HIFT_STFT_BACKEND: str = "conv"  # 声码器 STFT/ISTFT 实现: torch (torch.stft) 或 conv (DFT 矩阵乘, 启动时与 torch 比对精度, 超出容差退回 torch)
+    HIFT_PRECISION: str = "fp32"  # 声码器卷积精度: fp32, bf16 (autocast, 需 CPU 支持 avx512_bf16/amx) 或 int8 (静态量化, 仅 CPU, 用已加载音色的 mel 校准)
+    HIFT_PRECISION_MAX_MCD: float = 1.0  # 声码器降精度与 fp32 的梅尔倒谱距离 (dB) 上限, 启动时比对, 超出则退回 fp32
     
     # ========== 服务配置 ==========
     HOST: str = "0.0.0.0"
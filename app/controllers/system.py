@@ -23,5 +23,9 @@ def health():
         sample_rate=model.sample_rate if model else None,
         output_sample_rate=settings.OUTPUT_SAMPLE_RATE,
         voice_count=VoiceService.get_voice_count(),
-        vllm_enabled=settings.USE_VLLM
+        vllm_enabled=settings.USE_VLLM,
+        decode_guard=model.model.decode_guard.get_stats() if model and hasattr(model.model, 'decode_guard') else None,
+        stream_hop=model.model.hop_controller.get_stats() if model and hasattr(model.model, 'hop_controller') else None,
+        pipeline=model.model.pipeline.get_stats() if model and hasattr(model.model, 'pipeline') else None,
+        memory=model.model.memory_policy.get_stats() if model and hasattr(model.model, 'memory_policy') else None
     )
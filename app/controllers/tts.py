@@ -1,5 +1,6 @@
 from fastapi import APIRouter, WebSocket, HTTPException
 from fastapi.responses import StreamingResponse, JSONResponse
+import itertools
 import logging
 
 from ..models import get_cosy_model
@@ -16,6 +17,17 @@ async def _async_audio_generator(req: TTSRequest):
     for chunk in TTSService.generate_audio_stream(req):
         yield chunk
 
+def _start_audio_stream(req: TTSRequest):
+    """
+    先生成首个音频块再返回流式响应
+    
+    请求参数错误 (如不支持的模式或流式文本输入) 在模型中以 ValueError 抛出,
+    响应开始后无法再返回状态码, 因此在返回响应前触发
+    """
+    audio_stream = TTSService.generate_audio_stream(req)
+    first_chunk = next(audio_stream, None)
+    return itertools.chain([] if first_chunk is None else [first_chunk], audio_stream)
+
 @router.post("/v1/tts", tags=["TTS"])
 async def tts(req: TTSRequest):
     """
@@ -38,7 +50,7 @@ async def tts(req: TTSRequest):
         if req.stream:
             # 流式返回
             return StreamingResponse(
-                TTSService.generate_audio_stream(req),
+                _start_audio_stream(req),
                 media_type="audio/pcm",
                 headers={
                     "X-Sample-Rate": str(settings.OUTPUT_SAMPLE_RATE),
@@ -64,6 +76,9 @@ async def tts(req: TTSRequest):
             
             return JSONResponse(response_data)
             
+    except ValueError as e:
+        logger.warning(f"TTS 请求参数错误: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         logger.error(f"TTS 生成失败: {e}")
         logger.error(get_exception_error())
@@ -82,8 +97,14 @@ async def tts_stream(req: TTSRequest):
     if not model:
         raise HTTPException(status_code=503, detail="模型未加载")
     
+    try:
+        audio_stream = _start_audio_stream(req)
+    except ValueError as e:
+        logger.warning(f"TTS 请求参数错误: {e}")
+        raise HTTPException(status_code=400, detail=str(e))
+    
     return StreamingResponse(
-        TTSService.generate_audio_stream(req),
+        audio_stream,
         media_type="audio/pcm",
         headers={
             "X-Sample-Rate": str(settings.OUTPUT_SAMPLE_RATE),
@@ -6,6 +6,8 @@ import os
 import threading
 import logging
 from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.cpu_utils import set_cpu_threads
+from cosyvoice.utils.memory_utils import MemoryPolicy
 
 from .config import settings, VoiceConfig
 
@@ -163,6 +165,13 @@ def load_cosyvoice_model(
             logger.error("启用 vLLM 失败: 未找到 vllm 库。请先安装: pip install vllm==0.9.0")
             sys.exit(1)
     
+    # CPU 线程与 NUMA 绑定需在模型加载前设置
+    set_cpu_threads(
+        settings.CPU_INTRA_OP_THREADS,
+        settings.CPU_INTER_OP_THREADS,
+        settings.CPU_NUMA_NODE
+    )
+    
     start_time = time.time()
     
     try:
@@ -170,20 +179,49 @@ def load_cosyvoice_model(
             model_dir=model_dir,
             load_trt=False,
             load_vllm=use_vllm,
+            load_int8=settings.LOAD_INT8,
+            load_onnx=settings.LOAD_ONNX,
+            load_hift_onnx=settings.LOAD_HIFT_ONNX,
             fp16=fp16
         )
     except TypeError as e:
-        if "load_vllm" in str(e):
-            logger.error("当前 CosyVoice 版本似乎不支持 vLLM,请确保使用最新代码")
+        if "load_vllm" in str(e) or "load_int8" in str(e) or "load_onnx" in str(e):
+            logger.error("当前 CosyVoice 版本似乎不支持 vLLM/int8/onnx,请确保使用最新代码")
         raise e
     
     logger.info(f"模型加载完成,耗时: {time.time() - start_time:.1f}s")
     logger.info(f"模型采样率: {cosy_model.sample_rate}Hz, 输出采样率: {settings.OUTPUT_SAMPLE_RATE}Hz")
     
+    # 流式流水线: token / token2mel / mel2wav 三阶段并行
+    if hasattr(cosy_model.model, 'pipeline'):
+        cosy_model.model.pipeline.configure(settings.PIPELINE_QUEUE_SIZE, settings.PIPELINE_STAGE_THREADS)
+    
+    # 显存策略: 仅在超过水位线时释放缓存, 可选启动时预留
+    if hasattr(cosy_model.model, 'memory_policy'):
+        cosy_model.model.memory_policy = MemoryPolicy(
+            cosy_model.model.device,
+            settings.MEMORY_HIGH_WATERMARK,
+            settings.MEMORY_MAX_FREE_CACHE_MB * 2 ** 20 if settings.MEMORY_MAX_FREE_CACHE_MB > 0 else None
+        )
+        cosy_model.model.memory_policy.reserve(settings.MEMORY_RESERVE_MB * 2 ** 20)
+    
+    # 声码器 f0 预测设备, 避免每个 chunk 在 GPU 与 CPU 间来回拷贝
+    if hasattr(cosy_model.model.hift, 'set_f0_device'):
+        cosy_model.model.hift.set_f0_device(settings.HIFT_F0_DEVICE)
+    
+    # 声码器 STFT/ISTFT 后端, n_fft=16 的小变换用 DFT 矩阵乘比 torch.stft 更快
+    if hasattr(cosy_model.model.hift, 'set_stft_backend'):
+        cosy_model.model.hift.set_stft_backend(settings.HIFT_STFT_BACKEND)
+    
     # 初始化音色缓存管理器
     voice_cache_manager = VoiceCacheManager(cosy_model)
     voice_count = voice_cache_manager.load_voices()
     
+    # 声码器精度, 用已加载音色的 prompt mel 校准 int8 并与 fp32 比对音质
+    if hasattr(cosy_model.model.hift, 'set_precision'):
+        calib_mels = [v['prompt_speech_feat'].transpose(1, 2) for v in cosy_model.frontend.spk2info.values() if 'prompt_speech_feat' in v]
+        cosy_model.model.hift.set_precision(settings.HIFT_PRECISION, calib_mels, settings.HIFT_PRECISION_MAX_MCD)
+    
     # 模型预热
     if settings.ENABLE_MODEL_WARMUP:
         default_voice = voice_cache_manager.get_default_voice()
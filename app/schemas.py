@@ -1,5 +1,5 @@
-from pydantic import BaseModel, Field
-from typing import Optional, List, Union, Dict
+from pydantic import BaseModel, ConfigDict, Field
+from typing import Optional, List, Dict, Literal
 
 class SFTRequest(BaseModel):
     text: str
@@ -33,6 +33,29 @@ class VCRequest(BaseModel):
     stream: bool = False
     speed: float = 1.0
 
+class DecodeGuardOptions(BaseModel):
+    """解码保护参数覆盖, 未设置的字段使用服务默认值, 见 cosyvoice/llm/decode_guard.py"""
+    model_config = ConfigDict(extra="forbid")
+
+    enable: Optional[bool] = Field(default=None, description="是否启用解码保护")
+    max_token_text_ratio: Optional[float] = Field(default=None, gt=0, le=50, description="speech token 与 text token 的最大比例")
+    min_token_text_ratio: Optional[float] = Field(default=None, ge=0, le=50, description="speech token 与 text token 的最小比例")
+    ngram_max_size: Optional[int] = Field(default=None, ge=1, le=100, description="重复检测的最大 n-gram 长度")
+    ngram_max_repeat: Optional[int] = Field(default=None, ge=2, le=100, description="n-gram 最大重复次数")
+    ngram_min_span: Optional[int] = Field(default=None, ge=1, le=1000, description="判定重复的最小 token 跨度")
+    max_silent_token_num: Optional[int] = Field(default=None, ge=0, le=1000, description="连续静音 token 超过该值后丢弃")
+    max_silence_run: Optional[int] = Field(default=None, ge=1, le=1000, description="连续静音 token 超过该值后停止解码")
+
+class StreamHopOptions(BaseModel):
+    """流式 hop 调度参数覆盖, 未设置的字段使用服务默认值, hop 长度会被限制在服务配置的范围内"""
+    model_config = ConfigDict(extra="forbid")
+
+    enable: Optional[bool] = Field(default=None, description="是否启用 hop 自适应")
+    min_hop_len: Optional[int] = Field(default=None, ge=1, description="最小 hop token 数")
+    max_hop_len: Optional[int] = Field(default=None, ge=1, description="最大 hop token 数")
+    headroom_ratio: Optional[float] = Field(default=None, gt=0, le=1, description="可用于下一个 hop 的播放缓冲比例")
+    cost_smoothing: Optional[float] = Field(default=None, ge=0, lt=1, description="token2wav 耗时滑动平均系数")
+
 class TTSRequest(BaseModel):
     """统一 TTS 请求模型"""
     text: str = Field(..., description="要合成的文本")
@@ -56,6 +79,11 @@ class TTSRequest(BaseModel):
     stream: bool = Field(default=False, description="是否流式返回")
     speed: float = Field(default=1.0, ge=0.5, le=2.0, description="语速: 0.5-2.0")
     seed: Optional[int] = Field(default=None, description="随机种子")
+    decode_guard: Optional[DecodeGuardOptions] = Field(default=None, description="解码保护参数覆盖")
+    n_timesteps: Optional[int] = Field(default=None, ge=1, le=50, description="flow matching 步数, 默认使用服务配置 FLOW_N_TIMESTEPS")
+    solver: Optional[Literal["euler", "midpoint", "heun", "rk4", "dpm_solver"]] = Field(default=None, description="flow matching ODE 求解器, 默认使用服务配置 FLOW_SOLVER")
+    cfg_skip_steps: Optional[int] = Field(default=None, ge=0, le=50, description="最后若干步跳过 CFG, 默认使用服务配置 FLOW_CFG_SKIP_STEPS")
+    stream_hop: Optional[StreamHopOptions] = Field(default=None, description="流式 hop 调度参数覆盖")
 
 class VoiceInfo(BaseModel):
     """音色信息响应模型"""
@@ -80,6 +108,10 @@ class HealthResponse(BaseModel):
     output_sample_rate: Optional[int] = None
     voice_count: int = 0
     vllm_enabled: bool = False
+    decode_guard: Optional[Dict] = None
+    stream_hop: Optional[Dict] = None
+    pipeline: Optional[Dict] = None
+    memory: Optional[Dict] = None
 
 class TTSResponse(BaseModel):
     """非流式 TTS 响应"""
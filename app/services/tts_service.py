@@ -131,12 +131,25 @@ class TTSService:
         Returns:
             音频迭代器
         """
+        # flow matching 步数, ODE 求解器和 CFG 跳过步数, 请求未指定时使用部署默认值
+        flow_kwargs = {
+            'n_timesteps': req.n_timesteps or settings.FLOW_N_TIMESTEPS,
+            'solver': req.solver or settings.FLOW_SOLVER,
+            'cfg_skip_steps': settings.FLOW_CFG_SKIP_STEPS if req.cfg_skip_steps is None else req.cfg_skip_steps,
+        }
+        # 流式 hop 调度, 请求参数覆盖部署默认值
+        stream_hop = {'enable': settings.STREAM_HOP_ADAPTIVE, **(req.stream_hop.model_dump(exclude_none=True) if req.stream_hop is not None else {})}
+        # 解码保护, 只传递请求中显式设置的参数
+        decode_guard = req.decode_guard.model_dump(exclude_none=True) if req.decode_guard is not None else None
         if req.mode == "sft":
             return model.inference_sft(
                 req.text,
                 req.speaker,
                 stream=req.stream,
-                speed=req.speed
+                speed=req.speed,
+                stream_hop=stream_hop,
+                decode_guard=decode_guard,
+                **flow_kwargs
             )
         
         elif req.mode == "zero_shot":
@@ -152,7 +165,10 @@ class TTSService:
                 prompt_wav_path,
                 stream=req.stream,
                 speed=req.speed,
-                zero_shot_spk_id=zero_shot_spk_id
+                stream_hop=stream_hop,
+                zero_shot_spk_id=zero_shot_spk_id,
+                decode_guard=decode_guard,
+                **flow_kwargs
             )
         
         elif req.mode == "cross_lingual":
@@ -160,7 +176,10 @@ class TTSService:
                 req.text,
                 prompt_wav_path,
                 stream=req.stream,
-                speed=req.speed
+                speed=req.speed,
+                stream_hop=stream_hop,
+                decode_guard=decode_guard,
+                **flow_kwargs
             )
         
         elif req.mode == "instruct":
@@ -170,7 +189,10 @@ class TTSService:
                     req.instruct_text,
                     prompt_wav_path,
                     stream=req.stream,
-                    speed=req.speed
+                    speed=req.speed,
+                    stream_hop=stream_hop,
+                    decode_guard=decode_guard,
+                    **flow_kwargs
                 )
             else:
                 return model.inference_instruct(
@@ -178,7 +200,10 @@ class TTSService:
                     req.speaker,
                     req.instruct_text,
                     stream=req.stream,
-                    speed=req.speed
+                    speed=req.speed,
+                    stream_hop=stream_hop,
+                    decode_guard=decode_guard,
+                    **flow_kwargs
                 )
         
         elif req.mode == "vc":
@@ -186,7 +211,9 @@ class TTSService:
                 req.source_wav_path,
                 prompt_wav_path,
                 stream=req.stream,
-                speed=req.speed
+                speed=req.speed,
+                stream_hop=stream_hop,
+                **flow_kwargs
             )
         
         else:
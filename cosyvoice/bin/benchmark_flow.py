@@ -0,0 +1,118 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.flow.flow_matching import ODE_SOLVERS
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark flow matching quality against ode steps, solver and cfg skip steps')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='{}/../../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--solvers', type=str, default=','.join(ODE_SOLVERS.keys()))
+    parser.add_argument('--n_timesteps', type=str, default='2,4,6,8,10')
+    parser.add_argument('--cfg_skip_steps', type=str, default='0')
+    parser.add_argument('--ref_n_timesteps', type=int, default=10)
+    parser.add_argument('--streaming', action='store_true')
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+@torch.inference_mode()
+def flow_inference(model, model_input, token, n_timesteps, solver, cfg_skip_steps, streaming, num_runs):
+    flow, device = model.model.flow, model.model.device
+    total_time = 0
+    for _ in range(num_runs):
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        with torch.cuda.amp.autocast(model.model.fp16):
+            mel, _ = flow.inference(token=token.to(device),
+                                    token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(device),
+                                    prompt_token=model_input['flow_prompt_speech_token'].to(device),
+                                    prompt_token_len=torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                                    prompt_feat=model_input['prompt_speech_feat'].to(device),
+                                    prompt_feat_len=torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(device),
+                                    embedding=model_input['flow_embedding'].to(device),
+                                    streaming=streaming,
+                                    finalize=True,
+                                    n_timesteps=n_timesteps,
+                                    solver=solver,
+                                    cfg_skip_steps=cfg_skip_steps)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        total_time += time.time() - start_time
+    return mel.float(), total_time / num_runs
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model = AutoModel(model_dir=args.model_dir)
+    assert model.__class__.__name__ in ['CosyVoice2', 'CosyVoice3'], 'only CosyVoice2/CosyVoice3 flow is supported'
+    model_input = model.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, model.sample_rate, '')
+    set_all_random_seed(0)
+    token = torch.tensor([list(model.model.llm.inference(text=model_input['text'].to(model.model.device),
+                                                         text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(model.model.device),
+                                                         prompt_text=model_input['prompt_text'].to(model.model.device),
+                                                         prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(model.model.device),
+                                                         prompt_speech_token=model_input['llm_prompt_speech_token'].to(model.model.device),
+                                                         prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]],
+                                                                                              dtype=torch.int32).to(model.model.device),
+                                                         embedding=model_input['llm_embedding'].to(model.model.device)))], dtype=torch.int32)
+    logging.info('benchmark flow with {} speech tokens'.format(token.shape[1]))
+
+    ref_mel, ref_time = flow_inference(model, model_input, token, args.ref_n_timesteps, 'euler', 0, args.streaming, args.num_runs)
+    logging.info('reference euler {} steps, {:.4f}s'.format(args.ref_n_timesteps, ref_time))
+    for solver in args.solvers.split(','):
+        for n_timesteps in [int(i) for i in args.n_timesteps.split(',')]:
+            for cfg_skip_steps in [int(i) for i in args.cfg_skip_steps.split(',') if int(i) <= n_timesteps]:
+                mel, cost_time = flow_inference(model, model_input, token, n_timesteps, solver, cfg_skip_steps, args.streaming, args.num_runs)
+                # estimator calls counted in batch 1 rows, cfg steps run 2 rows
+                rows = (2 * n_timesteps - cfg_skip_steps) * ODE_SOLVERS[solver]
+                logging.info('solver {} steps {} cfg skip steps {} estimator rows {}, mel l1 {:.4f}, {:.4f}s, speedup {:.2f}x'.format(
+                    solver, n_timesteps, cfg_skip_steps, rows, (mel - ref_mel).abs().mean().item(), cost_time, ref_time / cost_time))
+
+
+if __name__ == '__main__':
+    main()
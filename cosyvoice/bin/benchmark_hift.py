@@ -0,0 +1,117 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.losses import log_spectral_distance, mel_cepstral_distance
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark hift vocoder precision modes, speed per core and spectral distance to fp32')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--calib_wavs',
+                        type=str,
+                        default='{0}/../../asset/zero_shot_prompt.wav,{0}/../../asset/cross_lingual_prompt.wav'.format(ROOT_DIR),
+                        help='wavs whose mels calibrate int8 activation ranges')
+    parser.add_argument('--eval_wavs',
+                        type=str,
+                        default='{0}/../../asset/tone_man.wav,{0}/../../asset/tone_woman.wav,{0}/../../asset/tone_woman2.wav'.format(ROOT_DIR),
+                        help='wavs whose mels are vocoded to measure speed and quality')
+    parser.add_argument('--precisions', type=str, default='fp32,bf16,int8')
+    parser.add_argument('--num_threads', type=int, default=1, help='cpu intra op threads, speed is reported per core')
+    parser.add_argument('--num_runs', type=int, default=3)
+    parser.add_argument('--max_mcd', type=float, default=1.0, help='quality gate, max mel cepstral distance to fp32 in dB')
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+@torch.inference_mode()
+def vocode(hift, mels, num_runs):
+    """Vocode every mel with the same source noise, return speech and mean seconds per run."""
+    device = next(hift.parameters()).device
+    total_time = 0
+    for _ in range(num_runs):
+        speeches = []
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        for mel in mels:
+            torch.manual_seed(0)
+            speeches.append(hift.inference(mel)[0].float())
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        total_time += time.time() - start_time
+    return speeches, total_time / num_runs
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    if args.num_threads > 0:
+        torch.set_num_threads(args.num_threads)
+
+    model = AutoModel(model_dir=args.model_dir)
+    hift, device = model.model.hift, model.model.device
+    calib_mels = [model.frontend._extract_speech_feat(i)[0].transpose(1, 2).to(device) for i in args.calib_wavs.split(',')]
+    eval_mels = [model.frontend._extract_speech_feat(i)[0].transpose(1, 2).to(device) for i in args.eval_wavs.split(',')]
+    logging.info('benchmark hift on {} threads, {} calibration mels and {} evaluation mels of {} frames'.format(
+        torch.get_num_threads(), len(calib_mels), len(eval_mels), sum(i.shape[2] for i in eval_mels)))
+
+    hift.set_precision('fp32')
+    # warmup, then fp32 reference
+    vocode(hift, eval_mels, 1)
+    ref_speeches, ref_time = vocode(hift, eval_mels, args.num_runs)
+    speech_len = sum(i.shape[1] for i in ref_speeches) / model.sample_rate
+    num_cores = torch.get_num_threads() if device.type == 'cpu' else 1
+    failed = []
+    for precision in args.precisions.split(','):
+        # no fallback here, the gate below decides
+        hift.set_precision(precision, calib_mels, tolerance=float('inf'))
+        if hift.precision != precision:
+            logging.warning('precision {} not available on {}, skip'.format(precision, device))
+            continue
+        vocode(hift, eval_mels, 1)
+        speeches, cost_time = vocode(hift, eval_mels, args.num_runs)
+        mcd = max(mel_cepstral_distance(i, j, model.sample_rate) for i, j in zip(ref_speeches, speeches))
+        lsd = max(log_spectral_distance(i, j) for i, j in zip(ref_speeches, speeches))
+        passed = mcd <= args.max_mcd
+        if not passed:
+            failed.append(precision)
+        logging.info('precision {} {:.4f}s rtf {:.4f}, {:.2f}x realtime per core, speedup {:.2f}x, mcd {:.3f}dB lsd {:.3f}dB, {}'.format(
+            precision, cost_time, cost_time / speech_len, speech_len / cost_time / num_cores, ref_time / cost_time, mcd, lsd, 'pass' if passed else 'fail'))
+    hift.set_precision('fp32')
+    if len(failed) != 0:
+        logging.error('precision {} exceed max mcd {}dB'.format(','.join(failed), args.max_mcd))
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,131 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import copy
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.llm.llm import CosyVoice3LM
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.cpu_utils import set_cpu_threads, quantize_llm_int8
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark cpu llm inference, fp32 against dynamic int8')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice2-0.5B',
+                        help='local path')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='{}/../../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--intra_op_num_threads', type=int, default=0)
+    parser.add_argument('--inter_op_num_threads', type=int, default=0)
+    parser.add_argument('--numa_node', type=int, default=-1)
+    parser.add_argument('--num_runs', type=int, default=3)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+def get_lm_input(llm, model_input):
+    device = model_input['text'].device
+    text = torch.concat([model_input['prompt_text'], model_input['text']], dim=1)
+    text = llm.llm.model.model.embed_tokens(text)
+    if isinstance(llm, CosyVoice3LM):
+        sos_emb, task_id_emb = llm.speech_token_embedding(llm.sos, device), llm.speech_token_embedding(llm.task_id, device)
+    else:
+        sos_emb = llm.llm_embedding.weight[llm.sos].reshape(1, 1, -1)
+        task_id_emb = llm.llm_embedding.weight[llm.task_id].reshape(1, 1, -1)
+    prompt_speech_token_emb = llm.speech_embedding(model_input['llm_prompt_speech_token'])
+    return torch.concat([sos_emb, text, task_id_emb, prompt_speech_token_emb], dim=1)
+
+
+@torch.inference_mode()
+def benchmark_decode(llm, model_input, num_runs):
+    token_num, total_time, tokens = 0, 0, []
+    for _ in range(num_runs):
+        set_all_random_seed(0)
+        start_time = time.time()
+        tokens = list(llm.inference(text=model_input['text'],
+                                    text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32),
+                                    prompt_text=model_input['prompt_text'],
+                                    prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32),
+                                    prompt_speech_token=model_input['llm_prompt_speech_token'],
+                                    prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]], dtype=torch.int32),
+                                    embedding=model_input['llm_embedding']))
+        total_time += time.time() - start_time
+        token_num += len(tokens)
+    return token_num / total_time, tokens
+
+
+@torch.inference_mode()
+def teacher_forcing_logp(llm, model_input, tokens):
+    lm_input = get_lm_input(llm, model_input)
+    token_emb = torch.concat([llm.speech_token_embedding(i, lm_input.device) for i in tokens], dim=1)
+    lm_input = torch.concat([lm_input, token_emb], dim=1)
+    y_pred, _ = llm.llm.forward_one_step(lm_input, masks=torch.tril(torch.ones((1, lm_input.shape[1], lm_input.shape[1]))).to(torch.bool))
+    # logp at position i predicts tokens[i]
+    return llm.llm_decoder(y_pred[:, -len(tokens) - 1: -1]).log_softmax(dim=-1).squeeze(dim=0)
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+    set_cpu_threads(args.intra_op_num_threads, args.inter_op_num_threads, args.numa_node)
+
+    model = AutoModel(model_dir=args.model_dir)
+    assert model.__class__.__name__ in ['CosyVoice2', 'CosyVoice3'], 'only CosyVoice2/CosyVoice3 llm is supported'
+    assert model.model.device.type == 'cpu', 'cpu benchmark, hide your cuda device by CUDA_VISIBLE_DEVICES=""'
+    model_input = model.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, model.sample_rate, '')
+
+    # 1. tokens/s
+    llm_fp32 = model.model.llm
+    llm_int8 = quantize_llm_int8(copy.deepcopy(llm_fp32))
+    fp32_speed, fp32_tokens = benchmark_decode(llm_fp32, model_input, args.num_runs)
+    int8_speed, int8_tokens = benchmark_decode(llm_int8, model_input, args.num_runs)
+    logging.info('fp32 {:.2f} tokens/s, int8 {:.2f} tokens/s, speedup {:.2f}x'.format(fp32_speed, int8_speed, int8_speed / fp32_speed))
+    logging.info('fp32 decode {} tokens, int8 decode {} tokens'.format(len(fp32_tokens), len(int8_tokens)))
+
+    # 2. token distribution drift, teacher forcing int8 with fp32 decoded tokens
+    logp_fp32 = teacher_forcing_logp(llm_fp32, model_input, fp32_tokens)
+    logp_int8 = teacher_forcing_logp(llm_int8, model_input, fp32_tokens)
+    kl = (logp_fp32.exp() * (logp_fp32 - logp_int8)).sum(dim=-1)
+    top1_agreement = (logp_fp32.argmax(dim=-1) == logp_int8.argmax(dim=-1)).float().mean()
+    top25_fp32, top25_int8 = logp_fp32.topk(25, dim=-1).indices, logp_int8.topk(25, dim=-1).indices
+    top25_overlap = torch.tensor([len(set(i.tolist()) & set(j.tolist())) / 25 for i, j in zip(top25_fp32, top25_int8)]).mean()
+    logging.info('kl(fp32||int8) mean {:.4f} max {:.4f}, top1 agreement {:.4f}, top25 overlap {:.4f}'.format(
+        kl.mean().item(), kl.max().item(), top1_agreement.item(), top25_overlap.item()))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,117 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+
+import argparse
+import logging
+logging.getLogger('matplotlib').setLevel(logging.WARNING)
+import os
+import sys
+import time
+import torch
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.append('{}/../..'.format(ROOT_DIR))
+sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
+from cosyvoice.cli.cosyvoice import AutoModel
+from cosyvoice.utils.common import set_all_random_seed
+from cosyvoice.utils.file_utils import logging
+
+
+def get_args():
+    parser = argparse.ArgumentParser(description='benchmark CosyVoice v1 streaming flow per hop latency, with and without prompt cache')
+    parser.add_argument('--model_dir',
+                        type=str,
+                        default='pretrained_models/CosyVoice-300M',
+                        help='local path')
+    parser.add_argument('--prompt_wav',
+                        type=str,
+                        default='{}/../../asset/zero_shot_prompt.wav'.format(ROOT_DIR))
+    parser.add_argument('--prompt_text',
+                        type=str,
+                        default='希望你以后能够做的比我还好呦。')
+    parser.add_argument('--tts_text',
+                        type=str,
+                        default='收到好友从远方寄来的生日礼物，那份意外的惊喜与深深的祝福让我心中充满了甜蜜的快乐，笑容如花儿般绽放。')
+    parser.add_argument('--n_timesteps', type=int, default=10)
+    args = parser.parse_args()
+    print(args)
+    return args
+
+
+@torch.inference_mode()
+def stream_flow(model, model_input, token, n_timesteps, prompt_cache):
+    """Run flow hop by hop with fixed token_min_hop_len hops like CosyVoiceModel.tts stream mode, return mel and latency of each hop."""
+    cosyvoice_model = model.model
+    flow, device = cosyvoice_model.flow, cosyvoice_model.device
+    spk_cond = cosyvoice_model.get_spk_cond(None, model_input['prompt_speech_feat'], model_input['flow_embedding'])
+    flow_cache, token_hop_len, mels, latencies = torch.zeros(1, 80, 0, 2), cosyvoice_model.token_min_hop_len, [], []
+    while token.shape[1] >= token_hop_len + cosyvoice_model.token_overlap_len:
+        this_token = token[:, :token_hop_len + cosyvoice_model.token_overlap_len]
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        start_time = time.time()
+        with torch.cuda.amp.autocast(cosyvoice_model.fp16):
+            mel, flow_cache = flow.inference(token=this_token.to(device),
+                                             token_len=torch.tensor([this_token.shape[1]], dtype=torch.int32).to(device),
+                                             prompt_token=model_input['flow_prompt_speech_token'].to(device),
+                                             prompt_token_len=torch.tensor([model_input['flow_prompt_speech_token'].shape[1]], dtype=torch.int32).to(device),
+                                             prompt_feat=model_input['prompt_speech_feat'].to(device),
+                                             prompt_feat_len=torch.tensor([model_input['prompt_speech_feat'].shape[1]], dtype=torch.int32).to(device),
+                                             embedding=model_input['flow_embedding'].to(device),
+                                             flow_cache=flow_cache,
+                                             n_timesteps=n_timesteps,
+                                             spk_cond=spk_cond,
+                                             prompt_cache=prompt_cache)
+        if device.type == 'cuda':
+            torch.cuda.synchronize()
+        latencies.append(time.time() - start_time)
+        mels.append(mel.float())
+        token = token[:, token_hop_len:]
+    return mels, latencies
+
+
+def main():
+    args = get_args()
+    logging.basicConfig(level=logging.DEBUG,
+                        format='%(asctime)s %(levelname)s %(message)s')
+
+    model = AutoModel(model_dir=args.model_dir)
+    assert model.__class__.__name__ == 'CosyVoice', 'only CosyVoice v1 flow is supported'
+    model_input = model.frontend.frontend_zero_shot(args.tts_text, args.prompt_text, args.prompt_wav, model.sample_rate, '')
+    set_all_random_seed(0)
+    token = torch.tensor([list(model.model.llm.inference(text=model_input['text'].to(model.model.device),
+                                                         text_len=torch.tensor([model_input['text'].shape[1]], dtype=torch.int32).to(model.model.device),
+                                                         prompt_text=model_input['prompt_text'].to(model.model.device),
+                                                         prompt_text_len=torch.tensor([model_input['prompt_text'].shape[1]], dtype=torch.int32).to(model.model.device),
+                                                         prompt_speech_token=model_input['llm_prompt_speech_token'].to(model.model.device),
+                                                         prompt_speech_token_len=torch.tensor([model_input['llm_prompt_speech_token'].shape[1]],
+                                                                                              dtype=torch.int32).to(model.model.device),
+                                                         embedding=model_input['llm_embedding'].to(model.model.device)))], dtype=torch.int32)
+    logging.info('benchmark v1 streaming flow with {} prompt tokens and {} speech tokens'.format(model_input['flow_prompt_speech_token'].shape[1], token.shape[1]))
+
+    # warmup, then same random seed for both runs so the only difference is the prompt cache
+    stream_flow(model, model_input, token, args.n_timesteps, False)
+    set_all_random_seed(0)
+    ref_mels, ref_latencies = stream_flow(model, model_input, token, args.n_timesteps, False)
+    set_all_random_seed(0)
+    mels, latencies = stream_flow(model, model_input, token, args.n_timesteps, True)
+    for i, (ref_mel, mel, ref_latency, latency) in enumerate(zip(ref_mels, mels, ref_latencies, latencies)):
+        logging.info('hop {} full {:.4f}s prompt cache {:.4f}s, speedup {:.2f}x, mel l1 {:.4f}'.format(
+            i, ref_latency, latency, ref_latency / latency, (mel - ref_mel).abs().mean().item()))
+    logging.info('total full {:.4f}s prompt cache {:.4f}s'.format(sum(ref_latencies), sum(latencies)))
+
+
+if __name__ == '__main__':
+    main()
@@ -28,7 +28,8 @@ ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append('{}/../..'.format(ROOT_DIR))
 sys.path.append('{}/../../third_party/Matcha-TTS'.format(ROOT_DIR))
 from cosyvoice.cli.cosyvoice import AutoModel
-from cosyvoice.utils.file_utils import logging
+from cosyvoice.utils.file_utils import logging, export_cosyvoice2_onnx, export_hift_onnx, export_causal_hift_onnx, convert_onnx_to_trt
+from cosyvoice.llm.llm import Qwen2OnnxStep
 
 
 def get_dummy_input(batch_size, seq_len, out_channels, device):
@@ -109,6 +110,59 @@ def main():
         torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
     logging.info('successfully export estimator')
 
+    # 3. export qwen2 llm with explicit kv cache
+    if model.__class__.__name__ in ['CosyVoice2', 'CosyVoice3']:
+        export_cosyvoice2_onnx(model.model.llm, '{}/llm.fp32.onnx'.format(args.model_dir), device)
+        step = Qwen2OnnxStep(model.model.llm)
+        step.eval()
+        input_names, _ = step.get_io_names()
+        llm_onnx = onnxruntime.InferenceSession('{}/llm.fp32.onnx'.format(args.model_dir), sess_options=option, providers=providers)
+        config = step.model.config
+        kv_head, head_dim = config.num_key_value_heads, config.hidden_size // config.num_attention_heads
+        for _ in tqdm(range(10)):
+            seq_len, past_len = random.randint(1, 64), random.randint(0, 256)
+            inputs_embeds = torch.rand((1, seq_len, config.hidden_size), dtype=torch.float32, device=device)
+            attention_mask = torch.ones((1, past_len + seq_len), dtype=torch.int64, device=device)
+            past_key_values = [torch.rand((1, kv_head, past_len, head_dim), dtype=torch.float32, device=device) for _ in range(2 * step.num_layers)]
+            output_pytorch = step(inputs_embeds, attention_mask, *past_key_values)
+            ort_inputs = dict(zip(input_names, [i.cpu().numpy() for i in [inputs_embeds, attention_mask] + past_key_values]))
+            output_onnx = llm_onnx.run(None, ort_inputs)
+            for i, j in zip(output_pytorch, output_onnx):
+                torch.testing.assert_allclose(i, torch.from_numpy(j).to(device), rtol=1e-2, atol=1e-3)
+        logging.info('successfully export llm')
+
+    # 4. export hift decode with conv stft/istft, f0 predictor and source module stay in pytorch
+    hift = model.model.hift
+    export_hift_onnx(hift, '{}/hift.fp32.onnx'.format(args.model_dir), device)
+    hift_onnx = onnxruntime.InferenceSession('{}/hift.fp32.onnx'.format(args.model_dir), sess_options=option, providers=providers)
+    upsample_scale = int(hift.f0_upsamp.scale_factor)
+    for _ in tqdm(range(10)):
+        seq_len = random.randint(16, 512)
+        x = torch.rand((1, hift.conv_pre.in_channels, seq_len), dtype=torch.float32, device=device)
+        s = torch.rand((1, 1, seq_len * upsample_scale), dtype=torch.float32, device=device) * 0.2 - 0.1
+        output_pytorch = hift.decode(x, s)
+        output_onnx = hift_onnx.run(None, {'x': x.cpu().numpy(), 's': s.cpu().numpy()})[0]
+        torch.testing.assert_allclose(output_pytorch, torch.from_numpy(output_onnx).to(device), rtol=1e-2, atol=1e-4)
+    if torch.cuda.is_available():
+        convert_onnx_to_trt('{}/hift.fp32.mygpu.plan'.format(args.model_dir), model.model.get_hift_trt_kwargs(), '{}/hift.fp32.onnx'.format(args.model_dir), False)
+    logging.info('successfully export hift')
+
+    # 5. export steady state streaming step of causal hift with explicit state, compare streams with and without it
+    if model.__class__.__name__ == 'CosyVoice3':
+        export_causal_hift_onnx(hift, '{}/hift.chunk.fp32.onnx'.format(args.model_dir), device)
+        speech_feat = torch.rand((1, hift.conv_pre.in_channels, 500), dtype=torch.float32, device=device)
+
+        def stream(hop_len):
+            cache = hift.init_cache()
+            return torch.concat([hift.inference_chunk(speech_feat[:, :, i:i + hop_len], cache, finalize=i + hop_len >= speech_feat.shape[2])[0]
+                                 for i in range(0, speech_feat.shape[2], hop_len)], dim=1)
+
+        output_pytorch = [stream(hop_len) for hop_len in [50, 100]]
+        model.model.load_hift_onnx('{}/hift.fp32.onnx'.format(args.model_dir), '{}/hift.chunk.fp32.onnx'.format(args.model_dir))
+        for hop_len, i in zip([50, 100], output_pytorch):
+            torch.testing.assert_allclose(i, stream(hop_len), rtol=1e-2, atol=1e-4)
+        logging.info('successfully export causal hift')
+
 
 if __name__ == "__main__":
     main()
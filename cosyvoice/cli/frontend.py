@@ -87,10 +87,10 @@ class CosyVoiceFrontEnd:
             return text_token, text_token_len
 
     def _extract_text_token_generator(self, text_generator):
+        # NOTE yield all text token of one incoming text at once, llm embeds them in one call
         for text in text_generator:
             text_token, _ = self._extract_text_token(text)
-            for i in range(text_token.shape[1]):
-                yield text_token[:, i: i + 1]
+            yield text_token
 
     def _extract_speech_token(self, prompt_wav):
         speech = load_wav(prompt_wav, 16000)
@@ -124,6 +124,12 @@ class CosyVoiceFrontEnd:
         speech_feat_len = torch.tensor([speech_feat.shape[1]], dtype=torch.int32).to(self.device)
         return speech_feat, speech_feat_len
 
+    def _get_language(self, text):
+        # NOTE only used as key of decode guard token/text ratio statistics
+        if not isinstance(text, str):
+            return 'unknown'
+        return 'zh' if contains_chinese(text) else 'en'
+
     def text_normalize(self, text, split=True, text_frontend=True):
         if isinstance(text, Generator):
             logging.info('get tts_text generator, will skip text_normalize!')
@@ -162,7 +168,8 @@ class CosyVoiceFrontEnd:
     def frontend_sft(self, tts_text, spk_id):
         tts_text_token, tts_text_token_len = self._extract_text_token(tts_text)
         embedding = self.spk2info[spk_id]['embedding']
-        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding}
+        model_input = {'text': tts_text_token, 'text_len': tts_text_token_len, 'llm_embedding': embedding, 'flow_embedding': embedding,
+                       'language': self._get_language(tts_text), 'spk_id': spk_id}
         return model_input
 
     def frontend_zero_shot(self, tts_text, prompt_text, prompt_wav, resample_rate, zero_shot_spk_id):
@@ -184,8 +191,11 @@ class CosyVoiceFrontEnd:
                            'llm_embedding': embedding, 'flow_embedding': embedding}
         else:
             model_input = {**self.spk2info[zero_shot_spk_id]}
+            # registered voice, its flow speaker condition is cached by spk_id
+            model_input['spk_id'] = zero_shot_spk_id
         model_input['text'] = tts_text_token
         model_input['text_len'] = tts_text_token_len
+        model_input['language'] = self._get_language(tts_text)
         return model_input
 
     def frontend_cross_lingual(self, tts_text, prompt_wav, resample_rate, zero_shot_spk_id):
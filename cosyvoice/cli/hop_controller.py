@@ -0,0 +1,144 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import threading
+import time
+from collections import deque
+from typing import Dict, Optional
+from cosyvoice.utils.file_utils import logging
+
+
+class HopState:
+    """Per session stream hop schedule, pick each hop from measured llm token rate and token2wav latency."""
+
+    def __init__(self, controller: 'HopController', uuid: str, options: Dict):
+        self.controller = controller
+        self.uuid = uuid
+        self.options = options
+        self.start_time = time.time()
+        self.first_yield_time = None
+        self.first_hop_latency = None
+        # seconds of speech yielded so far
+        self.speech_len = 0.0
+        # token2wav seconds per token, exponential moving average
+        self.token2wav_cost = None
+        self.schedule = []
+        self.num_underrun = 0
+
+    def headroom(self, now: float) -> float:
+        """Seconds of yielded speech not played yet, assuming playback starts at the first yield."""
+        if self.first_yield_time is None:
+            return 0.0
+        return self.speech_len - (now - self.first_yield_time)
+
+    def next_hop(self, num_tokens: int, token_offset: int, llm_end: bool, context_len: int = 0) -> int:
+        """Largest hop whose token wait plus token2wav cost fits in the playback headroom.
+
+        num_tokens is the number of speech tokens produced so far, token_offset the number already consumed and
+        context_len the lookahead/overlap tokens each hop needs beyond its own. The first hop is always min_hop_len
+        for fast first packet, later hops grow in hop_unit steps up to max_hop_len and shrink again under load.
+        """
+        min_hop_len, max_hop_len, unit = self.options['min_hop_len'], self.options['max_hop_len'], self.controller.hop_unit
+        if not self.options['enable'] or self.token2wav_cost is None:
+            return min_hop_len
+        now = time.time()
+        budget = self.headroom(now) * self.options['headroom_ratio']
+        token_rate = num_tokens / max(now - self.start_time, 1e-3)
+        hop_len = min_hop_len
+        for candidate in range(min_hop_len + unit, max_hop_len + 1, unit):
+            missing = max(0, token_offset + candidate + context_len - num_tokens)
+            wait = 0.0 if llm_end is True else missing / max(token_rate, 1e-3)
+            if wait + self.token2wav_cost * candidate > budget:
+                break
+            hop_len = candidate
+        return hop_len
+
+    def update(self, hop_len: int, latency: float):
+        """Record a finished hop of hop_len tokens whose token2wav took latency seconds."""
+        now = time.time()
+        if self.first_yield_time is None:
+            self.first_yield_time = now
+            self.first_hop_latency = now - self.start_time
+        elif self.headroom(now) < 0:
+            # playback drained before this hop was ready
+            self.num_underrun += 1
+        self.speech_len += hop_len / self.controller.token_frame_rate
+        cost = latency / hop_len
+        smoothing = self.options['cost_smoothing']
+        self.token2wav_cost = cost if self.token2wav_cost is None else smoothing * self.token2wav_cost + (1 - smoothing) * cost
+        self.schedule.append(hop_len)
+
+
+class HopController:
+    """Adaptive hop sizing for streaming token2wav.
+
+    A small first hop keeps first packet latency low, then each hop is grown as long as the time to wait for its
+    tokens plus the measured token2wav cost fits in the speech already yielded but not yet played, so hops get
+    longer (cheaper per token) when the server keeps up and shorter again when it falls behind.
+    hop_unit keeps hops a multiple of the flow static chunk for chunk trained models. Every option can be
+    overridden per request.
+    """
+
+    default_options = {
+        'enable': True,
+        'headroom_ratio': 0.5,
+        'cost_smoothing': 0.5,
+    }
+
+    def __init__(self, min_hop_len: int, max_hop_len: int, hop_unit: int, token_frame_rate: float, num_recent: int = 16, **kwargs):
+        assert min_hop_len % hop_unit == 0 and max_hop_len % hop_unit == 0 and min_hop_len <= max_hop_len
+        self.hop_unit = hop_unit
+        self.token_frame_rate = token_frame_rate
+        self.options = {**self.default_options, 'min_hop_len': min_hop_len, 'max_hop_len': max_hop_len}
+        for k in kwargs:
+            assert k in self.options, 'unknown stream hop option {}'.format(k)
+        self.options.update(kwargs)
+        self.lock = threading.Lock()
+        self.counters = {'session': 0, 'hop': 0, 'underrun': 0}
+        self.hop_len_count = {}
+        # sessions shorter than one hop never yield before the final chunk
+        self.first_hop_latency_stats = [0, 0.0]
+        self.recent_schedules = deque(maxlen=num_recent)
+
+    def new_state(self, uuid: str, overrides: Optional[Dict] = None) -> HopState:
+        """Create the hop schedule of a session, call it before starting llm_job so that bad overrides reach the client."""
+        overrides = {} if overrides is None else overrides
+        for k in overrides:
+            if k not in self.options:
+                raise ValueError('unknown stream hop option {}, expect one of {}'.format(k, list(self.options)))
+        options = {**self.options, **overrides}
+        # keep hops a multiple of hop_unit and within the configured bounds, a request can not ask for longer or shorter hops
+        min_hop_len, max_hop_len = self.options['min_hop_len'], self.options['max_hop_len']
+        options['min_hop_len'] = min(max(int(options['min_hop_len']) // self.hop_unit * self.hop_unit, min_hop_len), max_hop_len)
+        options['max_hop_len'] = min(max(int(options['max_hop_len']) // self.hop_unit * self.hop_unit, options['min_hop_len']), max_hop_len)
+        return HopState(self, uuid, options)
+
+    def finish(self, state: HopState):
+        logging.info('stream hop schedule {} {}, first hop latency {}, underrun {}'.format(state.uuid, state.schedule, state.first_hop_latency, state.num_underrun))
+        with self.lock:
+            self.counters['session'] += 1
+            self.counters['hop'] += len(state.schedule)
+            self.counters['underrun'] += state.num_underrun
+            for hop_len in state.schedule:
+                self.hop_len_count[hop_len] = self.hop_len_count.get(hop_len, 0) + 1
+            if state.first_hop_latency is not None:
+                self.first_hop_latency_stats[0] += 1
+                self.first_hop_latency_stats[1] += state.first_hop_latency
+            self.recent_schedules.append({'uuid': state.uuid, 'schedule': state.schedule, 'first_hop_latency': state.first_hop_latency,
+                                          'underrun': state.num_underrun})
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            count, total = self.first_hop_latency_stats
+            return {'options': dict(self.options), 'counters': dict(self.counters), 'hop_len': dict(sorted(self.hop_len_count.items())),
+                    'first_hop_latency_mean': total / count if count > 0 else 0.0, 'recent_schedules': list(self.recent_schedules)}
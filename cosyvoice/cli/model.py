@@ -18,12 +18,18 @@ import torch
 import numpy as np
 import threading
 import time
-from torch.nn import functional as F
 from contextlib import nullcontext
 import uuid
-from cosyvoice.utils.common import fade_in_out
-from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm
+from cosyvoice.utils.common import CrossFade
+from cosyvoice.utils.file_utils import convert_onnx_to_trt, export_cosyvoice2_vllm, export_cosyvoice2_onnx, export_hift_onnx, export_causal_hift_onnx, logging
 from cosyvoice.utils.common import TrtContextWrapper
+from cosyvoice.utils.speed_utils import init_speed_cache, speed_change_chunk
+from cosyvoice.utils.cpu_utils import quantize_llm_int8
+from cosyvoice.utils.memory_utils import MemoryPolicy, get_module_memory
+from cosyvoice.llm.bistream import BistreamSessionManager
+from cosyvoice.llm.decode_guard import DecodeGuard, DROP, STOP
+from cosyvoice.cli.hop_controller import HopController
+from cosyvoice.cli.pipeline import PipelineExecutor
 
 
 class CosyVoiceModel:
@@ -43,24 +49,29 @@ class CosyVoiceModel:
         self.token_overlap_len = 20
         # mel fade in out
         self.mel_overlap_len = int(self.token_overlap_len / self.flow.input_frame_rate * 22050 / 256)
-        self.mel_window = np.hamming(2 * self.mel_overlap_len)
+        self.mel_fade = CrossFade(self.mel_overlap_len)
         # hift cache
         self.mel_cache_len = 20
         self.source_cache_len = int(self.mel_cache_len * 256)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
-        # rtf and decoding related
-        self.stream_scale_factor = 1
-        assert self.stream_scale_factor >= 1, 'stream_scale_factor should be greater than 1, change it according to your actual rtf'
+        self.speech_fade = CrossFade(self.source_cache_len)
+        # rtf and decoding related, stream hop grows from token_min_hop_len to token_max_hop_len according to measured rtf
+        self.hop_controller = HopController(self.token_min_hop_len, self.token_max_hop_len, 1, self.flow.input_frame_rate)
         self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
         self.lock = threading.Lock()
+        # trim cuda cache only above watermarks instead of after every request
+        self.memory_policy = MemoryPolicy(self.device)
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.mel_overlap_dict = {}
         self.flow_cache_dict = {}
         self.hift_cache_dict = {}
+        self.speed_cache_dict = {}
+        # spk_id -> flow speaker condition, see get_spk_cond
+        self.spk_cond_dict = {}
         self.silent_tokens = []
+        self.decode_guard = DecodeGuard(self.silent_tokens)
 
     def load(self, llm_model, flow_model, hift_model):
         self.llm.load_state_dict(torch.load(llm_model, map_location=self.device, weights_only=True), strict=True)
@@ -71,6 +82,13 @@ class CosyVoiceModel:
         hift_state_dict = {k.replace('generator.', ''): v for k, v in torch.load(hift_model, map_location=self.device, weights_only=True).items()}
         self.hift.load_state_dict(hift_state_dict, strict=True)
         self.hift.to(self.device).eval()
+        # fold weight_norm once instead of recomputing normalized weights in every vocoder forward
+        self.hift.optimize_for_inference()
+        # f0_predictor of causal hift runs on cpu by default, move it back once after moving the vocoder
+        if hasattr(self.hift, 'set_f0_device'):
+            self.hift.set_f0_device()
+        for name in ['llm', 'flow', 'hift']:
+            logging.info('{} resident memory {}'.format(name, get_module_memory(getattr(self, name))))
 
     def load_jit(self, llm_text_encoder_model, llm_llm_model, flow_encoder_model):
         llm_text_encoder = torch.jit.load(llm_text_encoder_model, map_location=self.device)
@@ -98,17 +116,38 @@ class CosyVoiceModel:
         input_names = ["x", "mask", "mu", "cond"]
         return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
 
-    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid):
-        cur_silent_token_num, max_silent_token_num = 0, 5
+    def get_onnx_session(self, onnx_model):
+        import onnxruntime
+        option = onnxruntime.SessionOptions()
+        option.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+        option.intra_op_num_threads = torch.get_num_threads()
+        providers = ['CUDAExecutionProvider' if self.device.type == 'cuda' else 'CPUExecutionProvider']
+        return onnxruntime.InferenceSession(onnx_model, sess_options=option, providers=providers)
+
+    def load_hift_onnx(self, hift_onnx_model):
+        export_hift_onnx(self.hift, hift_onnx_model, self.device)
+        self.hift.decode_onnx = self.get_onnx_session(hift_onnx_model)
+
+    def get_hift_trt_kwargs(self):
+        upsample_scale = int(self.hift.f0_upsamp.scale_factor)
+        min_shape = [(1, 80, 4), (1, 1, 4 * upsample_scale)]
+        opt_shape = [(1, 80, 200), (1, 1, 200 * upsample_scale)]
+        max_shape = [(1, 80, 3000), (1, 1, 3000 * upsample_scale)]
+        input_names = ["x", "s"]
+        return {'min_shape': min_shape, 'opt_shape': opt_shape, 'max_shape': max_shape, 'input_names': input_names}
+
+    def llm_job(self, text, prompt_text, llm_prompt_speech_token, llm_embedding, uuid, language='unknown', decode_guard=None):
+        guard = self.decode_guard.new_state(uuid, None if isinstance(text, Generator) else text.shape[1], language, decode_guard)
+        start_time = time.time()
+        if hasattr(self, 'pipeline'):
+            self.pipeline.stages['token'].init_worker()
         with self.llm_context, torch.cuda.amp.autocast(self.fp16 is True and hasattr(self.llm, 'vllm') is False):
             if isinstance(text, Generator):
-                assert (self.__class__.__name__ != 'CosyVoiceModel') and not hasattr(self.llm, 'vllm'), 'streaming input text is only implemented for CosyVoice2/3 and do not support vllm!'
-                token_generator = self.llm.inference_bistream(text=text,
-                                                              prompt_text=prompt_text.to(self.device),
-                                                              prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(self.device),
-                                                              prompt_speech_token=llm_prompt_speech_token.to(self.device),
-                                                              prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
-                                                              embedding=llm_embedding.to(self.device))
+                token_generator = self.bistream_manager.inference(text=text,
+                                                                  prompt_text=prompt_text.to(self.device),
+                                                                  prompt_speech_token=llm_prompt_speech_token.to(self.device),
+                                                                  max_token_text_ratio=guard.max_token_text_ratio,
+                                                                  uuid=uuid)
             else:
                 token_generator = self.llm.inference(text=text.to(self.device),
                                                      text_len=torch.tensor([text.shape[1]], dtype=torch.int32).to(self.device),
@@ -117,22 +156,39 @@ class CosyVoiceModel:
                                                      prompt_speech_token=llm_prompt_speech_token.to(self.device),
                                                      prompt_speech_token_len=torch.tensor([llm_prompt_speech_token.shape[1]], dtype=torch.int32).to(self.device),
                                                      embedding=llm_embedding.to(self.device),
-                                                     uuid=uuid)  
+                                                     max_token_text_ratio=guard.max_token_text_ratio,
+                                                     min_token_text_ratio=guard.min_token_text_ratio,
+                                                     uuid=uuid)
             for i in token_generator:
-                if i in self.silent_tokens:
-                    cur_silent_token_num += 1
-                    if cur_silent_token_num > max_silent_token_num:
-                        continue
-                else:
-                    cur_silent_token_num = 0
+                action = guard.check(i)
+                if action == DROP:
+                    continue
+                if action == STOP:
+                    # NOTE close generator explicitly so that vllm request or bistream session is released
+                    token_generator.close()
+                    break
                 self.tts_speech_token_dict[uuid].append(i)
+        self.decode_guard.finish(guard)
+        if hasattr(self, 'pipeline'):
+            self.pipeline.stages['token'].record(time.time() - start_time, len(self.tts_speech_token_dict[uuid]))
         self.llm_end_dict[uuid] = True
 
+    def get_spk_cond(self, spk_id, prompt_feat, embedding):
+        # speaker projection and prompt mel condition of a registered voice are identical across requests
+        if spk_id is not None and spk_id in self.spk_cond_dict:
+            return self.spk_cond_dict[spk_id]
+        with torch.cuda.amp.autocast(self.fp16):
+            spk_cond = self.flow.get_spk_cond(embedding.to(self.device), prompt_feat.to(self.device))
+        if spk_id is not None:
+            with self.lock:
+                self.spk_cond_dict[spk_id] = spk_cond
+        return spk_cond
+
     def vc_job(self, source_speech_token, uuid):
         self.tts_speech_token_dict[uuid] = source_speech_token.flatten().tolist()
         self.llm_end_dict[uuid] = True
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0):
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, uuid, finalize=False, speed=1.0, **flow_kwargs):
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, self.flow_cache_dict[uuid] = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                                                       token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -141,35 +197,38 @@ class CosyVoiceModel:
                                                                       prompt_feat=prompt_feat.to(self.device),
                                                                       prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                                                       embedding=embedding.to(self.device),
-                                                                      flow_cache=self.flow_cache_dict[uuid])
+                                                                      flow_cache=self.flow_cache_dict[uuid],
+                                                                      **flow_kwargs)
 
         # mel overlap fade in out
         if self.mel_overlap_dict[uuid].shape[2] != 0:
-            tts_mel = fade_in_out(tts_mel, self.mel_overlap_dict[uuid], self.mel_window)
+            tts_mel = self.mel_fade(tts_mel, self.mel_overlap_dict[uuid], inplace=True)
+        # keep overlap mel
+        if finalize is False:
+            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
+            tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
+        # speed change of faded mel, chunk consistent so stream and non-stream mode give the same frames
+        if speed != 1.0:
+            tts_mel = speed_change_chunk(tts_mel, speed, self.speed_cache_dict[uuid], finalize=finalize)
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
             tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
         else:
             hift_cache_source = torch.zeros(1, 1, 0)
-        # keep overlap mel and hift cache
+        # keep hift cache
         if finalize is False:
-            self.mel_overlap_dict[uuid] = tts_mel[:, :, -self.mel_overlap_len:]
-            tts_mel = tts_mel[:, :, :-self.mel_overlap_len]
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = self.speech_fade(tts_speech, self.hift_cache_dict[uuid]['speech'], inplace=True)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
                                           'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
-            if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
-                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = self.speech_fade(tts_speech, self.hift_cache_dict[uuid]['speech'], inplace=True)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
@@ -177,23 +236,40 @@ class CosyVoiceModel:
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+        if isinstance(text, Generator):
+            raise ValueError('streaming input text is only implemented for CosyVoice2/3!')
+        # NOTE reject bad overrides here, an error raised in llm_job would leave the request waiting for llm_end_dict forever
+        self.decode_guard.check_overrides(kwargs.get('decode_guard', None))
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        # NOTE create the hop schedule before llm_job starts, it raises ValueError on bad stream_hop overrides
+        hop_state = self.hop_controller.new_state(this_uuid, kwargs.get('stream_hop', None)) if stream is True else None
+        # flow matching ode steps, solver and cfg, see ODE_SOLVERS in flow_matching.py
+        flow_kwargs = {'n_timesteps': kwargs.get('n_timesteps', 10), 'solver': kwargs.get('solver', None), 'cfg_skip_steps': kwargs.get('cfg_skip_steps', 0),
+                       'spk_cond': self.get_spk_cond(kwargs.get('spk_id', None), prompt_speech_feat, flow_embedding)}
+        # encode prompt tokens once per session/registered voice instead of every hop, see MaskedDiffWithXvec.encode_prompt
+        flow_kwargs['prompt_cache'] = kwargs.get('prompt_cache', False)
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
+            self.speed_cache_dict[this_uuid] = init_speed_cache()
             self.mel_overlap_dict[this_uuid] = torch.zeros(1, 80, 0)
             self.flow_cache_dict[this_uuid] = torch.zeros(1, 80, 0, 2)
         if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid,
+                                                            kwargs.get('language', 'unknown'), kwargs.get('decode_guard', None)))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
         if stream is True:
-            token_hop_len = self.token_min_hop_len
+            token_offset = 0
             while True:
                 time.sleep(0.1)
+                # consumed tokens are dropped from tts_speech_token_dict, token_offset counts them
+                token_hop_len = hop_state.next_hop(token_offset + len(self.tts_speech_token_dict[this_uuid]), token_offset,
+                                                   self.llm_end_dict[this_uuid], self.token_overlap_len)
                 if len(self.tts_speech_token_dict[this_uuid]) >= token_hop_len + self.token_overlap_len:
+                    start_time = time.time()
                     this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_hop_len + self.token_overlap_len]) \
                         .unsqueeze(dim=0)
                     this_tts_speech = self.token2wav(token=this_tts_speech_token,
@@ -201,15 +277,18 @@ class CosyVoiceModel:
                                                      prompt_feat=prompt_speech_feat,
                                                      embedding=flow_embedding,
                                                      uuid=this_uuid,
-                                                     finalize=False)
-                    yield {'tts_speech': this_tts_speech.cpu()}
+                                                     finalize=False,
+                                                     speed=speed,
+                                                     **flow_kwargs).cpu()
+                    hop_state.update(token_hop_len, time.time() - start_time)
+                    yield {'tts_speech': this_tts_speech}
                     with self.lock:
                         self.tts_speech_token_dict[this_uuid] = self.tts_speech_token_dict[this_uuid][token_hop_len:]
-                    # increase token_hop_len for better speech quality
-                    token_hop_len = min(self.token_max_hop_len, int(token_hop_len * self.stream_scale_factor))
+                    token_offset += token_hop_len
                 if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) < token_hop_len + self.token_overlap_len:
                     break
             p.join()
+            self.hop_controller.finish(hop_state)
             # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
             this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
             this_tts_speech = self.token2wav(token=this_tts_speech_token,
@@ -217,7 +296,9 @@ class CosyVoiceModel:
                                              prompt_feat=prompt_speech_feat,
                                              embedding=flow_embedding,
                                              uuid=this_uuid,
-                                             finalize=True)
+                                             finalize=True,
+                                             speed=speed,
+                                             **flow_kwargs)
             yield {'tts_speech': this_tts_speech.cpu()}
         else:
             # deal with all tokens
@@ -229,17 +310,17 @@ class CosyVoiceModel:
                                              embedding=flow_embedding,
                                              uuid=this_uuid,
                                              finalize=True,
-                                             speed=speed)
+                                             speed=speed,
+                                             **flow_kwargs)
             yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
             self.tts_speech_token_dict.pop(this_uuid)
             self.llm_end_dict.pop(this_uuid)
             self.mel_overlap_dict.pop(this_uuid)
             self.hift_cache_dict.pop(this_uuid)
+            self.speed_cache_dict.pop(this_uuid)
             self.flow_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+        self.memory_policy.after_request()
 
 
 class CosyVoice2Model(CosyVoiceModel):
@@ -260,15 +341,27 @@ class CosyVoice2Model(CosyVoiceModel):
         self.mel_cache_len = 8
         self.source_cache_len = int(self.mel_cache_len * 480)
         # speech fade in out
-        self.speech_window = np.hamming(2 * self.source_cache_len)
-        # rtf and decoding related
-        self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
+        self.speech_fade = CrossFade(self.source_cache_len)
+        # rtf and decoding related, stream hop is a multiple of token_hop_len so finalized chunks stay aligned
+        self.hop_controller = HopController(self.token_hop_len, 4 * self.token_hop_len, self.token_hop_len, self.flow.input_frame_rate)
+        # stream mode runs token, token2mel and mel2wav as pipeline stages, llm uses the token stage stream
+        self.pipeline = PipelineExecutor(self.device)
+        self.llm_context = self.pipeline.stages['token'].context()
         self.lock = threading.Lock()
+        # trim cuda cache only above watermarks instead of after every request
+        self.memory_policy = MemoryPolicy(self.device)
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.speed_cache_dict = {}
+        self.flow_cache_dict = {}
+        # spk_id -> flow speaker condition, see get_spk_cond
+        self.spk_cond_dict = {}
         self.silent_tokens = []
+        self.decode_guard = DecodeGuard(self.silent_tokens)
+        # bistream sessions share one batched llm decode loop
+        self.bistream_manager = BistreamSessionManager(self.llm, self.fp16, context=self.pipeline.stages['token'].context)
 
     def load_jit(self, flow_encoder_model):
         flow_encoder = torch.jit.load(flow_encoder_model, map_location=self.device)
@@ -285,7 +378,23 @@ class CosyVoice2Model(CosyVoiceModel):
         self.llm.lock = threading.Lock()
         del self.llm.llm.model.model.layers
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def load_onnx(self, llm_onnx_model):
+        export_cosyvoice2_onnx(self.llm, llm_onnx_model, self.device)
+        self.llm.llm_onnx = self.get_onnx_session(llm_onnx_model)
+        config = self.llm.llm.model.config
+        self.llm.llm_onnx_kv_head, self.llm.llm_onnx_head_dim = config.num_key_value_heads, config.hidden_size // config.num_attention_heads
+        self.llm.llm_onnx_past_names = [i.name for i in self.llm.llm_onnx.get_inputs()[2:]]
+        del self.llm.llm.model.model.layers
+
+    def load_int8(self):
+        assert self.device.type == 'cpu', 'int8 dynamic quantization only supports cpu!'
+        quantize_llm_int8(self.llm)
+
+    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0, **flow_kwargs):
+        tts_mel = self.token2mel(token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=stream, finalize=finalize, **flow_kwargs)
+        return self.mel2wav(tts_mel, uuid, finalize=finalize, speed=speed)
+
+    def token2mel(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, **flow_kwargs):
         with torch.cuda.amp.autocast(self.fp16):
             tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
                                              token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
@@ -295,8 +404,15 @@ class CosyVoice2Model(CosyVoiceModel):
                                              prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
                                              embedding=embedding.to(self.device),
                                              streaming=stream,
-                                             finalize=finalize)
-        tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+                                             finalize=finalize,
+                                             cache=self.flow_cache_dict[uuid],
+                                             **flow_kwargs)
+        return tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
+
+    def mel2wav(self, tts_mel, uuid, finalize=False, speed=1.0):
+        # speed change, chunk consistent so stream and non-stream mode give the same frames
+        if speed != 1.0:
+            tts_mel = speed_change_chunk(tts_mel, speed, self.speed_cache_dict[uuid], finalize=finalize)
         # append hift cache
         if self.hift_cache_dict[uuid] is not None:
             hift_cache_mel, hift_cache_source = self.hift_cache_dict[uuid]['mel'], self.hift_cache_dict[uuid]['source']
@@ -307,18 +423,15 @@ class CosyVoice2Model(CosyVoiceModel):
         if finalize is False:
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = self.speech_fade(tts_speech, self.hift_cache_dict[uuid]['speech'], inplace=True)
             self.hift_cache_dict[uuid] = {'mel': tts_mel[:, :, -self.mel_cache_len:],
                                           'source': tts_source[:, :, -self.source_cache_len:],
                                           'speech': tts_speech[:, -self.source_cache_len:]}
             tts_speech = tts_speech[:, :-self.source_cache_len]
         else:
-            if speed != 1.0:
-                assert self.hift_cache_dict[uuid] is None, 'speed change only support non-stream inference mode'
-                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
             tts_speech, tts_source = self.hift.inference(speech_feat=tts_mel, cache_source=hift_cache_source)
             if self.hift_cache_dict[uuid] is not None:
-                tts_speech = fade_in_out(tts_speech, self.hift_cache_dict[uuid]['speech'], self.speech_window)
+                tts_speech = self.speech_fade(tts_speech, self.hift_cache_dict[uuid]['speech'], inplace=True)
         return tts_speech
 
     def tts(self, text=torch.zeros(1, 0, dtype=torch.int32), flow_embedding=torch.zeros(0, 192), llm_embedding=torch.zeros(0, 192),
@@ -326,47 +439,77 @@ class CosyVoice2Model(CosyVoiceModel):
             llm_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             flow_prompt_speech_token=torch.zeros(1, 0, dtype=torch.int32),
             prompt_speech_feat=torch.zeros(1, 0, 80), source_speech_token=torch.zeros(1, 0, dtype=torch.int32), stream=False, speed=1.0, **kwargs):
+        # NOTE reject bad overrides here, an error raised in llm_job would leave the request waiting for llm_end_dict forever
+        self.decode_guard.check_overrides(kwargs.get('decode_guard', None))
         # this_uuid is used to track variables related to this inference thread
         this_uuid = str(uuid.uuid1())
+        # NOTE create the hop schedule before llm_job starts, it raises ValueError on bad stream_hop overrides
+        hop_state = self.hop_controller.new_state(this_uuid, kwargs.get('stream_hop', None)) if stream is True else None
+        # flow matching ode steps, solver and cfg, see ODE_SOLVERS in flow_matching.py
+        flow_kwargs = {'n_timesteps': kwargs.get('n_timesteps', 10), 'solver': kwargs.get('solver', None), 'cfg_skip_steps': kwargs.get('cfg_skip_steps', 0),
+                       'spk_cond': self.get_spk_cond(kwargs.get('spk_id', None), prompt_speech_feat, flow_embedding)}
         with self.lock:
             self.tts_speech_token_dict[this_uuid], self.llm_end_dict[this_uuid] = [], False
             self.hift_cache_dict[this_uuid] = None
+            self.speed_cache_dict[this_uuid] = init_speed_cache()
+            # incremental token2mel state of finalized chunks, only used in stream mode
+            self.flow_cache_dict[this_uuid] = self.flow.init_cache() if stream is True and hasattr(self.flow, 'init_cache') else None
         if source_speech_token.shape[1] == 0:
-            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid))
+            p = threading.Thread(target=self.llm_job, args=(text, prompt_text, llm_prompt_speech_token, llm_embedding, this_uuid,
+                                                            kwargs.get('language', 'unknown'), kwargs.get('decode_guard', None)))
         else:
             p = threading.Thread(target=self.vc_job, args=(source_speech_token, this_uuid))
         p.start()
         if stream is True:
-            token_offset = 0
             prompt_token_pad = int(np.ceil(flow_prompt_speech_token.shape[1] / self.token_hop_len) * self.token_hop_len - flow_prompt_speech_token.shape[1])
-            while True:
-                time.sleep(0.1)
-                this_token_hop_len = self.token_hop_len + prompt_token_pad if token_offset == 0 else self.token_hop_len
-                if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
-                    this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]).unsqueeze(dim=0)
-                    this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                                     prompt_token=flow_prompt_speech_token,
-                                                     prompt_feat=prompt_speech_feat,
-                                                     embedding=flow_embedding,
-                                                     token_offset=token_offset,
-                                                     uuid=this_uuid,
-                                                     stream=stream,
-                                                     finalize=False)
-                    token_offset += this_token_hop_len
-                    yield {'tts_speech': this_tts_speech.cpu()}
-                if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
-                    break
-            p.join()
-            # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
-            this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
-            this_tts_speech = self.token2wav(token=this_tts_speech_token,
-                                             prompt_token=flow_prompt_speech_token,
-                                             prompt_feat=prompt_speech_feat,
-                                             embedding=flow_embedding,
-                                             token_offset=token_offset,
-                                             uuid=this_uuid,
-                                             finalize=True)
-            yield {'tts_speech': this_tts_speech.cpu()}
+
+            def chunks(should_stop):
+                # token stage, wait until the llm has produced the next hop
+                token_offset = 0
+                while True:
+                    time.sleep(0.1)
+                    # NOTE stream closed by client or decode guard, do not wait for the rest of llm decoding
+                    if should_stop():
+                        return
+                    token_hop_len = hop_state.next_hop(len(self.tts_speech_token_dict[this_uuid]), token_offset, self.llm_end_dict[this_uuid], self.flow.pre_lookahead_len)
+                    this_token_hop_len = token_hop_len + prompt_token_pad if token_offset == 0 else token_hop_len
+                    if len(self.tts_speech_token_dict[this_uuid]) - token_offset >= this_token_hop_len + self.flow.pre_lookahead_len:
+                        this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid][:token_offset + this_token_hop_len + self.flow.pre_lookahead_len]) \
+                            .unsqueeze(dim=0)
+                        yield {'token': this_tts_speech_token, 'token_offset': token_offset, 'hop_len': this_token_hop_len, 'stream': stream, 'finalize': False}
+                        token_offset += this_token_hop_len
+                    if self.llm_end_dict[this_uuid] is True and len(self.tts_speech_token_dict[this_uuid]) - token_offset < this_token_hop_len + self.flow.pre_lookahead_len:
+                        break
+                if should_stop():
+                    return
+                p.join()
+                # deal with remain tokens, make sure inference remain token len equals token_hop_len when cache_speech is not None
+                this_tts_speech_token = torch.tensor(self.tts_speech_token_dict[this_uuid]).unsqueeze(dim=0)
+                yield {'token': this_tts_speech_token, 'token_offset': token_offset, 'hop_len': None, 'stream': False, 'finalize': True}
+
+            def token2mel(chunk):
+                start_time = time.time()
+                tts_mel = self.token2mel(token=chunk['token'],
+                                         prompt_token=flow_prompt_speech_token,
+                                         prompt_feat=prompt_speech_feat,
+                                         embedding=flow_embedding,
+                                         token_offset=chunk['token_offset'],
+                                         uuid=this_uuid,
+                                         stream=chunk['stream'],
+                                         finalize=chunk['finalize'],
+                                         **flow_kwargs)
+                return {'mel': tts_mel, 'hop_len': chunk['hop_len'], 'finalize': chunk['finalize'], 'start_time': start_time}
+
+            def mel2wav(item):
+                this_tts_speech = self.mel2wav(item['mel'], this_uuid, finalize=item['finalize'], speed=speed).cpu()
+                if item['hop_len'] is not None:
+                    hop_state.update(item['hop_len'], time.time() - item['start_time'])
+                return this_tts_speech
+
+            # vocoder of chunk N overlaps with flow of chunk N + 1, see PipelineExecutor
+            for this_tts_speech in self.pipeline.run(this_uuid, chunks, token2mel, mel2wav):
+                yield {'tts_speech': this_tts_speech}
+            self.hop_controller.finish(hop_state)
         else:
             # deal with all tokens
             p.join()
@@ -378,15 +521,16 @@ class CosyVoice2Model(CosyVoiceModel):
                                              token_offset=0,
                                              uuid=this_uuid,
                                              finalize=True,
-                                             speed=speed)
+                                             speed=speed,
+                                             **flow_kwargs)
             yield {'tts_speech': this_tts_speech.cpu()}
         with self.lock:
             self.tts_speech_token_dict.pop(this_uuid)
             self.llm_end_dict.pop(this_uuid)
             self.hift_cache_dict.pop(this_uuid)
-        if torch.cuda.is_available():
-            torch.cuda.empty_cache()
-            torch.cuda.current_stream().synchronize()
+            self.speed_cache_dict.pop(this_uuid)
+            self.flow_cache_dict.pop(this_uuid)
+        self.memory_policy.after_request()
 
 
 class CosyVoice3Model(CosyVoice2Model):
@@ -403,39 +547,42 @@ class CosyVoice3Model(CosyVoice2Model):
         self.fp16 = fp16
         # NOTE must matching training static_chunk_size
         self.token_hop_len = 25
-        # rtf and decoding related
-        self.llm_context = torch.cuda.stream(torch.cuda.Stream(self.device)) if torch.cuda.is_available() else nullcontext()
+        # rtf and decoding related, stream hop is a multiple of token_hop_len so finalized chunks stay aligned
+        self.hop_controller = HopController(self.token_hop_len, 4 * self.token_hop_len, self.token_hop_len, self.flow.input_frame_rate)
+        # stream mode runs token, token2mel and mel2wav as pipeline stages, llm uses the token stage stream
+        self.pipeline = PipelineExecutor(self.device)
+        self.llm_context = self.pipeline.stages['token'].context()
         self.lock = threading.Lock()
+        # trim cuda cache only above watermarks instead of after every request
+        self.memory_policy = MemoryPolicy(self.device)
         # dict used to store session related variable
         self.tts_speech_token_dict = {}
         self.llm_end_dict = {}
         self.hift_cache_dict = {}
+        self.speed_cache_dict = {}
+        self.flow_cache_dict = {}
+        # spk_id -> flow speaker condition, see get_spk_cond
+        self.spk_cond_dict = {}
         # FSQ silent and breath token
         self.silent_tokens = [1, 2, 28, 29, 55, 248, 494, 2241, 2242, 2322, 2323]
+        self.decode_guard = DecodeGuard(self.silent_tokens)
+        # bistream sessions share one batched llm decode loop
+        self.bistream_manager = BistreamSessionManager(self.llm, self.fp16, context=self.pipeline.stages['token'].context)
 
-    def token2wav(self, token, prompt_token, prompt_feat, embedding, token_offset, uuid, stream=False, finalize=False, speed=1.0):
+    def load_hift_onnx(self, hift_onnx_model, hift_chunk_onnx_model):
+        super().load_hift_onnx(hift_onnx_model)
+        export_causal_hift_onnx(self.hift, hift_chunk_onnx_model, self.device)
+        self.hift.decode_chunk_onnx = self.get_onnx_session(hift_chunk_onnx_model)
+        # empty states are not graph inputs, the last state (istft overlap) is never empty
+        state_lengths = {int(i.name.split('_')[1]): i.shape[-1] for i in self.hift.decode_chunk_onnx.get_inputs()[2:]}
+        self.hift.decode_chunk_onnx_state_lengths = [state_lengths.get(k, 0) for k in range(max(state_lengths) + 1)]
+
+    def mel2wav(self, tts_mel, uuid, finalize=False, speed=1.0):
         with torch.cuda.amp.autocast(self.fp16):
-            tts_mel, _ = self.flow.inference(token=token.to(self.device, dtype=torch.int32),
-                                             token_len=torch.tensor([token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_token=prompt_token.to(self.device),
-                                             prompt_token_len=torch.tensor([prompt_token.shape[1]], dtype=torch.int32).to(self.device),
-                                             prompt_feat=prompt_feat.to(self.device),
-                                             prompt_feat_len=torch.tensor([prompt_feat.shape[1]], dtype=torch.int32).to(self.device),
-                                             embedding=embedding.to(self.device),
-                                             streaming=stream,
-                                             finalize=finalize)
-            tts_mel = tts_mel[:, :, token_offset * self.flow.token_mel_ratio:]
-            # append mel cache
-            if self.hift_cache_dict[uuid] is not None:
-                hift_cache_mel = self.hift_cache_dict[uuid]['mel']
-                tts_mel = torch.concat([hift_cache_mel, tts_mel], dim=2)
-                self.hift_cache_dict[uuid]['mel'] = tts_mel
-            else:
-                self.hift_cache_dict[uuid] = {'mel': tts_mel, 'speech_offset': 0}
+            # streaming vocoder state, each call only vocodes the new mel frames
+            if self.hift_cache_dict[uuid] is None:
+                self.hift_cache_dict[uuid] = self.hift.init_cache()
             if speed != 1.0:
-                assert token_offset == 0 and finalize is True, 'speed change only support non-stream inference mode'
-                tts_mel = F.interpolate(tts_mel, size=int(tts_mel.shape[2] / speed), mode='linear')
-            tts_speech, _ = self.hift.inference(speech_feat=tts_mel, finalize=finalize)
-            tts_speech = tts_speech[:, self.hift_cache_dict[uuid]['speech_offset']:]
-            self.hift_cache_dict[uuid]['speech_offset'] += tts_speech.shape[1]
+                tts_mel = speed_change_chunk(tts_mel, speed, self.speed_cache_dict[uuid], finalize=finalize)
+            tts_speech, _ = self.hift.inference_chunk(speech_feat=tts_mel, cache=self.hift_cache_dict[uuid], finalize=finalize)
         return tts_speech
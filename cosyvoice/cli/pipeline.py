@@ -0,0 +1,207 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+import time
+from contextlib import nullcontext
+from typing import Any, Callable, Dict, Generator, Optional
+import torch
+from cosyvoice.utils.file_utils import logging
+
+STAGES = ['token', 'token2mel', 'mel2wav']
+# end of stream marker passed through the queues
+END = object()
+
+
+def record_stream(item: Any, stream: torch.cuda.Stream):
+    """Mark tensors of item as used on stream, so the allocator does not hand them back to their producer stream early."""
+    if isinstance(item, torch.Tensor):
+        if item.is_cuda:
+            item.record_stream(stream)
+    elif isinstance(item, (list, tuple)):
+        for i in item:
+            record_stream(i, stream)
+    elif isinstance(item, dict):
+        for i in item.values():
+            record_stream(i, stream)
+
+
+class PipelineStage:
+    """One stage shared by all sessions, with its own cuda stream on gpu or its own intra op threads on cpu."""
+
+    def __init__(self, name: str, device: torch.device, num_threads: int = 0):
+        self.name = name
+        self.stream = torch.cuda.Stream(device) if device.type == 'cuda' else None
+        # NOTE torch.set_num_threads is per thread for openmp/mkl, so each stage worker can have its own pool size
+        self.num_threads = num_threads
+        self.lock = threading.Lock()
+        self.busy_time = 0.0
+        self.num_items = 0
+        # time blocked on a full output queue, i.e. waiting for the next stage
+        self.blocked_time = 0.0
+
+    def context(self):
+        return torch.cuda.stream(self.stream) if self.stream is not None else nullcontext()
+
+    def init_worker(self):
+        if self.stream is None and self.num_threads > 0:
+            torch.set_num_threads(self.num_threads)
+
+    def record(self, busy_time: float, num_items: int = 1, blocked_time: float = 0.0):
+        with self.lock:
+            self.busy_time += busy_time
+            self.num_items += num_items
+            self.blocked_time += blocked_time
+
+
+class PipelineSession:
+    """Worker threads and bounded queues of one streaming request."""
+
+    def __init__(self, executor: 'PipelineExecutor', uuid: str):
+        self.executor = executor
+        self.uuid = uuid
+        self.mel_queue = queue.Queue(maxsize=executor.queue_size)
+        self.speech_queue = queue.Queue(maxsize=executor.queue_size)
+        self.stop = threading.Event()
+
+    def put(self, q: queue.Queue, item) -> float:
+        """Put with backpressure, return blocked seconds, give up once the session is stopped."""
+        start_time = time.time()
+        while not self.stop.is_set():
+            try:
+                q.put(item, timeout=0.1)
+                break
+            except queue.Full:
+                continue
+        return time.time() - start_time
+
+    def token2mel_worker(self, chunks: Callable[[Callable[[], bool]], Generator], token2mel: Callable):
+        stage = self.executor.stages['token2mel']
+        stage.init_worker()
+        try:
+            with stage.context():
+                for chunk in chunks(self.stop.is_set):
+                    start_time = time.time()
+                    item = token2mel(chunk)
+                    if stage.stream is not None:
+                        # NOTE only this worker waits for its own stream, so busy time is device time and mel2wav
+                        # issued afterwards on its stream sees a finished chunk
+                        stage.stream.synchronize()
+                    busy_time = time.time() - start_time
+                    blocked_time = self.put(self.mel_queue, item)
+                    stage.record(busy_time, blocked_time=blocked_time)
+                    if self.stop.is_set():
+                        return
+            self.put(self.mel_queue, END)
+        except Exception as e:
+            self.put(self.mel_queue, e)
+
+    def mel2wav_worker(self, mel2wav: Callable):
+        stage = self.executor.stages['mel2wav']
+        stage.init_worker()
+        try:
+            with stage.context():
+                while not self.stop.is_set():
+                    try:
+                        item = self.mel_queue.get(timeout=0.1)
+                    except queue.Empty:
+                        continue
+                    if item is END or isinstance(item, Exception):
+                        self.put(self.speech_queue, item)
+                        return
+                    start_time = time.time()
+                    if stage.stream is not None:
+                        record_stream(item, stage.stream)
+                    # NOTE mel2wav returns speech on cpu, which also waits for this chunk on the stage stream
+                    speech = mel2wav(item)
+                    busy_time = time.time() - start_time
+                    blocked_time = self.put(self.speech_queue, speech)
+                    stage.record(busy_time, blocked_time=blocked_time)
+        except Exception as e:
+            self.put(self.speech_queue, e)
+
+
+class PipelineExecutor:
+    """Streaming executor with three stages, token production -> token2mel -> mel2wav.
+
+    The token stage is llm_job, token2mel and mel2wav of a request run in their own worker threads. Every stage has
+    its own cuda stream (or its own intra op thread pool on cpu) and a bounded queue to the next stage, so the vocoder
+    of chunk N overlaps with the flow of chunk N + 1 while the llm keeps decoding. The queue size bounds how far a
+    stage may run ahead. Busy time of each stage is accumulated to report its utilization.
+    """
+
+    def __init__(self, device: torch.device, queue_size: int = 2, stage_threads: Optional[Dict[str, int]] = None):
+        stage_threads = {} if stage_threads is None else stage_threads
+        for k in stage_threads:
+            assert k in STAGES, 'unknown pipeline stage {}'.format(k)
+        self.device = device
+        self.queue_size = queue_size
+        self.stages = {name: PipelineStage(name, device, stage_threads.get(name, 0)) for name in STAGES}
+        self.start_time = time.time()
+        self.lock = threading.Lock()
+        self.num_sessions = 0
+
+    def configure(self, queue_size: Optional[int] = None, stage_threads: Optional[Dict[str, int]] = None):
+        """Change queue size and cpu threads of stages, applies to sessions started afterwards."""
+        if queue_size is not None:
+            assert queue_size > 0
+            self.queue_size = queue_size
+        for k, v in ({} if stage_threads is None else stage_threads).items():
+            assert k in STAGES, 'unknown pipeline stage {}'.format(k)
+            self.stages[k].num_threads = v
+
+    def run(self, uuid: str, chunks: Callable[[Callable[[], bool]], Generator], token2mel: Callable, mel2wav: Callable) -> Generator:
+        """Run token2mel and mel2wav of one request in their stage workers and yield speech chunks in order.
+
+        chunks is a generator function which waits for tokens of the token stage and yields the input of each chunk,
+        it is called with should_stop and must return soon once should_stop() is True. token2mel maps a chunk to a mel
+        item and mel2wav maps a mel item to a speech chunk on cpu. Closing the returned generator stops both workers.
+        """
+        with self.lock:
+            self.num_sessions += 1
+        session = PipelineSession(self, uuid)
+        if self.device.type == 'cuda':
+            # inputs like speaker condition were prepared on the caller stream
+            for stage in self.stages.values():
+                stage.stream.wait_stream(torch.cuda.current_stream())
+        workers = [threading.Thread(target=session.token2mel_worker, args=(chunks, token2mel)),
+                   threading.Thread(target=session.mel2wav_worker, args=(mel2wav,))]
+        for worker in workers:
+            worker.start()
+        try:
+            while True:
+                speech = session.speech_queue.get()
+                if speech is END:
+                    break
+                if isinstance(speech, Exception):
+                    raise speech
+                yield speech
+        finally:
+            session.stop.set()
+            for worker in workers:
+                worker.join()
+
+    def get_stats(self) -> Dict:
+        elapsed = time.time() - self.start_time
+        stats = {'sessions': self.num_sessions, 'elapsed': elapsed, 'queue_size': self.queue_size, 'stages': {}}
+        for name, stage in self.stages.items():
+            with stage.lock:
+                stats['stages'][name] = {'items': stage.num_items, 'busy_time': stage.busy_time, 'blocked_time': stage.blocked_time,
+                                         'utilization': stage.busy_time / elapsed if elapsed > 0 else 0.0, 'num_threads': stage.num_threads}
+        return stats
+
+    def log_stats(self):
+        for name, stage in self.get_stats()['stages'].items():
+            logging.info('pipeline stage {} items {} busy {:.3f}s blocked {:.3f}s utilization {:.3f}'.format(
+                name, stage['items'], stage['busy_time'], stage['blocked_time'], stage['utilization']))
@@ -15,7 +15,7 @@ from torch import nn
 import torch.nn.functional as F
 from einops import repeat
 from x_transformers.x_transformers import RotaryEmbedding
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask
 from cosyvoice.flow.DiT.modules import (
     TimestepEmbedding,
     ConvNeXtV2Block,
@@ -97,6 +97,16 @@ class InputEmbedding(nn.Module):
         x = self.conv_pos_embed(x) + x
         return x
 
+    def forward_chunk(self, x, cond, text_embed, spks, cache, num_commit):
+        to_cat = [x, cond, text_embed]
+        if self.spk_dim > 0:
+            spks = repeat(spks, "b c -> b t c", t=x.shape[1])
+            to_cat.append(spks)
+
+        x = self.proj(torch.cat(to_cat, dim=-1))
+        pos, cache = self.conv_pos_embed.forward_chunk(x, cache, num_commit)
+        return pos + x, cache
+
 
 # Transformer backbone using DiT blocks
 
@@ -141,8 +151,23 @@ class DiT(nn.Module):
         self.out_channels = out_channels
         self.static_chunk_size = static_chunk_size
         self.num_decoding_left_chunks = num_decoding_left_chunks
-
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+        # rotary embedding of the longest sequence seen, shorter sequences slice it, see get_rope
+        self.rope_cache = None
+
+    def get_rope(self, seq_len):
+        """Rotary embedding of positions [0, seq_len), memoized as it only depends on the position."""
+        if self.training or torch.jit.is_tracing() or torch.onnx.is_in_onnx_export():
+            return self.rotary_embed.forward_from_seq_len(seq_len)
+        # NOTE cache is replaced as a whole, so concurrent requests at worst compute the table twice
+        rope_cache = self.rope_cache
+        if rope_cache is None or rope_cache[0].shape[-2] < seq_len or rope_cache[0].device != self.rotary_embed.inv_freq.device:
+            rope_cache = self.rope_cache = self.rotary_embed.forward_from_seq_len(seq_len)
+        freqs, xpos_scale = rope_cache
+        if isinstance(xpos_scale, torch.Tensor):
+            xpos_scale = xpos_scale[..., :seq_len, :]
+        return freqs[..., :seq_len, :], xpos_scale
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, attn_masks=None):
         x = x.transpose(1, 2)
         mu = mu.transpose(1, 2)
         cond = cond.transpose(1, 2)
@@ -155,18 +180,78 @@ class DiT(nn.Module):
         t = self.time_embed(t)
         x = self.input_embed(x, cond, mu, spks.squeeze(1))
 
-        rope = self.rotary_embed.forward_from_seq_len(seq_len)
+        rope = self.get_rope(seq_len)
 
         if self.long_skip_connection is not None:
             residual = x
 
-        if streaming is True:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+        # NOTE attn_masks is shared by the estimator calls of one flow matching solve, where mask and streaming are fixed
+        key = (batch, seq_len)
+        if attn_masks is not None and key in attn_masks:
+            attn_mask = attn_masks[key]
         else:
-            attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1).unsqueeze(dim=1)
+            if streaming is True:
+                attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1).unsqueeze(dim=1)
+            else:
+                attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1).unsqueeze(dim=1)
+            attn_mask = attn_mask.bool()
+            if attn_masks is not None:
+                attn_masks[key] = attn_mask
 
         for block in self.transformer_blocks:
-            x = block(x, t, mask=attn_mask.bool(), rope=rope)
+            x = block(x, t, mask=attn_mask, rope=rope)
+
+        if self.long_skip_connection is not None:
+            x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
+
+        x = self.norm_out(x, t)
+        output = self.proj_out(x).transpose(1, 2)
+        return output
+
+    def forward_chunk(self, x, mask, mu, t, spks, cond, cache: dict, offset: int, num_commit: int):
+        """Streaming forward of frames [offset, offset + seq_len), frames before offset are only visited through cache.
+
+        The result equals the frames [offset, offset + seq_len) of forward(streaming=True) over the whole sequence, as
+        static chunk attention never looks into later chunks and the position embedding convs are causal. Only the
+        queries of the new frames are computed, against the key/value of the finalized chunks kept in cache.
+
+        Args:
+            x, mu, spks, cond: same as forward, but only frames after offset
+            mask: same as forward, all frames are valid in streaming inference
+            cache (dict): position embedding conv inputs and attention key/value of frames before offset, empty dict
+                for the first chunk, updated in place
+            offset (int): number of frames in cache, must be a multiple of static_chunk_size
+            num_commit (int): number of leading frames of x which complete their chunks and are appended to cache
+
+        Returns:
+            output of shape (batch_size, mel_dim, seq_len)
+        """
+        assert offset % self.static_chunk_size == 0
+        if len(cache) == 0:
+            cache['conv'] = [torch.zeros(0, 0, 0)] * 2
+            cache['att'] = [torch.zeros(0, 0, 0, 0)] * len(self.transformer_blocks)
+        x = x.transpose(1, 2)
+        mu = mu.transpose(1, 2)
+        cond = cond.transpose(1, 2)
+        batch, seq_len = x.shape[0], x.shape[1]
+        if t.ndim == 0:
+            t = t.repeat(batch)
+
+        t = self.time_embed(t)
+        x, cache['conv'] = self.input_embed.forward_chunk(x, cond, mu, spks, cache['conv'], num_commit)
+
+        freqs, xpos_scale = self.get_rope(offset + seq_len)
+        if isinstance(xpos_scale, torch.Tensor):
+            xpos_scale = xpos_scale[..., offset:, :]
+        rope = (freqs[..., offset:, :], xpos_scale)
+
+        if self.long_skip_connection is not None:
+            residual = x
+
+        attn_mask = subsequent_chunk_mask(offset + seq_len, self.static_chunk_size, device=x.device)[offset:].unsqueeze(0).unsqueeze(0)
+
+        for i, block in enumerate(self.transformer_blocks):
+            x, cache['att'][i] = block.forward_chunk(x, t, attn_mask, rope, cache['att'][i], num_commit)
 
         if self.long_skip_connection is not None:
             x = self.long_skip_connection(torch.cat((x, residual), dim=-1))
@@ -143,6 +143,22 @@ class CausalConvPositionEmbedding(nn.Module):
 
         return out
 
+    def forward_chunk(self, x: float["b n d"], cache: list[torch.Tensor], num_commit: int):  # noqa: F722
+        """
+        cache: input frames of conv1 and conv2 before x, each (b, d, kernel_size - 1), empty cache means zero padding
+        num_commit: new cache is the input frames before x[:, num_commit]
+        """
+        x = x.permute(0, 2, 1)
+        new_cache = []
+        for conv, conv_cache in zip([self.conv1, self.conv2], cache):
+            if conv_cache.size(2) == 0:
+                x = F.pad(x, (self.kernel_size - 1, 0, 0, 0))
+            else:
+                x = torch.concat([conv_cache, x], dim=2)
+            new_cache.append(x[:, :, num_commit: num_commit + self.kernel_size - 1])
+            x = conv(x)
+        return x.permute(0, 2, 1), new_cache
+
 
 # rotary positional embedding related
 
@@ -406,6 +422,53 @@ class AttnProcessor:
 
         return x
 
+    def forward_chunk(
+        self,
+        attn: Attention,
+        x: float["b n d"],  # noqa: F722
+        mask: bool["b 1 n m"],  # noqa: F722
+        rope,
+        cache: torch.Tensor,
+        num_commit: int,
+    ):
+        """Attention of x against cached key/value of the frames before x.
+
+        mask is the chunk mask of x against cache + x, rope the rotary embedding of the positions of x. cache is
+        (b, heads, cache_len, head_dim * 2) with rope already applied to key, empty for the first chunk. Returns the
+        output and cache extended by the first num_commit frames of x.
+        """
+        batch_size = x.shape[0]
+
+        query = attn.to_q(x)
+        key = attn.to_k(x)
+        value = attn.to_v(x)
+
+        if rope is not None:
+            freqs, xpos_scale = rope
+            q_xpos_scale, k_xpos_scale = (xpos_scale, xpos_scale**-1.0) if xpos_scale is not None else (1.0, 1.0)
+
+            query = apply_rotary_pos_emb(query, freqs, q_xpos_scale)
+            key = apply_rotary_pos_emb(key, freqs, k_xpos_scale)
+
+        inner_dim = key.shape[-1]
+        head_dim = inner_dim // attn.heads
+        query = query.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        key = key.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+        value = value.view(batch_size, -1, attn.heads, head_dim).transpose(1, 2)
+
+        kv = torch.concat([key, value], dim=-1)
+        if cache.size(0) > 0:
+            kv = torch.concat([cache, kv], dim=2)
+        key, value = torch.split(kv, head_dim, dim=-1)
+
+        x = F.scaled_dot_product_attention(query, key, value, attn_mask=mask, dropout_p=0.0, is_causal=False)
+        x = x.transpose(1, 2).reshape(batch_size, -1, attn.heads * head_dim)
+        x = x.to(query.dtype)
+
+        x = attn.to_out[0](x)
+        x = attn.to_out[1](x)
+        return x, kv[:, :, :kv.size(2) - query.size(2) + num_commit]
+
 
 # Joint Attention processor for MM-DiT
 # modified from diffusers/src/diffusers/models/attention_processor.py
@@ -529,6 +592,19 @@ class DiTBlock(nn.Module):
 
         return x
 
+    def forward_chunk(self, x, t, mask, rope, cache, num_commit):
+        norm, gate_msa, shift_mlp, scale_mlp, gate_mlp = self.attn_norm(x, emb=t)
+
+        attn_output, cache = self.attn.processor.forward_chunk(self.attn, norm, mask, rope, cache, num_commit)
+
+        x = x + gate_msa.unsqueeze(1) * attn_output
+
+        ff_norm = self.ff_norm(x) * (1 + scale_mlp[:, None]) + shift_mlp[:, None]
+        ff_output = self.ff(ff_norm)
+        x = x + gate_mlp.unsqueeze(1) * ff_output
+
+        return x, cache
+
 
 # MMDiT Block https://arxiv.org/abs/2403.03206
 
@@ -11,13 +11,13 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
-from typing import Tuple
+from typing import Dict, List, Tuple
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from einops import pack, rearrange, repeat
 from cosyvoice.utils.common import mask_to_bias
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask
 from matcha.models.components.decoder import SinusoidalPosEmb, Block1D, ResnetBlock1D, Downsample1D, TimestepEmbedding, Upsample1D
 from matcha.models.components.transformer import BasicTransformerBlock
 
@@ -61,6 +61,17 @@ class CausalConv1d(torch.nn.Conv1d):
         x = super(CausalConv1d, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor, num_commit: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        cache: (batch_size, in_channels, causal_padding) input frames before x, empty cache means zero padding
+        num_commit: new cache is the input frames before x[:, :, num_commit]
+        """
+        if cache.size(2) == 0:
+            x = F.pad(x, (self.causal_padding, 0), value=0.0)
+        else:
+            x = torch.concat([cache, x], dim=2)
+        return super(CausalConv1d, self).forward(x), x[:, :, num_commit: num_commit + self.causal_padding]
+
 
 class CausalBlock1D(Block1D):
     def __init__(self, dim: int, dim_out: int):
@@ -77,6 +88,11 @@ class CausalBlock1D(Block1D):
         output = self.block(x * mask)
         return output * mask
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, cache: torch.Tensor, num_commit: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        output, cache = self.block[0].forward_chunk(x * mask, cache, num_commit)
+        output = self.block[1:](output)
+        return output * mask, cache
+
 
 class CausalResnetBlock1D(ResnetBlock1D):
     def __init__(self, dim: int, dim_out: int, time_emb_dim: int, groups: int = 8):
@@ -84,6 +100,14 @@ class CausalResnetBlock1D(ResnetBlock1D):
         self.block1 = CausalBlock1D(dim, dim_out)
         self.block2 = CausalBlock1D(dim_out, dim_out)
 
+    def forward_chunk(self, x: torch.Tensor, mask: torch.Tensor, time_emb: torch.Tensor, cache: List[torch.Tensor],
+                      num_commit: int) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        h, cache1 = self.block1.forward_chunk(x, mask, cache[0], num_commit)
+        h += self.mlp(time_emb).unsqueeze(-1)
+        h, cache2 = self.block2.forward_chunk(h, mask, cache[1], num_commit)
+        output = h + self.res_conv(x * mask)
+        return output, [cache1, cache2]
+
 
 class ConditionalDecoder(nn.Module):
     def __init__(
@@ -207,7 +231,23 @@ class ConditionalDecoder(nn.Module):
                 if m.bias is not None:
                     nn.init.constant_(m.bias, 0)
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def get_attn_mask(self, x, mask, streaming, attn_masks):
+        """Attention bias of the transformer blocks.
+
+        It only depends on mask, streaming and dtype, not on the ode timestep. attn_masks holds the biases of one
+        flow matching solve, where mask and streaming are fixed, so it is keyed by shape and dtype only and every
+        resolution builds its bias once for all blocks and estimator calls, without comparing mask contents.
+        """
+        key = (x.shape[:2], x.dtype)
+        if key not in attn_masks:
+            if streaming is True:
+                attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, self.static_chunk_size, -1)
+            else:
+                attn_mask = add_optional_chunk_mask(x, mask.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
+            attn_masks[key] = mask_to_bias(attn_mask, x.dtype)
+        return attn_masks[key]
+
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, attn_masks=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -216,6 +256,7 @@ class ConditionalDecoder(nn.Module):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            attn_masks (dict, optional): attention biases shared by the estimator calls of one solve, see get_attn_mask.
 
         Raises:
             ValueError: _description_
@@ -236,14 +277,15 @@ class ConditionalDecoder(nn.Module):
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
+        if attn_masks is None:
+            attn_masks = {}
         hiddens = []
         masks = [mask]
         for resnet, transformer_blocks, downsample in self.down_blocks:
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_mask(x, mask_down, False, attn_masks)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -260,8 +302,7 @@ class ConditionalDecoder(nn.Module):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_mask(x, mask_mid, False, attn_masks)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -276,8 +317,7 @@ class ConditionalDecoder(nn.Module):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_mask(x, mask_up, False, attn_masks)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -402,7 +442,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
         self.final_proj = nn.Conv1d(channels[-1], self.out_channels, 1)
         self.initialize_weights()
 
-    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False):
+    def forward(self, x, mask, mu, t, spks=None, cond=None, streaming=False, attn_masks=None):
         """Forward pass of the UNet1DConditional model.
 
         Args:
@@ -411,6 +451,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             t (_type_): shape (batch_size)
             spks (_type_, optional): shape: (batch_size, condition_channels). Defaults to None.
             cond (_type_, optional): placeholder for future use. Defaults to None.
+            attn_masks (dict, optional): attention biases shared by the estimator calls of one solve, see get_attn_mask.
 
         Raises:
             ValueError: _description_
@@ -430,17 +471,15 @@ class CausalConditionalDecoder(ConditionalDecoder):
         if cond is not None:
             x = pack([x, cond], "b * t")[0]
 
+        if attn_masks is None:
+            attn_masks = {}
         hiddens = []
         masks = [mask]
         for resnet, transformer_blocks, downsample in self.down_blocks:
             mask_down = masks[-1]
             x = resnet(x, mask_down, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_down.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_mask(x, mask_down, streaming, attn_masks)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -457,11 +496,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
         for resnet, transformer_blocks in self.mid_blocks:
             x = resnet(x, mask_mid, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_mid.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_mask(x, mask_mid, streaming, attn_masks)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -476,11 +511,7 @@ class CausalConditionalDecoder(ConditionalDecoder):
             x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
             x = resnet(x, mask_up, t)
             x = rearrange(x, "b c t -> b t c").contiguous()
-            if streaming is True:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, self.static_chunk_size, -1)
-            else:
-                attn_mask = add_optional_chunk_mask(x, mask_up.bool(), False, False, 0, 0, -1).repeat(1, x.size(1), 1)
-            attn_mask = mask_to_bias(attn_mask, x.dtype)
+            attn_mask = self.get_attn_mask(x, mask_up, streaming, attn_masks)
             for transformer_block in transformer_blocks:
                 x = transformer_block(
                     hidden_states=x,
@@ -492,3 +523,108 @@ class CausalConditionalDecoder(ConditionalDecoder):
         x = self.final_block(x, mask_up)
         output = self.final_proj(x * mask_up)
         return output * mask
+
+    def forward_transformer_chunk(self, transformer_block, x, attn_mask, cache, num_commit):
+        """BasicTransformerBlock forward with attention key/value cache.
+
+        Args:
+            x (torch.Tensor): shape (batch_size, time, channels)
+            attn_mask (torch.Tensor): attention bias, shape (1, 1, time, cache_time + time)
+            cache (torch.Tensor): shape (batch_size, num_heads, cache_time, head_dim * 2), empty for the first chunk
+            num_commit (int): number of leading frames of x appended to cache
+
+        Returns:
+            output of shape (batch_size, time, channels) and new cache
+        """
+        attn = transformer_block.attn1
+        norm_x = transformer_block.norm1(x)
+        q, k, v = attn.to_q(norm_x), attn.to_k(norm_x), attn.to_v(norm_x)
+        q, k, v = [rearrange(i, "b t (h d) -> b h t d", h=attn.heads) for i in [q, k, v]]
+        kv = torch.concat([k, v], dim=-1)
+        if cache.size(0) > 0:
+            kv = torch.concat([cache, kv], dim=2)
+        k, v = torch.split(kv, kv.size(-1) // 2, dim=-1)
+        output = F.scaled_dot_product_attention(q, k, v, attn_mask=attn_mask)
+        output = rearrange(output, "b h t d -> b t (h d)")
+        output = attn.to_out[1](attn.to_out[0](output))
+        x = x + output
+        x = x + transformer_block.ff(transformer_block.norm3(x))
+        return x, kv[:, :, :kv.size(2) - q.size(2) + num_commit]
+
+    def forward_chunk(self, x, mask, mu, t, spks, cond, cache: Dict, offset: int, num_commit: int):
+        """Streaming forward of frames [offset, offset + time), frames before offset are only visited through cache.
+
+        The result equals the frames [offset, offset + time) of forward(streaming=True) over the whole sequence, as
+        static chunk attention never looks into later chunks and all convs are causal.
+
+        Args:
+            x, mask, mu, spks, cond: same as forward, but only frames after offset
+            cache (Dict): causal conv input frames and attention key/value of frames before offset, empty dict for
+                the first chunk, updated in place
+            offset (int): number of frames in cache, must be a multiple of static_chunk_size
+            num_commit (int): number of leading frames of x which complete their chunks and are appended to cache
+
+        Returns:
+            output of shape (batch_size, out_channels, time)
+        """
+        assert offset % self.static_chunk_size == 0
+        if len(cache) == 0:
+            cache['conv'] = [torch.zeros(0, 0, 0)] * sum(isinstance(m, CausalConv1d) for m in self.modules())
+            cache['att'] = [torch.zeros(0, 0, 0, 0)] * sum(len(m[1]) for m in [*self.down_blocks, *self.mid_blocks, *self.up_blocks])
+        conv_cache, att_cache = cache['conv'], cache['att']
+        i, j = 0, 0
+
+        t = self.time_embeddings(t).to(t.dtype)
+        t = self.time_mlp(t)
+
+        x = pack([x, mu], "b * t")[0]
+
+        if spks is not None:
+            spks = repeat(spks, "b c -> b c t", t=x.shape[-1])
+            x = pack([x, spks], "b * t")[0]
+        if cond is not None:
+            x = pack([x, cond], "b * t")[0]
+
+        # all blocks keep time resolution, so one chunk mask for every attention
+        attn_mask = subsequent_chunk_mask(offset + x.size(2), self.static_chunk_size, device=x.device)[offset:]
+        attn_mask = mask_to_bias(attn_mask, x.dtype).unsqueeze(0).unsqueeze(0)
+
+        hiddens = []
+        for resnet, transformer_blocks, downsample in self.down_blocks:
+            assert isinstance(downsample, CausalConv1d), 'forward_chunk does not support Downsample1D'
+            x, conv_cache[i: i + 2] = resnet.forward_chunk(x, mask, t, conv_cache[i: i + 2], num_commit)
+            i += 2
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, att_cache[j] = self.forward_transformer_chunk(transformer_block, x, attn_mask, att_cache[j], num_commit)
+                j += 1
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            hiddens.append(x)  # Save hidden states for skip connections
+            x, conv_cache[i] = downsample.forward_chunk(x * mask, conv_cache[i], num_commit)
+            i += 1
+
+        for resnet, transformer_blocks in self.mid_blocks:
+            x, conv_cache[i: i + 2] = resnet.forward_chunk(x, mask, t, conv_cache[i: i + 2], num_commit)
+            i += 2
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, att_cache[j] = self.forward_transformer_chunk(transformer_block, x, attn_mask, att_cache[j], num_commit)
+                j += 1
+            x = rearrange(x, "b t c -> b c t").contiguous()
+
+        for resnet, transformer_blocks, upsample in self.up_blocks:
+            assert isinstance(upsample, CausalConv1d), 'forward_chunk does not support Upsample1D'
+            skip = hiddens.pop()
+            x = pack([x[:, :, :skip.shape[-1]], skip], "b * t")[0]
+            x, conv_cache[i: i + 2] = resnet.forward_chunk(x, mask, t, conv_cache[i: i + 2], num_commit)
+            i += 2
+            x = rearrange(x, "b c t -> b t c").contiguous()
+            for transformer_block in transformer_blocks:
+                x, att_cache[j] = self.forward_transformer_chunk(transformer_block, x, attn_mask, att_cache[j], num_commit)
+                j += 1
+            x = rearrange(x, "b t c -> b c t").contiguous()
+            x, conv_cache[i] = upsample.forward_chunk(x * mask, conv_cache[i], num_commit)
+            i += 1
+        x, conv_cache[i] = self.final_block.forward_chunk(x, mask, conv_cache[i], num_commit)
+        output = self.final_proj(x * mask)
+        return output * mask
@@ -98,6 +98,29 @@ class MaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    @torch.inference_mode()
+    def get_spk_cond(self, embedding, prompt_feat):
+        """Speaker projection and prompt mel condition, they are fixed for a voice so callers may cache them."""
+        embedding = F.normalize(embedding, dim=1)
+        embedding = self.spk_embed_affine_layer(embedding)
+        return {'spks': embedding, 'prompt_cond': prompt_feat.transpose(1, 2).contiguous()}
+
+    @torch.inference_mode()
+    def encode_prompt(self, prompt_token, spk_cond):
+        """Encode prompt tokens alone once and keep their encoder output and attention key/value in spk_cond.
+
+        NOTE the encoder is full context, with the cached prompt the prompt tokens no longer attend to the following
+        tokens, so the output is an approximation of full recompute. In exchange each streaming hop only encodes its
+        own tokens, see cosyvoice/bin/benchmark_stream_v1.py for latency and mel difference. It is opt-in for such
+        measurements and not exposed by the serving api. Encoders with conv modules are never cached, forward_chunk
+        is called without cnn_cache.
+        """
+        if 'prompt_att_cache' not in spk_cond:
+            token = self.input_embedding(torch.clamp(prompt_token, min=0))
+            h, att_cache, _ = self.encoder.forward_chunk(token, 0, -1)
+            spk_cond['prompt_h'], spk_cond['prompt_att_cache'] = self.encoder_proj(h), att_cache
+        return spk_cond
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -107,28 +130,41 @@ class MaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat,
                   prompt_feat_len,
                   embedding,
-                  flow_cache):
+                  flow_cache,
+                  n_timesteps=10,
+                  solver=None,
+                  spk_cond=None,
+                  cfg_skip_steps=0,
+                  prompt_cache=False):
         assert token.shape[0] == 1
         # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if spk_cond is None:
+            spk_cond = self.get_spk_cond(embedding, prompt_feat)
+        embedding = spk_cond['spks']
 
         # concat speech token and prompt speech token
         token_len1, token_len2 = prompt_token.shape[1], token.shape[1]
-        token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
-        mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
-        token = self.input_embedding(torch.clamp(token, min=0)) * mask
-
-        # text encode
-        h, h_lengths = self.encoder(token, token_len)
-        h = self.encoder_proj(h)
         mel_len1, mel_len2 = prompt_feat.shape[1], int(token_len2 / self.input_frame_rate * 22050 / 256)
-        h, h_lengths = self.length_regulator.inference(h[:, :token_len1], h[:, token_len1:], mel_len1, mel_len2, self.input_frame_rate)
+        if prompt_cache is True and token_len1 != 0 and hasattr(self.encoder, 'forward_chunk') and \
+                all(getattr(layer, 'conv_module', None) is None for layer in self.encoder.encoders):
+            # text encode, only tokens after the cached prompt
+            spk_cond = self.encode_prompt(prompt_token, spk_cond)
+            token = self.input_embedding(torch.clamp(token, min=0))
+            h2, _, _ = self.encoder.forward_chunk(token, token_len1, 0, att_cache=spk_cond['prompt_att_cache'])
+            h1, h2 = spk_cond['prompt_h'], self.encoder_proj(h2)
+        else:
+            token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
+            mask = (~make_pad_mask(token_len)).unsqueeze(-1).to(embedding)
+            token = self.input_embedding(torch.clamp(token, min=0)) * mask
+
+            # text encode
+            h, h_lengths = self.encoder(token, token_len)
+            h = self.encoder_proj(h)
+            h1, h2 = h[:, :token_len1], h[:, token_len1:]
+        h, h_lengths = self.length_regulator.inference(h1, h2, mel_len1, mel_len2, self.input_frame_rate)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = F.pad(spk_cond['prompt_cond'], (0, mel_len2)).to(h.dtype)
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
         feat, flow_cache = self.decoder(
@@ -136,9 +172,11 @@ class MaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
+            n_timesteps=n_timesteps,
             prompt_len=mel_len1,
-            cache=flow_cache
+            cache=flow_cache,
+            solver=solver,
+            cfg_skip_steps=cfg_skip_steps
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
@@ -226,6 +264,8 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         )
         return {'loss': loss}
 
+    get_spk_cond = MaskedDiffWithXvec.get_spk_cond
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -236,11 +276,19 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  cache=None,
+                  n_timesteps=10,
+                  solver=None,
+                  spk_cond=None,
+                  cfg_skip_steps=0):
         assert token.shape[0] == 1
         # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if spk_cond is None:
+            spk_cond = self.get_spk_cond(embedding, prompt_feat)
+        if cache is not None:
+            return self.inference_chunk(token, prompt_token, spk_cond, finalize, cache, n_timesteps=n_timesteps, solver=solver, cfg_skip_steps=cfg_skip_steps)
+        embedding = spk_cond['spks']
 
         # concat text and prompt_text
         token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
@@ -257,9 +305,7 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
         h = self.encoder_proj(h)
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = F.pad(spk_cond['prompt_cond'], (0, mel_len2)).to(h.dtype)
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
         feat, _ = self.decoder(
@@ -267,13 +313,69 @@ class CausalMaskedDiffWithXvec(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_skip_steps=cfg_skip_steps
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
 
+    def init_cache(self):
+        # NOTE incremental inference needs python encoder and estimator, jit/trt models recompute the whole prefix
+        if not hasattr(self.encoder, 'forward_chunk') or not hasattr(self.decoder.estimator, 'forward_chunk'):
+            return None
+        return {'offset': 0, 'mel': torch.zeros(1, self.output_size, 0), 'encoder': {}, 'estimator': []}
+
+    @torch.inference_mode()
+    def inference_chunk(self, token, prompt_token, spk_cond, finalize, cache, n_timesteps=10, solver=None, cfg_skip_steps=0):
+        """Streaming inference which only encodes and decodes tokens after the finalized chunks.
+
+        token is the whole token prefix as in inference, cache keeps encoder/estimator conv states and attention
+        key/value of the finalized chunks together with their mel, so the result equals inference(streaming=True)
+        while the work of each call is proportional to the new tokens instead of the whole prefix.
+        spk_cond is the output of get_spk_cond.
+        """
+        # only embed tokens after the finalized chunks
+        offset = cache['offset']
+        token = torch.concat([prompt_token, token], dim=1)
+        token_len = token.shape[1] if finalize is True else token.shape[1] - self.pre_lookahead_len
+        assert token_len >= offset
+        token, context = token[:, offset:token_len], token[:, token_len:]
+        token, context = self.input_embedding(torch.clamp(token, min=0)), self.input_embedding(torch.clamp(context, min=0))
+        # a chunk is finalized once all its tokens are available, the rest is recomputed by the next call
+        chunk_size = self.encoder.static_chunk_size
+        num_commit = token_len // chunk_size * chunk_size - offset
+
+        # text encode
+        h = self.encoder.forward_chunk(token, context, cache['encoder'], offset, num_commit)
+        h = self.encoder_proj(h)
+        mel_offset, mel_len1, mel_len2 = offset * self.token_mel_ratio, spk_cond['prompt_cond'].shape[2], h.shape[1]
+
+        # get conditions
+        conds = spk_cond['prompt_cond'][:, :, mel_offset:mel_offset + mel_len2]
+        conds = F.pad(conds, (0, mel_len2 - conds.shape[2])).to(h.dtype)
+
+        mask = torch.ones([1, 1, mel_len2], device=token.device).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=spk_cond['spks'],
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=True,
+            solver=solver,
+            cfg_skip_steps=cfg_skip_steps,
+            cache=cache['estimator'],
+            offset=mel_offset,
+            num_commit=num_commit * self.token_mel_ratio
+        )
+        feat = torch.concat([cache['mel'].to(feat), feat], dim=2)
+        cache['offset'] += num_commit
+        cache['mel'] = feat[:, :, :cache['offset'] * self.token_mel_ratio]
+        return feat[:, :, mel_len1:].float(), cache
+
 
 class CausalMaskedDiffWithDiT(torch.nn.Module):
     def __init__(self,
@@ -355,6 +457,8 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
         )
         return {'loss': loss}
 
+    get_spk_cond = MaskedDiffWithXvec.get_spk_cond
+
     @torch.inference_mode()
     def inference(self,
                   token,
@@ -365,11 +469,19 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
                   prompt_feat_len,
                   embedding,
                   streaming,
-                  finalize):
+                  finalize,
+                  cache=None,
+                  n_timesteps=10,
+                  solver=None,
+                  spk_cond=None,
+                  cfg_skip_steps=0):
         assert token.shape[0] == 1
         # xvec projection
-        embedding = F.normalize(embedding, dim=1)
-        embedding = self.spk_embed_affine_layer(embedding)
+        if spk_cond is None:
+            spk_cond = self.get_spk_cond(embedding, prompt_feat)
+        if cache is not None:
+            return self.inference_chunk(token, prompt_token, spk_cond, finalize, cache, n_timesteps=n_timesteps, solver=solver, cfg_skip_steps=cfg_skip_steps)
+        embedding = spk_cond['spks']
 
         # concat text and prompt_text
         token, token_len = torch.concat([prompt_token, token], dim=1), prompt_token_len + token_len
@@ -385,9 +497,7 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
         mel_len1, mel_len2 = prompt_feat.shape[1], h.shape[1] - prompt_feat.shape[1]
 
         # get conditions
-        conds = torch.zeros([1, mel_len1 + mel_len2, self.output_size], device=token.device).to(h.dtype)
-        conds[:, :mel_len1] = prompt_feat
-        conds = conds.transpose(1, 2)
+        conds = F.pad(spk_cond['prompt_cond'], (0, mel_len2)).to(h.dtype)
 
         mask = (~make_pad_mask(torch.tensor([mel_len1 + mel_len2]))).to(h)
         feat, _ = self.decoder(
@@ -395,13 +505,68 @@ class CausalMaskedDiffWithDiT(torch.nn.Module):
             mask=mask.unsqueeze(1),
             spks=embedding,
             cond=conds,
-            n_timesteps=10,
-            streaming=streaming
+            n_timesteps=n_timesteps,
+            streaming=streaming,
+            solver=solver,
+            cfg_skip_steps=cfg_skip_steps
         )
         feat = feat[:, :, mel_len1:]
         assert feat.shape[2] == mel_len2
         return feat.float(), None
 
+    def init_cache(self):
+        # NOTE incremental inference needs python estimator, trt models recompute the whole prefix
+        if not hasattr(self.decoder.estimator, 'forward_chunk'):
+            return None
+        return {'offset': 0, 'mel': torch.zeros(1, self.output_size, 0), 'pre_lookahead': torch.zeros(0, 0, 0), 'estimator': []}
+
+    @torch.inference_mode()
+    def inference_chunk(self, token, prompt_token, spk_cond, finalize, cache, n_timesteps=10, solver=None, cfg_skip_steps=0):
+        """Streaming inference which only runs pre lookahead layer and DiT over tokens after the finalized chunks.
+
+        Same as CausalMaskedDiffWithXvec.inference_chunk, cache keeps pre lookahead conv state, DiT position
+        embedding conv state and attention key/value of every ode step for the finalized chunks together with their
+        mel, so the result equals inference(streaming=True).
+        """
+        # only embed tokens after the finalized chunks
+        offset = cache['offset']
+        token = torch.concat([prompt_token, token], dim=1)
+        token_len = token.shape[1] if finalize is True else token.shape[1] - self.pre_lookahead_len
+        assert token_len >= offset
+        token, context = token[:, offset:token_len], token[:, token_len:]
+        token, context = self.input_embedding(torch.clamp(token, min=0)), self.input_embedding(torch.clamp(context, min=0))
+        # a chunk is finalized once all its tokens are available, the rest is recomputed by the next call
+        chunk_size = self.decoder.estimator.static_chunk_size // self.token_mel_ratio
+        num_commit = token_len // chunk_size * chunk_size - offset
+
+        # text encode
+        h, cache['pre_lookahead'] = self.pre_lookahead_layer.forward_chunk(token, context, cache['pre_lookahead'], num_commit)
+        h = h.repeat_interleave(self.token_mel_ratio, dim=1)
+        mel_offset, mel_len1, mel_len2 = offset * self.token_mel_ratio, spk_cond['prompt_cond'].shape[2], h.shape[1]
+
+        # get conditions
+        conds = spk_cond['prompt_cond'][:, :, mel_offset:mel_offset + mel_len2]
+        conds = F.pad(conds, (0, mel_len2 - conds.shape[2])).to(h.dtype)
+
+        mask = torch.ones([1, 1, mel_len2], device=token.device).to(h)
+        feat, _ = self.decoder(
+            mu=h.transpose(1, 2).contiguous(),
+            mask=mask,
+            spks=spk_cond['spks'],
+            cond=conds,
+            n_timesteps=n_timesteps,
+            streaming=True,
+            solver=solver,
+            cfg_skip_steps=cfg_skip_steps,
+            cache=cache['estimator'],
+            offset=mel_offset,
+            num_commit=num_commit * self.token_mel_ratio
+        )
+        feat = torch.concat([cache['mel'].to(feat), feat], dim=2)
+        cache['offset'] += num_commit
+        cache['mel'] = feat[:, :, :cache['offset'] * self.token_mel_ratio]
+        return feat[:, :, mel_len1:].float(), cache
+
 
 if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
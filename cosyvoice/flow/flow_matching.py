@@ -12,11 +12,20 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+import math
 import torch
 import torch.nn.functional as F
 from matcha.models.components.flow_matching import BASECFM
 from cosyvoice.utils.common import set_all_random_seed
 
+# fixed step ode solvers and their estimator calls per step
+ODE_SOLVERS = {'euler': 1, 'midpoint': 2, 'heun': 2, 'rk4': 4, 'dpm_solver': 1}
+
+
+def cfg_input_shapes(size):
+    # x, mask, mu, t, spks, cond of the cfg batch
+    return [[2, 80, size], [2, 1, size], [2, 80, size], [2], [2, 80], [2, 80, size]]
+
 
 class ConditionalCFM(BASECFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
@@ -32,9 +41,11 @@ class ConditionalCFM(BASECFM):
         in_channels = in_channels + (spk_emb_dim if n_spks > 0 else 0)
         # Just change the architecture of the estimator here
         self.estimator = estimator
+        # (device, dtype) -> free cfg input buffers on cpu, see acquire_buffers
+        self.buffer_pool = {}
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2)):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, prompt_len=0, cache=torch.zeros(1, 80, 0, 2), solver=None, cfg_skip_steps=0):
         """Forward diffusion
 
         Args:
@@ -47,6 +58,8 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver, see ODE_SOLVERS. Defaults to cfm_params.solver.
+            cfg_skip_steps (int, optional): number of last ode steps without classifier free guidance. Defaults to 0.
 
         Returns:
             sample: generated mel-spectrogram
@@ -66,11 +79,11 @@ class ConditionalCFM(BASECFM):
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond), cache
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, solver=solver or self.solver, cfg_skip_steps=cfg_skip_steps), cache
 
-    def solve_euler(self, x, t_span, mu, mask, spks, cond, streaming=False):
+    def solve(self, x, t_span, mu, mask, spks, cond, streaming=False, solver='euler', cache=None, offset=0, num_commit=0, cfg_skip_steps=0):
         """
-        Fixed euler solver for ODEs.
+        Fixed step solver for ODEs.
         Args:
             x (torch.Tensor): random noise
             t_span (torch.Tensor): n_timesteps interpolated
@@ -82,51 +95,127 @@ class ConditionalCFM(BASECFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str): one of ODE_SOLVERS
+                euler: first order
+                midpoint/heun: second order, two estimator calls per step
+                rk4: fourth order, four estimator calls per step
+                dpm_solver: second order multistep (Adams-Bashforth on the velocity, like DPM-Solver-2M for
+                    flow matching), one estimator call per step by reusing the previous velocity
+            cache (list, optional): estimator chunk cache of each estimator call, see CausalConditionalDecoder.forward_chunk
+            cfg_skip_steps (int): the last cfg_skip_steps steps only run the conditional branch, which halves their
+                estimator work, the velocity field is nearly converged there so guidance matters less. Set it to
+                n_timesteps for a cfg distilled estimator
         """
-        t, _, dt = t_span[0], t_span[-1], t_span[1] - t_span[0]
-        t = t.unsqueeze(dim=0)
-
-        # I am storing this because I can later plot it by putting a debugger here and saving it to a file
-        # Or in future might add like a return_all_steps flag
-        sol = []
-
+        assert solver in ODE_SOLVERS, 'unknown ode solver {}, choose from {}'.format(solver, list(ODE_SOLVERS.keys()))
         # Do not use concat, it may cause memory format changed and trt infer with wrong results!
         # NOTE when flow run in amp mode, x.dtype is float32, which cause nan in trt fp16 inference, so set dtype=spks.dtype
-        x_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        mask_in = torch.zeros([2, 1, x.size(2)], device=x.device, dtype=spks.dtype)
-        mu_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
-        t_in = torch.zeros([2], device=x.device, dtype=spks.dtype)
-        spks_in = torch.zeros([2, 80], device=x.device, dtype=spks.dtype)
-        cond_in = torch.zeros([2, 80, x.size(2)], device=x.device, dtype=spks.dtype)
+        buffers, inputs = self.acquire_buffers(x.size(2), x.device, spks.dtype)
+        try:
+            return self.solve_steps(x, t_span, mu, mask, spks, cond, inputs, streaming, solver, cache, offset, num_commit, cfg_skip_steps)
+        finally:
+            self.release_buffers(buffers, x.device, spks.dtype)
+
+    def solve_steps(self, x, t_span, mu, mask, spks, cond, inputs, streaming, solver, cache, offset, num_commit, cfg_skip_steps):
+        nfe, last_dphi_dt, last_dt = 0, None, None
+        # mask and streaming are fixed during the solve, the estimator builds its attention biases once into attn_masks
+        attn_masks = {}
         for step in range(1, len(t_span)):
-            # Classifier-Free Guidance inference introduced in VoiceBox
-            x_in[:] = x
-            mask_in[:] = mask
-            mu_in[0] = mu
-            t_in[:] = t.unsqueeze(0)
-            spks_in[0] = spks
-            cond_in[0] = cond
-            dphi_dt = self.forward_estimator(
-                x_in, mask_in,
-                mu_in, t_in,
-                spks_in,
-                cond_in,
-                streaming
-            )
-            dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
-            dphi_dt = ((1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt)
-            x = x + dt * dphi_dt
-            t = t + dt
-            sol.append(x)
-            if step < len(t_span) - 1:
-                dt = t_span[step + 1] - t
-
-        return sol[-1].float()
-
-    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False):
+            t, dt = t_span[step - 1], t_span[step] - t_span[step - 1]
+            step_cache = [None] * ODE_SOLVERS[solver] if cache is None else cache[nfe: nfe + ODE_SOLVERS[solver]]
+            nfe += ODE_SOLVERS[solver]
+            cfg = step < len(t_span) - cfg_skip_steps
+
+            def velocity(x, t, i):
+                return self.forward_cfg(x, t, mu, mask, spks, cond, inputs, streaming, step_cache[i], offset, num_commit, cfg, attn_masks)
+
+            k1 = velocity(x, t, 0)
+            if solver == 'euler':
+                x = x + dt * k1
+            elif solver == 'midpoint':
+                k2 = velocity(x + 0.5 * dt * k1, t + 0.5 * dt, 1)
+                x = x + dt * k2
+            elif solver == 'heun':
+                k2 = velocity(x + dt * k1, t + dt, 1)
+                x = x + 0.5 * dt * (k1 + k2)
+            elif solver == 'rk4':
+                k2 = velocity(x + 0.5 * dt * k1, t + 0.5 * dt, 1)
+                k3 = velocity(x + 0.5 * dt * k2, t + 0.5 * dt, 2)
+                k4 = velocity(x + dt * k3, t + dt, 3)
+                x = x + dt / 6 * (k1 + 2 * k2 + 2 * k3 + k4)
+            elif solver == 'dpm_solver':
+                if last_dphi_dt is None:
+                    x = x + dt * k1
+                else:
+                    r = dt / (2 * last_dt)
+                    x = x + dt * ((1 + r) * k1 - r * last_dphi_dt)
+                last_dphi_dt, last_dt = k1, dt
+        return x.float()
+
+    def acquire_buffers(self, size, device, dtype):
+        """Estimator inputs of the cfg batch, [x, mask, mu, t, spks, cond] with batch 2.
+
+        On cpu their storage is taken from a per (device, dtype) pool and given back by release_buffers, so chunks and
+        requests reuse it instead of allocating six tensors per call, as cpu allocations are not cached. Each input is
+        a view on the head of its own flat storage, so it stays contiguous and aligned for trt. Concurrent requests take
+        different storages from the pool.
+        NOTE cuda buffers are never pooled, kernels queued on another stream may still use a released buffer, the
+        caching allocator already reuses memory with the right stream semantics.
+        """
+        try:
+            buffers = self.buffer_pool.get((device, dtype), []).pop() if device.type != 'cuda' else None
+        except IndexError:
+            buffers = None
+        if buffers is None or buffers[0].numel() < 2 * 80 * size:
+            # round up capacity so growing streaming chunks do not reallocate on every call
+            capacity = (size + 255) // 256 * 256
+            buffers = [torch.zeros(math.prod(i), device=device, dtype=dtype) for i in cfg_input_shapes(capacity)]
+        shapes = cfg_input_shapes(size)
+        inputs = [b[:math.prod(i)].view(i) for b, i in zip(buffers, shapes)]
+        # unconditional row of mu, spks and cond must be zero, others are fully written by forward_cfg
+        for i in inputs[2:]:
+            i[1].zero_()
+        return buffers, inputs
+
+    def release_buffers(self, buffers, device, dtype):
+        if device.type == 'cuda':
+            return
+        self.buffer_pool.setdefault((device, dtype), []).append(buffers)
+
+    def forward_cfg(self, x, t, mu, mask, spks, cond, inputs, streaming=False, cache=None, offset=0, num_commit=0, cfg=True, attn_masks=None):
+        # Classifier-Free Guidance inference introduced in VoiceBox
+        # NOTE without cfg only the conditional rows are run, trt engine is built with batch 2 so it still runs both
+        if cfg is False and isinstance(self.estimator, torch.nn.Module):
+            inputs = [i[:x.size(0)] for i in inputs]
+        x_in, mask_in, mu_in, t_in, spks_in, cond_in = inputs
+        x_in[:] = x
+        mask_in[:] = mask
+        mu_in[0] = mu
+        t_in[:] = t
+        spks_in[0] = spks
+        cond_in[0] = cond
+        dphi_dt = self.forward_estimator(
+            x_in, mask_in,
+            mu_in, t_in,
+            spks_in,
+            cond_in,
+            streaming,
+            cache=cache,
+            offset=offset,
+            num_commit=num_commit,
+            attn_masks=attn_masks
+        )
+        if cfg is False:
+            return dphi_dt[:x.size(0)]
+        dphi_dt, cfg_dphi_dt = torch.split(dphi_dt, [x.size(0), x.size(0)], dim=0)
+        return (1.0 + self.inference_cfg_rate) * dphi_dt - self.inference_cfg_rate * cfg_dphi_dt
+
+    def forward_estimator(self, x, mask, mu, t, spks, cond, streaming=False, cache=None, offset=0, num_commit=0, attn_masks=None):
         if isinstance(self.estimator, torch.nn.Module):
-            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming)
+            if cache is not None:
+                return self.estimator.forward_chunk(x, mask, mu, t, spks, cond, cache=cache, offset=offset, num_commit=num_commit)
+            return self.estimator(x, mask, mu, t, spks, cond, streaming=streaming, attn_masks=attn_masks)
         else:
+            assert cache is None, 'trt estimator does not support chunk cache'
             [estimator, stream], trt_engine = self.estimator.acquire_estimator()
             # NOTE need to synchronize when switching stream
             torch.cuda.current_stream().synchronize()
@@ -198,10 +287,12 @@ class CausalConditionalCFM(ConditionalCFM):
     def __init__(self, in_channels, cfm_params, n_spks=1, spk_emb_dim=64, estimator: torch.nn.Module = None):
         super().__init__(in_channels, cfm_params, n_spks, spk_emb_dim, estimator)
         set_all_random_seed(0)
-        self.rand_noise = torch.randn([1, 80, 50 * 300])
+        # fixed noise moves with the model, so forward only slices it on device
+        self.register_buffer('rand_noise', torch.randn([1, 80, 50 * 300]), persistent=False)
 
     @torch.inference_mode()
-    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False):
+    def forward(self, mu, mask, n_timesteps, temperature=1.0, spks=None, cond=None, streaming=False, solver=None, cache=None, offset=0, num_commit=0,
+                cfg_skip_steps=0):
         """Forward diffusion
 
         Args:
@@ -214,15 +305,24 @@ class CausalConditionalCFM(ConditionalCFM):
             spks (torch.Tensor, optional): speaker ids. Defaults to None.
                 shape: (batch_size, spk_emb_dim)
             cond: Not used but kept for future purposes
+            solver (str, optional): ode solver, see ODE_SOLVERS. Defaults to cfm_params.solver.
+            cache (list, optional): estimator chunk cache of each estimator call, only frames after offset are passed in mu
+            offset (int): number of frames in cache
+            num_commit (int): number of leading frames of mu appended to cache
+            cfg_skip_steps (int, optional): number of last ode steps without classifier free guidance. Defaults to 0.
 
         Returns:
             sample: generated mel-spectrogram
                 shape: (batch_size, n_feats, mel_timesteps)
         """
 
-        z = self.rand_noise[:, :, :mu.size(2)].to(mu.device).to(mu.dtype) * temperature
+        z = self.rand_noise[:, :, offset:offset + mu.size(2)].to(mu.device, mu.dtype) * temperature
         # fix prompt and overlap part mu and z
         t_span = torch.linspace(0, 1, n_timesteps + 1, device=mu.device, dtype=mu.dtype)
         if self.t_scheduler == 'cosine':
             t_span = 1 - torch.cos(t_span * 0.5 * torch.pi)
-        return self.solve_euler(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming), None
+        solver = solver or self.solver
+        if cache is not None and len(cache) < n_timesteps * ODE_SOLVERS[solver]:
+            cache.extend({} for _ in range(n_timesteps * ODE_SOLVERS[solver] - len(cache)))
+        return self.solve(z, t_span=t_span, mu=mu, mask=mask, spks=spks, cond=cond, streaming=streaming, solver=solver,
+                          cache=cache, offset=offset, num_commit=num_commit, cfg_skip_steps=cfg_skip_steps), cache
@@ -11,6 +11,7 @@
 # WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
 # See the License for the specific language governing permissions and
 # limitations under the License.
+from typing import List, Tuple
 import torch
 import torch.nn as nn
 try:
@@ -101,3 +102,18 @@ class CausalConvRNNF0Predictor(nn.Module):
             x = self.condnet[i](x)
         x = x.transpose(1, 2)
         return torch.abs(self.classifier(x).squeeze(-1))
+
+    def forward_chunk(self, x: torch.Tensor, cache: List[torch.Tensor], finalize: bool = False) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """
+        cache: input frames kept by each conv of condnet, empty list for the first chunk
+        finalize: zero pad the right context of condnet[0] for the last chunk
+        """
+        new_cache = []
+        for layer in self.condnet:
+            if isinstance(layer, CausalConv1d):
+                x, conv_cache = layer.forward_chunk(x, cache[len(new_cache)] if len(cache) != 0 else torch.zeros(0, 0, 0), finalize=finalize)
+                new_cache.append(conv_cache)
+            else:
+                x = layer(x)
+        x = x.transpose(1, 2)
+        return torch.abs(self.classifier(x).squeeze(-1)), new_cache
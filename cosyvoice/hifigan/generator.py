@@ -14,7 +14,8 @@
 
 """HIFI-GAN"""
 
-from typing import Dict, Optional, List
+from contextlib import nullcontext
+from typing import Dict, Optional, List, Tuple
 import numpy as np
 from scipy.signal import get_window
 import torch
@@ -23,15 +24,18 @@ import torch.nn.functional as F
 from torch.nn import Conv1d
 from torch.nn import ConvTranspose1d
 from torch.nn.utils import remove_weight_norm
+from torch.nn.utils import parametrize
+from torch.nn.utils.weight_norm import WeightNorm
 try:
     from torch.nn.utils.parametrizations import weight_norm
 except ImportError:
     from torch.nn.utils import weight_norm
-from torch.distributions.uniform import Uniform
 from cosyvoice.transformer.convolution import CausalConv1d, CausalConv1dDownSample, CausalConv1dUpsample
 from cosyvoice.transformer.activation import Snake
+from cosyvoice.hifigan.stft import ConvSTFT, ConvISTFT, polar
 from cosyvoice.utils.common import get_padding
 from cosyvoice.utils.common import init_weights
+from cosyvoice.utils.file_utils import logging
 
 
 """hifigan based generator implementation.
@@ -43,6 +47,41 @@ This code is modified from https://github.com/jik876/hifi-gan
 """
 
 
+def fold_weight_norm(module: nn.Module) -> int:
+    """Replace weight_norm of module and all its submodules by the normalized weight, return the number of folded layers.
+
+    Works for both torch.nn.utils.parametrizations.weight_norm and the legacy hook based weight_norm.
+    """
+    num_folded = 0
+    for m in list(module.modules()):
+        if parametrize.is_parametrized(m, 'weight'):
+            parametrize.remove_parametrizations(m, 'weight', leave_parametrized=True)
+            num_folded += 1
+        elif any(isinstance(hook, WeightNorm) for hook in m._forward_pre_hooks.values()):
+            remove_weight_norm(m)
+            num_folded += 1
+    return num_folded
+
+
+def weight_norm_dims(module: nn.Module) -> Dict[str, int]:
+    """Name -> weight_norm dim of module and all its submodules with weight_norm, see restore_weight_norm."""
+    dims = {}
+    for name, m in module.named_modules():
+        if parametrize.is_parametrized(m, 'weight'):
+            dims[name] = m.parametrizations.weight[0].dim
+        for hook in m._forward_pre_hooks.values():
+            if isinstance(hook, WeightNorm):
+                dims[name] = hook.dim
+    return dims
+
+
+def restore_weight_norm(module: nn.Module, dims: Dict[str, int], state_dict: Dict[str, torch.Tensor]):
+    """Undo fold_weight_norm, with dims from weight_norm_dims and state_dict of module, both taken before folding."""
+    for name, dim in dims.items():
+        weight_norm(module.get_submodule(name), dim=dim)
+    module.load_state_dict(state_dict)
+
+
 class ResBlock(torch.nn.Module):
     """Residual block module in HiFiGAN/BigVGAN."""
     def __init__(
@@ -116,10 +155,42 @@ class ResBlock(torch.nn.Module):
             x = xt + x
         return x
 
-    def remove_weight_norm(self):
+    def forward_chunk(self, x: torch.Tensor, cache: List[torch.Tensor]) -> Tuple[torch.Tensor, List[torch.Tensor]]:
+        """
+        cache: left context of convs1[0], convs2[0], convs1[1], ..., empty list for the first chunk
+        """
+        assert self.causal is True
+        new_cache = []
         for idx in range(len(self.convs1)):
-            remove_weight_norm(self.convs1[idx])
-            remove_weight_norm(self.convs2[idx])
+            xt = self.activations1[idx](x)
+            xt, conv_cache1 = self.convs1[idx].forward_chunk(xt, cache[2 * idx] if len(cache) != 0 else torch.zeros(0, 0, 0))
+            xt = self.activations2[idx](xt)
+            xt, conv_cache2 = self.convs2[idx].forward_chunk(xt, cache[2 * idx + 1] if len(cache) != 0 else torch.zeros(0, 0, 0))
+            x = xt + x
+            new_cache += [conv_cache1, conv_cache2]
+        return x, new_cache
+
+    def remove_weight_norm(self):
+        fold_weight_norm(self)
+
+
+def hash32(x: torch.Tensor) -> torch.Tensor:
+    """Integer hash (lowbias32) of the low 32 bits of int64 tensor x."""
+    x = x & 0xffffffff
+    x = ((x ^ (x >> 16)) * 0x7feb352d) & 0xffffffff
+    x = ((x ^ (x >> 15)) * 0x846ca68b) & 0xffffffff
+    return x ^ (x >> 16)
+
+
+def counter_rand(seed: int, offset: int, length: int, dim: int, device: torch.device) -> torch.Tensor:
+    """Uniform noise in [0, 1) of shape (1, length, dim) for samples offset ... offset + length - 1.
+
+    Every value is a hash of seed and its own sample index, so any slice is reproduced exactly without generating or
+    keeping the samples before it.
+    """
+    counter = torch.arange(offset * dim, (offset + length) * dim, dtype=torch.int64, device=device)
+    x = hash32(counter ^ hash32((counter >> 32) ^ seed))
+    return ((x >> 8).float() / 2 ** 24).view(1, length, dim)
 
 
 class SineGen(torch.nn.Module):
@@ -162,13 +233,14 @@ class SineGen(torch.nn.Module):
         output uv: tensor(batchsize=1, length, 1)
         """
         f0 = f0.transpose(1, 2)
-        F_mat = torch.zeros((f0.size(0), self.harmonic_num + 1, f0.size(-1))).to(f0.device)
-        for i in range(self.harmonic_num + 1):
-            F_mat[:, i: i + 1, :] = f0 * (i + 1) / self.sampling_rate
-
-        theta_mat = 2 * np.pi * (torch.cumsum(F_mat, dim=-1) % 1)
-        u_dist = Uniform(low=-np.pi, high=np.pi)
-        phase_vec = u_dist.sample(sample_shape=(f0.size(0), self.harmonic_num + 1, 1)).to(F_mat.device)
+        # all harmonics at once, (batchsize, 1, length) x (1, dim, 1)
+        harmonics = torch.arange(1, self.harmonic_num + 2, dtype=f0.dtype, device=f0.device).view(1, -1, 1)
+        F_mat = f0 * harmonics / self.sampling_rate
+
+        # NOTE phase is non negative, frac equals % 1 and is much cheaper
+        theta_mat = 2 * np.pi * torch.frac(torch.cumsum(F_mat, dim=-1))
+        # uniform initial phase in [-pi, pi), drawn on cpu like torch.distributions.Uniform
+        phase_vec = (-np.pi + torch.rand(f0.size(0), self.harmonic_num + 1, 1) * (2 * np.pi)).to(F_mat.device)
         phase_vec[:, 0, :] = 0
 
         # generate sine waveforms
@@ -223,7 +295,8 @@ class SineGen2(torch.nn.Module):
         if causal is True:
             self.rand_ini = torch.rand(1, 9)
             self.rand_ini[:, 0] = 0
-            self.sine_waves = torch.rand(1, 300 * 24000, 9)
+            # fixed noise of causal inference, indexed by sample so that chunked and full inference get the same noise
+            self.noise_seed = int(torch.randint(0, 2 ** 31, (1,)))
 
     def _f02uv(self, f0):
         # generate uv signal
@@ -236,7 +309,7 @@ class SineGen2(torch.nn.Module):
         """
         # convert to F0 in rad. The interger part n can be ignored
         # because 2 * np.pi * n doesn't affect phase
-        rad_values = (f0_values / self.sampling_rate) % 1
+        rad_values = torch.frac(f0_values / self.sampling_rate)
 
         # initial phase noise (no noise for fundamental component)
         if self.training is False and self.causal is True:
@@ -269,18 +342,12 @@ class SineGen2(torch.nn.Module):
 
             # get the instantanouse phase
             tmp_cumsum = torch.cumsum(rad_values, dim=1)
-            # different batch needs to be processed differently
-            for idx in range(f0_values.shape[0]):
-                temp_sum = tmp_cumsum[idx, u_loc[idx, :, 0], :]
-                temp_sum[1:, :] = temp_sum[1:, :] - temp_sum[0:-1, :]
-                # stores the accumulation of i.phase within
-                # each voiced segments
-                tmp_cumsum[idx, :, :] = 0
-                tmp_cumsum[idx, u_loc[idx, :, 0], :] = temp_sum
-
-            # rad_values - tmp_cumsum: remove the accumulation of i.phase
-            # within the previous voiced segment.
-            i_phase = torch.cumsum(rad_values - tmp_cumsum, dim=1)
+            # remove the accumulation of i.phase up to the last unvoiced step before each time step, all batch items
+            # at once: index of that step is a running max over time, -1 before the first one
+            time_index = torch.arange(u_loc.shape[1], device=u_loc.device).view(1, -1, 1)
+            last_loc = torch.cummax(torch.where(u_loc[:, :, :1], time_index, -1), dim=1)[0]
+            last_cumsum = torch.gather(tmp_cumsum, 1, last_loc.clamp(min=0).expand_as(tmp_cumsum))
+            i_phase = tmp_cumsum - last_cumsum * (last_loc >= 0)
 
             # get the sines
             sines = torch.cos(i_phase * 2 * np.pi)
@@ -294,7 +361,7 @@ class SineGen2(torch.nn.Module):
         output uv: tensor(batchsize=1, length, 1)
         """
         # fundamental component
-        fn = torch.multiply(f0, torch.FloatTensor([[range(1, self.harmonic_num + 2)]]).to(f0.device))
+        fn = f0 * torch.arange(1, self.harmonic_num + 2, dtype=f0.dtype, device=f0.device)
 
         # generate sine waveforms
         sine_waves = self._f02sine(fn) * self.sine_amp
@@ -307,7 +374,7 @@ class SineGen2(torch.nn.Module):
         # .       for voiced regions is self.noise_std
         noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
         if self.training is False and self.causal is True:
-            noise = noise_amp * self.sine_waves[:, :sine_waves.shape[1]].to(sine_waves.device)
+            noise = noise_amp * counter_rand(self.noise_seed, 0, sine_waves.shape[1], self.dim, sine_waves.device)
         else:
             noise = noise_amp * torch.randn_like(sine_waves)
 
@@ -316,6 +383,33 @@ class SineGen2(torch.nn.Module):
         sine_waves = sine_waves * uv + noise
         return sine_waves, uv, noise
 
+    def forward_chunk(self, f0: torch.Tensor, phase: torch.Tensor, offset: int) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor, torch.Tensor]:
+        """ sine_tensor, uv, noise, phase = forward_chunk(f0, phase, offset)
+        streaming forward of causal SineGen2, f0 is the upsampled f0 of new frames
+        phase: tensor(batchsize=1, 1, dim) accumulated phase of previous chunks in cycles, empty for the first chunk
+        offset: number of samples generated by previous chunks, selects the fixed noise of this chunk
+        """
+        assert self.causal is True and self.flag_for_pulse is False and self.training is False
+        fn = f0 * torch.arange(1, self.harmonic_num + 2, dtype=f0.dtype, device=f0.device)
+        rad_values = torch.frac(fn / self.sampling_rate)
+        if offset == 0:
+            rad_values[:, 0, :] = rad_values[:, 0, :] + self.rand_ini.to(rad_values.device)
+        rad_values = torch.nn.functional.interpolate(rad_values.transpose(1, 2),
+                                                     scale_factor=1 / self.upsample_scale,
+                                                     mode="linear").transpose(1, 2)
+        phase = torch.cumsum(rad_values, dim=1) + (phase if phase.size(2) != 0 else 0)
+        # NOTE whole cycles do not change the sines, carry the fraction only so phase stays precise in long streams
+        new_phase = torch.frac(phase[:, -1:])
+        phase = torch.nn.functional.interpolate(phase.transpose(1, 2) * 2 * np.pi * self.upsample_scale,
+                                                scale_factor=self.upsample_scale, mode="nearest").transpose(1, 2)
+        sine_waves = torch.sin(phase) * self.sine_amp
+
+        uv = self._f02uv(f0)
+        noise_amp = uv * self.noise_std + (1 - uv) * self.sine_amp / 3
+        noise = noise_amp * counter_rand(self.noise_seed, offset, sine_waves.shape[1], self.dim, sine_waves.device)
+        sine_waves = sine_waves * uv + noise
+        return sine_waves, uv, noise, new_phase
+
 
 class SourceModuleHnNSF(torch.nn.Module):
     """ SourceModule for hn-nsf
@@ -353,7 +447,7 @@ class SourceModuleHnNSF(torch.nn.Module):
         self.l_tanh = torch.nn.Tanh()
         self.causal = causal
         if causal is True:
-            self.uv = torch.rand(1, 300 * 24000, 1)
+            self.noise_seed = int(torch.randint(0, 2 ** 31, (1,)))
 
     def forward(self, x):
         """
@@ -369,11 +463,24 @@ class SourceModuleHnNSF(torch.nn.Module):
 
         # source for noise branch, in the same shape as uv
         if self.training is False and self.causal is True:
-            noise = self.uv[:, :uv.shape[1]] * self.sine_amp / 3
+            noise = counter_rand(self.noise_seed, 0, uv.shape[1], 1, uv.device) * self.sine_amp / 3
         else:
             noise = torch.randn_like(uv) * self.sine_amp / 3
         return sine_merge, noise, uv
 
+    def forward_chunk(self, x: torch.Tensor, cache: Dict) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        streaming forward of causal source module
+        cache: {'phase': sine phase, 'offset': number of generated samples}, updated in place
+        """
+        assert isinstance(self.l_sin_gen, SineGen2)
+        with torch.no_grad():
+            sine_wavs, uv, _, cache['phase'] = self.l_sin_gen.forward_chunk(x, cache['phase'], cache['offset'])
+        sine_merge = self.l_tanh(self.l_linear(sine_wavs))
+        noise = counter_rand(self.noise_seed, cache['offset'], uv.shape[1], 1, uv.device) * self.sine_amp / 3
+        cache['offset'] += uv.shape[1]
+        return sine_merge, noise, uv
+
 
 class HiFTGenerator(nn.Module):
     """
@@ -472,68 +579,194 @@ class HiFTGenerator(nn.Module):
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # torch or conv, see set_stft_backend
+        self.conv_stft = ConvSTFT(istft_params["n_fft"], istft_params["hop_len"], self.stft_window)
+        self.conv_istft = ConvISTFT(istft_params["n_fft"], istft_params["hop_len"], self.stft_window)
+        self.stft_backend = 'torch'
+        # fp32, bf16 or int8 conv stack, see set_precision
+        self.precision = 'fp32'
         self.f0_predictor = f0_predictor
 
     def remove_weight_norm(self):
         print('Removing weight norm...')
-        for l in self.ups:
-            remove_weight_norm(l)
-        for l in self.resblocks:
-            l.remove_weight_norm()
-        remove_weight_norm(self.conv_pre)
-        remove_weight_norm(self.conv_post)
-        self.m_source.remove_weight_norm()
-        for l in self.source_downs:
-            remove_weight_norm(l)
-        for l in self.source_resblocks:
-            l.remove_weight_norm()
+        fold_weight_norm(self)
+
+    @torch.inference_mode()
+    def optimize_for_inference(self, tolerance: float = 1e-4, num_frames: int = 100) -> float:
+        """Load time pass, fold weight_norm of all convs including f0_predictor so that forward no longer recomputes
+        normalized weights, and keep stft_window on the device of the model.
+
+        Output on random mel is checked against the unfolded model, if the max abs difference exceeds tolerance
+        weight_norm is restored. Return the measured difference.
+        """
+        device = next(self.parameters()).device
+        self.stft_window = self.stft_window.to(device)
+        mel = torch.randn(1, self.conv_pre.in_channels, num_frames, device=device)
+
+        def run():
+            # same source noise for both runs, and no tf32 so only the folding itself is measured
+            tf32_off = torch.backends.cudnn.flags(enabled=torch.backends.cudnn.enabled, benchmark=torch.backends.cudnn.benchmark,
+                                                  deterministic=torch.backends.cudnn.deterministic, allow_tf32=False) if device.type == 'cuda' else nullcontext()
+            with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []), tf32_off:
+                torch.manual_seed(0)
+                return self.inference(mel)[0]
+
+        ref = run()
+        dims, state_dict = weight_norm_dims(self), {k: v.clone() for k, v in self.state_dict().items()}
+        # NOTE fold outside inference mode, so that folded weights stay parameters
+        with torch.inference_mode(False):
+            num_folded = fold_weight_norm(self)
+        diff = (run() - ref).abs().max().item()
+        if diff > tolerance:
+            logging.warning('hift with folded weight_norm differs from original by {}, exceeds tolerance {}, keep weight_norm'.format(diff, tolerance))
+            with torch.inference_mode(False):
+                restore_weight_norm(self, dims, state_dict)
+            return diff
+        logging.info('hift optimize for inference, fold {} weight_norm, max abs difference {}'.format(num_folded, diff))
+        return diff
+
+    @torch.inference_mode()
+    def set_stft_backend(self, stft_backend: str = 'torch', tolerance: float = 1e-4, num_frames: int = 100) -> float:
+        """Run _stft/_istft with torch.stft/torch.istft, or with conv, the DFT basis as conv1d/conv_transpose1d.
+
+        conv is checked once against torch on random source and spectrum, if the max difference relative to the max
+        output exceeds tolerance it falls back to torch. Return the measured difference.
+        """
+        assert stft_backend in ['torch', 'conv']
+        self.stft_backend = 'torch'
+        if stft_backend == 'torch':
+            return 0.0
+        device = next(self.conv_pre.parameters()).device
+        s = torch.rand(1, num_frames * int(self.f0_upsamp.scale_factor), device=device) * 0.2 - 0.1
+        magnitude = torch.exp(torch.randn(1, self.istft_params['n_fft'] // 2 + 1, num_frames, device=device))
+        phase = torch.randn(1, self.istft_params['n_fft'] // 2 + 1, num_frames, device=device)
+        ref = [self._stft(s), self._istft(magnitude, phase)]
+        self.stft_backend = 'conv'
+        diff = max(((i - j).abs().max() / j.abs().max()).item() for i, j in zip([self._stft(s), self._istft(magnitude, phase)], ref))
+        if diff > tolerance:
+            logging.warning('conv stft differs from torch by {}, exceeds tolerance {}, keep torch stft'.format(diff, tolerance))
+            self.stft_backend = 'torch'
+        logging.info('hift stft backend {}, relative difference to torch {}'.format(self.stft_backend, diff))
+        return diff
+
+    @torch.inference_mode()
+    def set_precision(self, precision: str = 'fp32', calib_mels: Optional[List[torch.Tensor]] = None, tolerance: float = 1.0, num_frames: int = 200) -> float:
+        """Run the conv stack in fp32, in bf16 autocast, or as static int8 convs on cpu, see quantize_hift_int8.
+
+        f0_predictor, source, stft/istft, conv_pre and conv_post stay fp32 in every mode. calib_mels are real mels
+        (1, num_mels, T), they calibrate int8 activation ranges and are vocoded by fp32 and the new precision to
+        measure mel cepstral distance, random mel is used when none are given. If the distance exceeds tolerance dB,
+        or the device lacks bf16/int8 kernels, it falls back to fp32. Return the measured distance.
+        """
+        assert precision in ['fp32', 'bf16', 'int8']
+        from cosyvoice.utils.cpu_utils import is_bf16_supported, quantize_hift_int8, dequantize_hift_int8
+        from cosyvoice.utils.losses import mel_cepstral_distance
+        device = next(self.conv_pre.parameters()).device
+        dequantize_hift_int8(self)
+        self.precision = 'fp32'
+        if precision == 'fp32':
+            return 0.0
+        if hasattr(self, 'decode_onnx'):
+            logging.warning('hift decode runs on onnxruntime, keep fp32')
+            return 0.0
+        if precision == 'bf16' and not is_bf16_supported(device):
+            logging.warning('{} does not support bf16, keep hift in fp32'.format(device))
+            return 0.0
+        if precision == 'int8' and device.type != 'cpu':
+            logging.warning('int8 static quantization only supports cpu, keep hift in fp32')
+            return 0.0
+        if calib_mels is None or len(calib_mels) == 0:
+            calib_mels = [torch.randn(1, self.conv_pre.in_channels, num_frames, device=device)]
+        calib_mels = [i.to(device, torch.float32) for i in calib_mels]
+
+        def run():
+            # same source noise in every run, so only the precision of the conv stack differs
+            with torch.random.fork_rng(devices=[device] if device.type == 'cuda' else []):
+                torch.manual_seed(0)
+                return [self.inference(i)[0] for i in calib_mels]
+
+        ref = run()
+        if precision == 'int8':
+            num_quantized = quantize_hift_int8(self, calib_mels)
+            logging.info('hift int8 static quantization of {} convs, calibrated on {} mels'.format(num_quantized, len(calib_mels)))
+        self.precision = precision
+        diff = max(mel_cepstral_distance(i.float(), j, self.sampling_rate) for i, j in zip(run(), ref))
+        if diff > tolerance:
+            logging.warning('hift {} mel cepstral distance to fp32 {:.3f}dB, exceeds tolerance {}dB, keep fp32'.format(precision, diff, tolerance))
+            dequantize_hift_int8(self)
+            self.precision = 'fp32'
+        logging.info('hift precision {}, mel cepstral distance to fp32 {:.3f}dB'.format(self.precision, diff))
+        return diff
+
+    def _autocast(self, device: torch.device):
+        """Context of the conv stack between conv_pre and conv_post, bf16 autocast in bf16 precision."""
+        if self.precision == 'bf16':
+            return torch.autocast(device.type, dtype=torch.bfloat16)
+        return nullcontext()
 
     def _stft(self, x):
+        """x (B, T) -> spectrum (B, n_fft + 2, num_frames), real parts followed by imag parts"""
+        if self.stft_backend == 'conv':
+            with torch.cuda.amp.autocast(False):
+                return self.conv_stft(x.float())
         spec = torch.stft(
             x,
             self.istft_params["n_fft"], self.istft_params["hop_len"], self.istft_params["n_fft"], window=self.stft_window.to(x.device),
             return_complex=True)
         spec = torch.view_as_real(spec)  # [B, F, TT, 2]
-        return spec[..., 0], spec[..., 1]
+        return torch.cat([spec[..., 0], spec[..., 1]], dim=1)
 
     def _istft(self, magnitude, phase):
         magnitude = torch.clip(magnitude, max=1e2)
+        if self.stft_backend == 'conv':
+            with torch.cuda.amp.autocast(False):
+                return self.conv_istft(polar(magnitude.float(), phase.float()))
         real = magnitude * torch.cos(phase)
         img = magnitude * torch.sin(phase)
         inverse_transform = torch.istft(torch.complex(real, img), self.istft_params["n_fft"], self.istft_params["hop_len"],
                                         self.istft_params["n_fft"], window=self.stft_window.to(magnitude.device))
         return inverse_transform
 
-    def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
-
-        x = self.conv_pre(x)
-        for i in range(self.num_upsamples):
-            x = F.leaky_relu(x, self.lrelu_slope)
-            x = self.ups[i](x)
-
-            if i == self.num_upsamples - 1:
-                x = self.reflection_pad(x)
-
-            # fusion
-            si = self.source_downs[i](s_stft)
-            si = self.source_resblocks[i](si)
-            x = x + si
-
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
-                else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
-            x = xs / self.num_kernels
-
-        x = F.leaky_relu(x)
-        x = self.conv_post(x)
+    def _decode_spec(self, x: torch.Tensor, s_stft: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Upsample output x of conv_pre fused with source spectrum s_stft, return magnitude and phase of speech."""
+        with self._autocast(x.device):
+            for i in range(self.num_upsamples):
+                x = F.leaky_relu(x, self.lrelu_slope)
+                x = self.ups[i](x)
+
+                if i == self.num_upsamples - 1:
+                    x = self.reflection_pad(x)
+
+                # fusion
+                si = self.source_downs[i](s_stft)
+                si = self.source_resblocks[i](si)
+                x = x + si
+
+                xs = None
+                for j in range(self.num_kernels):
+                    if xs is None:
+                        xs = self.resblocks[i * self.num_kernels + j](x)
+                    else:
+                        xs += self.resblocks[i * self.num_kernels + j](x)
+                x = xs / self.num_kernels
+
+            x = F.leaky_relu(x)
+        # NOTE conv_post feeds exp of the magnitude, keep it in fp32 in every precision
+        with torch.autocast(x.device.type, enabled=False):
+            x = self.conv_post(x.float())
         magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
         phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+        return magnitude, phase
+
+    def _decode_onnx(self, x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+        speech = self.decode_onnx.run(None, {'x': x.float().cpu().numpy(), 's': s.float().cpu().numpy()})[0]
+        return torch.from_numpy(speech).to(x)
 
+    def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0)) -> torch.Tensor:
+        if hasattr(self, 'decode_onnx') and self.training is False:
+            return self._decode_onnx(x, s)
+        s_stft = self._stft(s.squeeze(1))
+        magnitude, phase = self._decode_spec(self.conv_pre(x), s_stft)
         x = self._istft(magnitude, phase)
         x = torch.clamp(x, -self.audio_limit, self.audio_limit)
         return x
@@ -666,44 +899,73 @@ class CausalHiFTGenerator(HiFTGenerator):
         self.conv_post.apply(init_weights)
         self.reflection_pad = nn.ReflectionPad1d((1, 0))
         self.stft_window = torch.from_numpy(get_window("hann", istft_params["n_fft"], fftbins=True).astype(np.float32))
+        # torch or conv, see set_stft_backend
+        self.conv_stft = ConvSTFT(istft_params["n_fft"], istft_params["hop_len"], self.stft_window)
+        self.conv_istft = ConvISTFT(istft_params["n_fft"], istft_params["hop_len"], self.stft_window)
+        self.stft_backend = 'torch'
+        # fp32, bf16 or int8 conv stack, see set_precision
+        self.precision = 'fp32'
         self.conv_pre_look_right = conv_pre_look_right
         self.f0_predictor = f0_predictor
+        # cpu or auto (device of speech_feat), see set_f0_device
+        self.f0_device = 'cpu'
+
+    def set_f0_device(self, f0_device: str = 'cpu', tolerance: float = 1e-4, num_frames: int = 500) -> float:
+        """Run f0_predictor on cpu, or in fp32 on the device of this vocoder with auto.
+
+        auto is checked once against cpu on random mel, if the max f0 difference relative to the max f0 exceeds
+        tolerance it falls back to cpu. f0_predictor is moved here once, call it again after moving this vocoder.
+        Return the measured difference.
+        """
+        assert f0_device in ['cpu', 'auto']
+        device = next(self.conv_pre.parameters()).device
+        self.f0_device = 'cpu'
+        self.f0_predictor.to('cpu')
+        if f0_device == 'cpu' or device.type == 'cpu':
+            return 0.0
+        mel = torch.randn(1, self.conv_pre.in_channels, num_frames, device=device)
+        f0_cpu, _ = self.predict_f0(mel)
+        self.f0_device = 'auto'
+        self.f0_predictor.to(device)
+        f0_auto, _ = self.predict_f0(mel)
+        diff = ((f0_auto - f0_cpu).abs().max() / f0_cpu.abs().max().clamp(min=1e-6)).item()
+        if diff > tolerance:
+            logging.warning('f0 on {} differs from cpu by {}, exceeds tolerance {}, keep f0_predictor on cpu'.format(device, diff, tolerance))
+            self.f0_device = 'cpu'
+            self.f0_predictor.to('cpu')
+        logging.info('f0_predictor runs on {}, relative difference to cpu {}'.format(self.f0_device, diff))
+        return diff
+
+    @torch.inference_mode()
+    def predict_f0(self, speech_feat: torch.Tensor, finalize: bool = True, cache: Optional[List[torch.Tensor]] = None) -> Tuple[torch.Tensor, Optional[List[torch.Tensor]]]:
+        """mel->f0 in fp32 on the f0 device, cache is the f0_predictor state of inference_chunk.
+
+        It runs on the device f0_predictor sits on and never moves it, as pipeline threads share this module,
+        see set_f0_device.
+        """
+        device = next(self.f0_predictor.parameters()).device
+        x = speech_feat.to(device, torch.float32)
+        # NOTE f0_predictor precision is crucial for causal inference, so no autocast and no tf32 convolution,
+        # cudnn flags are process wide, other threads may run without tf32 meanwhile which only costs speed
+        tf32_off = torch.backends.cudnn.flags(enabled=torch.backends.cudnn.enabled, benchmark=torch.backends.cudnn.benchmark,
+                                              deterministic=torch.backends.cudnn.deterministic, allow_tf32=False) if device.type == 'cuda' else nullcontext()
+        with torch.cuda.amp.autocast(False), tf32_off:
+            if cache is None:
+                f0 = self.f0_predictor(x, finalize=finalize)
+            else:
+                f0, cache = self.f0_predictor.forward_chunk(x, cache, finalize=finalize)
+        return f0.to(speech_feat), cache
 
     def decode(self, x: torch.Tensor, s: torch.Tensor = torch.zeros(1, 1, 0), finalize: bool = True) -> torch.Tensor:
-        s_stft_real, s_stft_imag = self._stft(s.squeeze(1))
+        if finalize is True and hasattr(self, 'decode_onnx') and self.training is False:
+            return self._decode_onnx(x, s)
+        s_stft = self._stft(s.squeeze(1))
         if finalize is True:
             x = self.conv_pre(x)
         else:
             x = self.conv_pre(x[:, :, :-self.conv_pre_look_right], x[:, :, -self.conv_pre_look_right:])
-            s_stft_real = s_stft_real[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
-            s_stft_imag = s_stft_imag[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
-        s_stft = torch.cat([s_stft_real, s_stft_imag], dim=1)
-
-        for i in range(self.num_upsamples):
-            x = F.leaky_relu(x, self.lrelu_slope)
-            x = self.ups[i](x)
-
-            if i == self.num_upsamples - 1:
-                x = self.reflection_pad(x)
-
-            # fusion
-            si = self.source_downs[i](s_stft)
-            si = self.source_resblocks[i](si)
-            x = x + si
-
-            xs = None
-            for j in range(self.num_kernels):
-                if xs is None:
-                    xs = self.resblocks[i * self.num_kernels + j](x)
-                else:
-                    xs += self.resblocks[i * self.num_kernels + j](x)
-            x = xs / self.num_kernels
-
-        x = F.leaky_relu(x)
-        x = self.conv_post(x)
-        magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
-        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
-
+            s_stft = s_stft[:, :, :-int(np.prod(self.upsample_rates) * self.conv_pre_look_right)]
+        magnitude, phase = self._decode_spec(x, s_stft)
         x = self._istft(magnitude, phase)
         if finalize is False:
             x = x[:, :-int(np.prod(self.upsample_rates) * self.istft_params['hop_len'])]
@@ -712,9 +974,8 @@ class CausalHiFTGenerator(HiFTGenerator):
 
     @torch.inference_mode()
     def inference(self, speech_feat: torch.Tensor, finalize: bool = True) -> torch.Tensor:
-        # mel->f0 NOTE f0_predictor precision is crucial for causal inference, move self.f0_predictor to cpu if necessary
-        self.f0_predictor.to('cpu')
-        f0 = self.f0_predictor(speech_feat.cpu(), finalize=finalize).to(speech_feat)
+        # mel->f0
+        f0, _ = self.predict_f0(speech_feat, finalize=finalize)
         # f0->source
         s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
         s, _, _ = self.m_source(s)
@@ -725,6 +986,274 @@ class CausalHiFTGenerator(HiFTGenerator):
             generated_speech = self.decode(x=speech_feat[:, :, :-self.f0_predictor.condnet[0].causal_padding], s=s, finalize=finalize)
         return generated_speech, s
 
+    def init_cache(self) -> Dict:
+        """Empty state of one streaming session, see inference_chunk."""
+        empty = torch.zeros(0, 0, 0)
+        return {'f0_predictor': [],
+                'source': {'phase': empty, 'offset': 0},
+                'stft': empty,
+                'conv_pre': empty,
+                'ups': [empty] * self.num_upsamples,
+                'reflection_pad': False,
+                'source_downs': [empty] * self.num_upsamples,
+                'source_resblocks': [[] for _ in range(self.num_upsamples)],
+                # frames of x and source of each stage which the other branch has not produced yet
+                'fusion': [[empty, empty] for _ in range(self.num_upsamples)],
+                'resblocks': [[] for _ in range(len(self.resblocks))],
+                'conv_post': empty,
+                'istft': {'speech': empty, 'envelope': empty, 'trim': self.istft_params['n_fft'] // 2},
+                'offset': 0}
+
+    def _stft_chunk(self, s: torch.Tensor, cache: torch.Tensor, finalize: bool) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Frames of _stft whose samples are all available, cache keeps the samples of later frames."""
+        n_fft, hop_len = self.istft_params['n_fft'], self.istft_params['hop_len']
+        if cache.size(2) == 0 and s.shape[2] != 0:
+            # center padding of torch.stft at the start of speech
+            s = F.pad(s, (n_fft // 2, 0), mode='reflect')
+        elif cache.size(2) != 0:
+            s = torch.concat([cache.to(s), s], dim=2)
+        if finalize is True:
+            s = F.pad(s, (0, n_fft // 2), mode='reflect')
+        num_frames = max(0, (s.shape[2] - n_fft) // hop_len + 1)
+        if num_frames == 0:
+            spec = torch.zeros(s.shape[0], n_fft + 2, 0).to(s)
+        elif self.stft_backend == 'conv':
+            with torch.cuda.amp.autocast(False):
+                spec = self.conv_stft(s[:, 0, :(num_frames - 1) * hop_len + n_fft].float(), center=False)
+        else:
+            spec = torch.stft(s[:, 0, :(num_frames - 1) * hop_len + n_fft], n_fft, hop_len, n_fft, window=self.stft_window.to(s.device),
+                              center=False, return_complex=True)
+            spec = torch.view_as_real(spec)  # [B, F, TT, 2]
+            spec = torch.cat([spec[..., 0], spec[..., 1]], dim=1)
+        return spec, s[:, :, num_frames * hop_len:]
+
+    def _istft_chunk(self, magnitude: torch.Tensor, phase: torch.Tensor, cache: Dict, finalize: bool) -> torch.Tensor:
+        """Overlap add and window envelope normalization of torch.istft, only samples all their frames have reached are emitted."""
+        n_fft, hop_len = self.istft_params['n_fft'], self.istft_params['hop_len']
+        magnitude = torch.clip(magnitude, max=1e2)
+        window = self.stft_window.to(magnitude.device)
+        num_frames, length = magnitude.shape[2], magnitude.shape[2] * hop_len + n_fft - hop_len
+        if num_frames == 0:
+            speech, envelope = torch.zeros(magnitude.shape[0], length).to(window), torch.zeros(1, length).to(window)
+        elif self.stft_backend == 'conv':
+            with torch.cuda.amp.autocast(False):
+                speech, envelope = self.conv_istft.overlap_add(polar(magnitude.float(), phase.float()))
+        else:
+            real = magnitude * torch.cos(phase)
+            img = magnitude * torch.sin(phase)
+            frames = torch.fft.irfft(torch.complex(real.float(), img.float()), n=n_fft, dim=1) * window[None, :, None]
+            speech = F.fold(frames, (1, length), (1, n_fft), stride=(1, hop_len)).view(frames.shape[0], length)
+            envelope = F.fold((window ** 2)[None, :, None].expand(1, n_fft, num_frames), (1, length), (1, n_fft), stride=(1, hop_len)).view(1, length)
+        if cache['speech'].size(-1) != 0:
+            speech[:, :n_fft - hop_len] += cache['speech']
+            envelope[:, :n_fft - hop_len] += cache['envelope']
+        # last n_fft // 2 samples are center padding of the last frame
+        num_samples = length - n_fft // 2 if finalize is True else num_frames * hop_len
+        cache['speech'], cache['envelope'] = speech[:, num_samples:], envelope[:, num_samples:]
+        # first n_fft // 2 samples are center padding of the first frame
+        trim = min(cache['trim'], num_samples)
+        cache['trim'] -= trim
+        return speech[:, trim:num_samples] / envelope[:, trim:num_samples]
+
+    def get_decode_states(self, cache: Dict) -> List[torch.Tensor]:
+        """States of decode_chunk in cache, in the input order of the exported decode_chunk graph."""
+        states = [cache['stft'], cache['conv_pre']]
+        for i in range(self.num_upsamples):
+            states += [cache['ups'][i], cache['source_downs'][i], *cache['source_resblocks'][i], *cache['fusion'][i]]
+            for j in range(self.num_kernels):
+                states += cache['resblocks'][i * self.num_kernels + j]
+        states += [cache['conv_post'], cache['istft']['speech'], cache['istft']['envelope']]
+        return states
+
+    def set_decode_states(self, cache: Dict, states: List[torch.Tensor]):
+        """Inverse of get_decode_states for a cache in steady state."""
+        states = iter(states)
+        cache['stft'], cache['conv_pre'] = next(states), next(states)
+        for i in range(self.num_upsamples):
+            cache['ups'][i], cache['source_downs'][i] = next(states), next(states)
+            cache['source_resblocks'][i] = [next(states) for _ in range(2 * len(self.source_resblocks[i].convs1))]
+            cache['fusion'][i] = [next(states), next(states)]
+            for j in range(self.num_kernels):
+                k = i * self.num_kernels + j
+                cache['resblocks'][k] = [next(states) for _ in range(2 * len(self.resblocks[k].convs1))]
+        cache['conv_post'], cache['istft']['speech'], cache['istft']['envelope'] = next(states), next(states), next(states)
+
+    def _is_initial_cache(self, cache: Dict) -> bool:
+        return cache['reflection_pad'] is False and cache['stft'].size(-1) == 0 and cache['conv_pre'].size(-1) == 0
+
+    def _is_steady_cache(self, cache: Dict) -> bool:
+        """After the first chunks every state of decode_chunk keeps the same length, which the decode_chunk graph is exported for."""
+        if cache['reflection_pad'] is False or cache['istft']['trim'] != 0:
+            return False
+        return [i.size(-1) for i in self.get_decode_states(cache)] == self.decode_chunk_onnx_state_lengths
+
+    def _decode_chunk_onnx(self, x: torch.Tensor, s: torch.Tensor, cache: Dict) -> torch.Tensor:
+        states = self.get_decode_states(cache)
+        ort_inputs = {'x': x.float().cpu().numpy(), 's': s.float().cpu().numpy()}
+        ort_inputs.update({'state_{}'.format(k): states[k].float().cpu().numpy() for k, length in enumerate(self.decode_chunk_onnx_state_lengths) if length != 0})
+        outs = iter(self.decode_chunk_onnx.run(None, ort_inputs))
+        speech = torch.from_numpy(next(outs)).to(x)
+        self.set_decode_states(cache, [torch.from_numpy(next(outs)) if length != 0 else states[k] for k, length in enumerate(self.decode_chunk_onnx_state_lengths)])
+        return speech
+
+    def decode_chunk(self, x: torch.Tensor, s: torch.Tensor, cache: Dict, finalize: bool = False) -> torch.Tensor:
+        # NOTE onnx graphs cover the whole utterance in one call and the steady state chunks in between, the first
+        # chunks and finalize of a stream run eagerly, cache is not updated by the whole utterance graph
+        if finalize is True and hasattr(self, 'decode_onnx') and self._is_initial_cache(cache):
+            return self._decode_onnx(x, s)
+        if finalize is False and hasattr(self, 'decode_chunk_onnx') and x.shape[2] != 0 and \
+                s.shape[2] == x.shape[2] * np.prod(self.upsample_rates) * self.istft_params['hop_len'] and self._is_steady_cache(cache):
+            return self._decode_chunk_onnx(x, s, cache)
+        s_stft, cache['stft'] = self._stft_chunk(s, cache['stft'], finalize)
+        x, cache['conv_pre'] = self.conv_pre.forward_chunk(x, cache['conv_pre'], finalize=finalize)
+        with self._autocast(x.device):
+            for i in range(self.num_upsamples):
+                x = F.leaky_relu(x, self.lrelu_slope)
+                x, cache['ups'][i] = self.ups[i].forward_chunk(x, cache['ups'][i])
+
+                if i == self.num_upsamples - 1 and cache['reflection_pad'] is False and x.shape[2] != 0:
+                    x = self.reflection_pad(x)
+                    cache['reflection_pad'] = True
+
+                # fusion
+                si, cache['source_downs'][i] = self.source_downs[i].forward_chunk(s_stft, cache['source_downs'][i])
+                si, cache['source_resblocks'][i] = self.source_resblocks[i].forward_chunk(si, cache['source_resblocks'][i])
+                # x and source frames of a stage are ready at different chunks, add up the frames both branches have
+                x_cache, si_cache = cache['fusion'][i]
+                x = torch.concat([x_cache.to(x), x], dim=2) if x_cache.size(2) != 0 else x
+                si = torch.concat([si_cache.to(si), si], dim=2) if si_cache.size(2) != 0 else si
+                num_frames = min(x.shape[2], si.shape[2])
+                cache['fusion'][i] = [x[:, :, num_frames:], si[:, :, num_frames:]]
+                x = x[:, :, :num_frames] + si[:, :, :num_frames]
+
+                xs = None
+                for j in range(self.num_kernels):
+                    k = i * self.num_kernels + j
+                    xj, cache['resblocks'][k] = self.resblocks[k].forward_chunk(x, cache['resblocks'][k])
+                    xs = xj if xs is None else xs + xj
+                x = xs / self.num_kernels
+
+            x = F.leaky_relu(x)
+        # NOTE conv_post feeds exp of the magnitude, keep it in fp32 in every precision
+        with torch.autocast(x.device.type, enabled=False):
+            x, cache['conv_post'] = self.conv_post.forward_chunk(x.float(), cache['conv_post'])
+        magnitude = torch.exp(x[:, :self.istft_params["n_fft"] // 2 + 1, :])
+        phase = torch.sin(x[:, self.istft_params["n_fft"] // 2 + 1:, :])  # actually, sin is redundancy
+
+        x = self._istft_chunk(magnitude, phase, cache['istft'], finalize)
+        x = torch.clamp(x, -self.audio_limit, self.audio_limit)
+        return x
+
+    @torch.inference_mode()
+    def inference_chunk(self, speech_feat: torch.Tensor, cache: Dict, finalize: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Streaming inference which only vocodes the new mel frames in speech_feat.
+
+        cache comes from init_cache and is updated in place. It carries the inputs every causal conv still needs, the
+        f0 predictor state, source phase and sample offset and the stft/istft overlap, so concatenated outputs of all
+        chunks match inference on the whole mel with finalize=True. Frames waiting for lookahead stay in the cache,
+        finalize flushes them with zero padding.
+        """
+        # mel->f0
+        f0, cache['f0_predictor'] = self.predict_f0(speech_feat, finalize=finalize, cache=cache['f0_predictor'])
+        # f0->source
+        if f0.shape[1] != 0:
+            s = self.f0_upsamp(f0[:, None]).transpose(1, 2)  # bs,n,t
+            s, _, _ = self.m_source.forward_chunk(s, cache['source'])
+            s = s.transpose(1, 2)
+        else:
+            s = torch.zeros(speech_feat.shape[0], 1, 0).to(speech_feat)
+        generated_speech = self.decode_chunk(x=speech_feat, s=s, cache=cache, finalize=finalize)
+        cache['offset'] += generated_speech.shape[1]
+        return generated_speech, s
+
+
+class HiFTDecodeOnnx(nn.Module):
+    """decode of HiFTGenerator, or CausalHiFTGenerator with finalize=True, with conv stft/istft, used for onnx export.
+
+    Inputs are mel x (B, 80, T) and source s (B, 1, T * upsample_scale), output is speech (B, T * upsample_scale).
+    """
+    def __init__(self, generator: HiFTGenerator):
+        super().__init__()
+        self.generator = generator
+
+    def forward(self, x: torch.Tensor, s: torch.Tensor) -> torch.Tensor:
+        magnitude, phase = self.generator._decode_spec(self.generator.conv_pre(x), self.generator.conv_stft(s.squeeze(1)))
+        speech = self.generator.conv_istft(polar(torch.clip(magnitude, max=1e2), phase))
+        return torch.clamp(speech, -self.generator.audio_limit, self.generator.audio_limit)
+
+    def get_io_names(self):
+        return ['x', 's'], ['speech']
+
+
+class CausalHiFTDecodeOnnx(nn.Module):
+    """Steady state decode_chunk of CausalHiFTGenerator with explicit state, used for onnx export.
+
+    Once the first chunks are decoded every state of decode_chunk keeps a fixed number of frames, state_lengths in
+    the order of get_decode_states. Each layer runs on its state concatenated with the new frames and keeps the last
+    frames as its next state, so the graph has no data dependent control flow. Inputs are mel x (B, 80, T), source
+    s (B, 1, T * upsample_scale) and state_k for every non empty state, outputs are speech (B, T * upsample_scale)
+    and new_state_k.
+    """
+    def __init__(self, generator: CausalHiFTGenerator, state_lengths: List[int]):
+        super().__init__()
+        self.generator = generator
+        self.state_lengths = state_lengths
+
+    def forward(self, x: torch.Tensor, s: torch.Tensor, *states: torch.Tensor) -> Tuple[torch.Tensor, ...]:
+        g, states, lengths, new_states = self.generator, iter(states), iter(self.state_lengths), []
+
+        def carry(x):
+            """Prepend the state of the next layer to x, return it and the number of frames kept as new state."""
+            length = next(lengths)
+            if length != 0:
+                x = torch.concat([next(states), x], dim=-1)
+                new_states.append(x[..., x.shape[-1] - length:])
+            return x, length
+
+        def conv(layer, x):
+            return nn.Conv1d.forward(layer, carry(x)[0])
+
+        def resblock(block, x):
+            for idx in range(len(block.convs1)):
+                xt = conv(block.convs1[idx], block.activations1[idx](x))
+                xt = conv(block.convs2[idx], block.activations2[idx](xt))
+                x = xt + x
+            return x
+
+        s_stft = g.conv_stft(carry(s)[0].squeeze(1), center=False)
+        x = conv(g.conv_pre, x)
+        for i in range(g.num_upsamples):
+            x = F.leaky_relu(x, g.lrelu_slope)
+            x = conv(g.ups[i], g.ups[i].upsample(x))
+            si = resblock(g.source_resblocks[i], conv(g.source_downs[i], s_stft))
+            # frames kept in the fusion state wait for the other branch
+            x, length = carry(x)
+            x = x[:, :, :x.shape[2] - length]
+            si, length = carry(si)
+            x = x + si[:, :, :si.shape[2] - length]
+            xs = None
+            for j in range(g.num_kernels):
+                xj = resblock(g.resblocks[i * g.num_kernels + j], x)
+                xs = xj if xs is None else xs + xj
+            x = xs / g.num_kernels
+
+        x = conv(g.conv_post, F.leaky_relu(x))
+        magnitude = torch.clip(torch.exp(x[:, :g.istft_params["n_fft"] // 2 + 1, :]), max=1e2)
+        phase = torch.sin(x[:, g.istft_params["n_fft"] // 2 + 1:, :])
+        outputs = []
+        for y in g.conv_istft.overlap_add(polar(magnitude, phase)):
+            # overlap of the previous frames is added to the first samples, the last samples wait for the next frames
+            length = next(lengths)
+            y = torch.concat([y[:, :length] + next(states), y[:, length:]], dim=1)
+            new_states.append(y[:, y.shape[1] - length:])
+            outputs.append(y[:, :y.shape[1] - length])
+        speech = outputs[0] / outputs[1]
+        return (torch.clamp(speech, -g.audio_limit, g.audio_limit), *new_states)
+
+    def get_io_names(self):
+        index = [k for k, length in enumerate(self.state_lengths) if length != 0]
+        return ['x', 's'] + ['state_{}'.format(k) for k in index], ['speech'] + ['new_state_{}'.format(k) for k in index]
+
 
 if __name__ == '__main__':
     torch.backends.cudnn.deterministic = True
@@ -0,0 +1,110 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""STFT/ISTFT of HiFT as conv1d/conv_transpose1d with a precomputed DFT basis.
+
+HiFT uses a tiny transform (n_fft 16, hop 4), where fft dispatch and complex tensors cost more than the math itself.
+As convolutions it also batches and exports to onnx/tensorrt. In eager mode the same basis is applied as a matmul over
+unfolded frames and overlap added with fold, which is several times faster than conv_transpose1d on cpu. A spectrum
+is one real tensor (B, n_fft + 2, num_frames) holding the real parts of the n_fft // 2 + 1 bins followed by their
+imag parts, the layout HiFT feeds to its convs.
+"""
+from typing import Tuple
+import numpy as np
+import torch
+import torch.nn as nn
+import torch.nn.functional as F
+
+
+def dft_angle(n_fft: int) -> np.ndarray:
+    """(n_fft // 2 + 1, n_fft) angles 2 * pi * k * n / n_fft of the onesided DFT."""
+    return 2 * np.pi * np.arange(n_fft // 2 + 1)[:, None] * np.arange(n_fft)[None, :] / n_fft
+
+
+def polar(magnitude: torch.Tensor, phase: torch.Tensor) -> torch.Tensor:
+    """Spectrum from magnitude and phase (B, n_fft // 2 + 1, num_frames), without building a complex tensor."""
+    return torch.concat([magnitude * torch.cos(phase), magnitude * torch.sin(phase)], dim=1)
+
+
+class ConvSTFT(nn.Module):
+    """torch.stft(x, n_fft, hop_len, n_fft, window, center, return_complex=True), onesided and not normalized."""
+
+    def __init__(self, n_fft: int, hop_len: int, window: torch.Tensor):
+        super().__init__()
+        self.n_fft = n_fft
+        self.hop_len = hop_len
+        angle = dft_angle(n_fft)
+        basis = np.concatenate([np.cos(angle), -np.sin(angle)], axis=0) * window.double().numpy()[None, :]
+        self.register_buffer('basis', torch.from_numpy(basis).float().unsqueeze(1), persistent=False)
+
+    def forward(self, x: torch.Tensor, center: bool = True) -> torch.Tensor:
+        """x (B, T) -> spectrum (B, n_fft + 2, num_frames)"""
+        x = x.unsqueeze(1)
+        if center is True:
+            x = F.pad(x, (self.n_fft // 2, self.n_fft // 2), mode='reflect')
+        if torch.onnx.is_in_onnx_export():
+            return F.conv1d(x, self.basis.to(x.dtype), stride=self.hop_len)
+        return torch.matmul(self.basis[:, 0].to(x.dtype), x[:, 0].unfold(-1, self.n_fft, self.hop_len).transpose(1, 2))
+
+
+class ConvISTFT(nn.Module):
+    """torch.istft(spec, n_fft, hop_len, n_fft, window) of a onesided spectrum, same window envelope normalization."""
+
+    def __init__(self, n_fft: int, hop_len: int, window: torch.Tensor):
+        super().__init__()
+        self.n_fft = n_fft
+        self.hop_len = hop_len
+        angle = dft_angle(n_fft)
+        # irfft counts every bin but dc and nyquist twice, their imag parts drop out as sin is 0
+        scale = np.full((n_fft // 2 + 1, 1), 2.0)
+        scale[0], scale[-1] = 1.0, 1.0
+        window = window.double().numpy()
+        basis = np.concatenate([scale * np.cos(angle), -scale * np.sin(angle)], axis=0) / n_fft * window[None, :]
+        self.register_buffer('basis', torch.from_numpy(basis).float().unsqueeze(1), persistent=False)
+        self.register_buffer('window_square', torch.from_numpy(window ** 2).float().view(1, 1, -1), persistent=False)
+        # envelope of at least n_fft // hop_len - 1 frames is a fixed head, a pattern repeating every hop_len and a fixed tail
+        assert n_fft % hop_len == 0
+        num_frames, overlap = 2 * n_fft // hop_len, n_fft - hop_len
+        envelope = np.zeros((num_frames - 1) * hop_len + n_fft)
+        for i in range(num_frames):
+            envelope[i * hop_len:i * hop_len + n_fft] += window ** 2
+        self.register_buffer('envelope_head', torch.from_numpy(envelope[:overlap]).float(), persistent=False)
+        self.register_buffer('envelope_period', torch.from_numpy(envelope[overlap:overlap + hop_len]).float(), persistent=False)
+        self.register_buffer('envelope_tail', torch.from_numpy(envelope[-overlap:]).float(), persistent=False)
+
+    def envelope(self, num_frames: int) -> torch.Tensor:
+        """Overlap added squared window of num_frames frames, (1, (num_frames - 1) * hop_len + n_fft)"""
+        num_periods = num_frames + 1 - self.n_fft // self.hop_len
+        if num_periods < 0:
+            envelope = F.conv_transpose1d(torch.ones(1, 1, num_frames).to(self.window_square), self.window_square, stride=self.hop_len)
+            return envelope.squeeze(1)
+        return torch.concat([self.envelope_head, self.envelope_period.repeat(num_periods), self.envelope_tail]).unsqueeze(0)
+
+    def overlap_add(self, spec: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+        """Windowed frames overlap added, and the window envelope, both (B, (num_frames - 1) * hop_len + n_fft) without normalization."""
+        if torch.onnx.is_in_onnx_export():
+            speech = F.conv_transpose1d(spec, self.basis.to(spec.dtype), stride=self.hop_len)
+            envelope = F.conv_transpose1d(torch.ones_like(spec[:1, :1]), self.window_square.to(spec.dtype), stride=self.hop_len)
+            return speech.squeeze(1), envelope.squeeze(1)
+        length = (spec.shape[2] - 1) * self.hop_len + self.n_fft
+        frames = torch.matmul(self.basis[:, 0].t().to(spec.dtype), spec)
+        speech = F.fold(frames, (1, length), (1, self.n_fft), stride=(1, self.hop_len)).view(spec.shape[0], length)
+        return speech, self.envelope(spec.shape[2]).to(spec.dtype)
+
+    def forward(self, spec: torch.Tensor) -> torch.Tensor:
+        """spectrum (B, n_fft + 2, num_frames) -> (B, (num_frames - 1) * hop_len)"""
+        speech, envelope = self.overlap_add(spec)
+        # drop center padding of the first and last frame
+        speech = speech[:, self.n_fft // 2:speech.shape[1] - self.n_fft // 2]
+        envelope = envelope[:, self.n_fft // 2:envelope.shape[1] - self.n_fft // 2]
+        return speech / envelope
@@ -0,0 +1,442 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import queue
+import threading
+from collections import OrderedDict
+from contextlib import nullcontext
+from typing import Callable, Dict, Generator, List
+import torch
+from transformers import Cache
+from cosyvoice.utils.file_utils import logging
+
+
+class EmbeddingQueue:
+    """Fifo of (1, T, D) embeddings backed by a growable ring buffer, push/pop are amortized O(1) per frame."""
+
+    def __init__(self, capacity: int = 256):
+        self.capacity = capacity
+        self.buffer = None
+        self.head, self.size = 0, 0
+
+    def __len__(self):
+        return self.size
+
+    def push(self, emb: torch.Tensor):
+        emb = emb[0]
+        if self.buffer is None:
+            self.buffer = torch.zeros((self.capacity, emb.size(1)), dtype=emb.dtype, device=emb.device)
+        if self.size + emb.size(0) > self.capacity:
+            self._grow(self.size + emb.size(0))
+        tail = (self.head + self.size) % self.capacity
+        first = min(emb.size(0), self.capacity - tail)
+        self.buffer[tail: tail + first] = emb[:first]
+        self.buffer[:emb.size(0) - first] = emb[first:]
+        self.size += emb.size(0)
+
+    def pop(self, num: int) -> torch.Tensor:
+        num = min(num, self.size)
+        first = min(num, self.capacity - self.head)
+        # NOTE return a copy as popped slots are overwritten by later push
+        if first == num:
+            emb = self.buffer[self.head: self.head + num].clone()
+        else:
+            emb = torch.concat([self.buffer[self.head:], self.buffer[:num - first]], dim=0)
+        self.head = (self.head + num) % self.capacity
+        self.size -= num
+        return emb.unsqueeze(dim=0)
+
+    def _grow(self, min_capacity: int):
+        capacity = max(2 * self.capacity, min_capacity)
+        buffer = torch.zeros((capacity, self.buffer.size(1)), dtype=self.buffer.dtype, device=self.buffer.device)
+        size = self.size
+        buffer[:size] = self.pop(size)[0]
+        self.buffer, self.capacity, self.head, self.size = buffer, capacity, 0, size
+
+
+class BistreamSession:
+    """Text/speech interleaving state of one bistream request.
+
+    Incoming text is appended mix_ratio[0] tokens at a time after every fill token, prompt speech token is
+    interleaved with text by mix_ratio until consumed, and once text ends the rest of text, task_id and remaining
+    prompt speech token are appended and decoding runs until eos. Embeddings not yet fed to the llm are kept in
+    pending, the backend decides how to feed them (kv cache step or full prompt resubmission for vllm).
+    """
+
+    def __init__(self, llm: torch.nn.Module, prompt_text: torch.Tensor, prompt_speech_token: torch.Tensor, sampling: int = 25,
+                 max_token_text_ratio: float = 20):
+        self.llm = llm
+        self.sampling = sampling
+        self.max_token_text_ratio = max_token_text_ratio
+        self.device = prompt_text.device
+        self.mix_ratio = llm.mix_ratio
+        sos_emb, self.task_id_emb = llm.sos_task_id_embedding(self.device)
+        self.pending = [sos_emb]
+        # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
+        self.text_cache = EmbeddingQueue()
+        self.raw_text = [prompt_text]
+        self.text_token_num = 0
+        self.text_end = False
+        self.prompt_speech_token_emb = llm.speech_embedding(prompt_speech_token) if prompt_speech_token.shape[1] != 0 else \
+            torch.zeros(1, 0, llm.llm_input_size, dtype=sos_emb.dtype, device=self.device)
+        self.out_tokens = []
+        self.next_fill_index = (int(prompt_speech_token.shape[1] / self.mix_ratio[1]) + 1) * self.mix_ratio[1] - prompt_speech_token.shape[1]
+        # decoding means pending is the last sampled token, final means text ended and decode until eos
+        self.decoding, self.final, self.finished = False, False, False
+        # backend related state, kv cache for step decoding or fed embeddings for vllm
+        self.cache = None
+        self.history = []
+
+    def push_text(self, text: torch.Tensor):
+        self.raw_text.append(text)
+        self.text_token_num += text.shape[1]
+
+    def push_text_emb(self, text_emb: torch.Tensor):
+        """Append text already embedded by embed_text, so that embedding can run outside of any lock."""
+        if text_emb.shape[1] != 0:
+            self.text_cache.push(text_emb)
+        self.text_token_num += text_emb.shape[1]
+
+    def end_text(self):
+        self.text_end = True
+
+    def embed_text(self, text: torch.Tensor) -> torch.Tensor:
+        return self.llm.llm.model.model.embed_tokens(text.to(self.device))
+
+    def _embed_text(self):
+        # NOTE embed all text received since last step in one call
+        if len(self.raw_text) != 0:
+            text = torch.concat([i.to(self.device) for i in self.raw_text], dim=1) if len(self.raw_text) != 1 else self.raw_text[0].to(self.device)
+            self.raw_text = []
+            if text.shape[1] != 0:
+                self.text_cache.push(self.embed_text(text))
+
+    def ready(self) -> bool:
+        """Append available text to pending following mix_ratio, return True if a decode step can be run."""
+        if self.finished:
+            return False
+        if self.decoding:
+            return True
+        self._embed_text()
+        # prompt_speech_token_emb not empty, try append to lm_input
+        while self.prompt_speech_token_emb.size(1) != 0 and len(self.text_cache) >= self.mix_ratio[0]:
+            self.pending += [self.text_cache.pop(self.mix_ratio[0]), self.prompt_speech_token_emb[:, :self.mix_ratio[1]]]
+            self.prompt_speech_token_emb = self.prompt_speech_token_emb[:, self.mix_ratio[1]:]
+        if self.prompt_speech_token_emb.size(1) != 0:
+            if self.text_end is False:
+                return False
+            return self.finalize()
+        # no prompt_speech_token_emb remain, can decode some speech token
+        if (len(self.out_tokens) != 0 and self.out_tokens[-1] == self.llm.fill_token) or (len(self.out_tokens) == 0 and len(self.pending) == 1):
+            if len(self.text_cache) < self.mix_ratio[0]:
+                if self.text_end is False:
+                    return False
+                return self.finalize()
+            self.pending.append(self.text_cache.pop(self.mix_ratio[0]))
+        self.decoding = True
+        return True
+
+    def finalize(self) -> bool:
+        # NOTE same as training, text less than mix_ratio[0] is followed by task_id and remaining prompt speech token
+        logging.info('no more text token, decode until met eos')
+        if len(self.text_cache) != 0:
+            self.pending.append(self.text_cache.pop(len(self.text_cache)))
+        self.pending += [self.task_id_emb, self.prompt_speech_token_emb]
+        self.prompt_speech_token_emb = self.prompt_speech_token_emb[:, :0]
+        self.decoding, self.final = True, True
+        return True
+
+    def pop_input(self) -> torch.Tensor:
+        lm_input = torch.concat(self.pending, dim=1) if len(self.pending) != 1 else self.pending[0]
+        self.pending = []
+        return lm_input
+
+    def sample(self, logp: torch.Tensor) -> int:
+        if self.final is True:
+            return self.llm.sampling_ids(logp, self.out_tokens, self.sampling, ignore_eos=False)
+        if self.next_fill_index != -1 and len(self.out_tokens) == self.next_fill_index:
+            return self.llm.fill_token
+        return self.llm.sampling_ids(logp, self.out_tokens, self.sampling, ignore_eos=True)
+
+    def accept(self, top_ids: int) -> bool:
+        """Update state with one decoded token, return True if it is a speech token to output."""
+        if top_ids == self.llm.fill_token and self.final is False:
+            self.next_fill_index = len(self.out_tokens) + self.mix_ratio[1] + 1
+            logging.info('fill_token index {} next fill_token index {}'.format(len(self.out_tokens), self.next_fill_index))
+        self.out_tokens.append(top_ids)
+        if top_ids >= self.llm.speech_token_size:
+            if top_ids == self.llm.fill_token and self.final is False:
+                self.decoding = False
+            elif top_ids == self.llm.eos_token and self.final is True:
+                self.finished = True
+            else:
+                raise ValueError('should not get token {}'.format(top_ids))
+            return False
+        self.pending.append(self.llm.speech_token_embedding(top_ids, self.device))
+        return True
+
+    def segment_len(self) -> int:
+        """Number of speech token to decode before next fill token, or max length after text ends."""
+        if self.final is True:
+            return max(int(self.text_token_num * self.max_token_text_ratio) - len(self.out_tokens), 1)
+        return self.next_fill_index - len(self.out_tokens)
+
+
+class BatchKVCache(Cache):
+    """Padded kv cache of the bistream decode loop, one row per session, written in place.
+
+    The kv of a session stays in its own row at positions [0, length). A step of B sessions runs on rows [0, B),
+    attention reads a view of the buffers and the new kv is scattered right after each valid length, so a step only
+    copies the new positions. Rows are swapped when the set of decoding sessions changes, capacity grows by doubling.
+    Only the decode thread touches the cache.
+    """
+
+    def __init__(self, capacity: int = 256):
+        super().__init__()
+        self.init_capacity = capacity
+        self.reset()
+
+    def reset(self):
+        self.capacity = self.init_capacity
+        self.key_buffers, self.value_buffers = [], []
+        # session owning every row (None for a free row) and its valid kv length
+        self.rows, self.lengths = [], []
+        self.batch_size, self.past_len, self.kv_len = 0, 0, 0
+        self.row_index, self.write_index = None, None
+
+    def prepare(self, sessions: List, input_len: int, device: torch.device) -> List[int]:
+        """Move sessions to rows [0, len(sessions)) and reserve input_len positions after each, return past lengths."""
+        for i, session in enumerate(sessions):
+            if session not in self.rows:
+                if None in self.rows:
+                    self.rows[self.rows.index(None)] = session
+                else:
+                    self.rows.append(session)
+                    self.lengths.append(0)
+                    self._reserve(len(self.rows), 0)
+            j = self.rows.index(session)
+            if j != i:
+                self._swap(i, j)
+        past_lens = self.lengths[:len(sessions)]
+        self.batch_size, self.past_len, self.kv_len = len(sessions), max(past_lens), max(past_lens) + input_len
+        self._reserve(0, self.kv_len)
+        self.row_index = torch.arange(self.batch_size, device=device).unsqueeze(dim=1)
+        self.write_index = torch.tensor(past_lens, device=device).unsqueeze(dim=1) + torch.arange(input_len, device=device)
+        return past_lens
+
+    def commit(self, input_lens: List[int]):
+        for i, input_len in enumerate(input_lens):
+            self.lengths[i] += input_len
+
+    def release_finished(self):
+        for j, session in enumerate(self.rows):
+            if session is not None and session.finished is True:
+                self.rows[j], self.lengths[j] = None, 0
+        # NOTE free the buffers once idle, a long utterance should not pin its capacity forever
+        if all(session is None for session in self.rows):
+            self.reset()
+
+    def _swap(self, i: int, j: int):
+        num = max(self.lengths[i], self.lengths[j])
+        for buffer in self.key_buffers + self.value_buffers:
+            buffer[[i, j], :, :num] = buffer[[j, i], :, :num]
+        self.rows[i], self.rows[j] = self.rows[j], self.rows[i]
+        self.lengths[i], self.lengths[j] = self.lengths[j], self.lengths[i]
+
+    def _reserve(self, num_rows: int, length: int):
+        capacity = max(2 * self.capacity, length) if length > self.capacity else self.capacity
+        if len(self.key_buffers) != 0 and (num_rows > self.key_buffers[0].size(0) or capacity != self.capacity):
+            rows = max(num_rows, self.key_buffers[0].size(0))
+            for buffers in (self.key_buffers, self.value_buffers):
+                for layer, buffer in enumerate(buffers):
+                    new_buffer = buffer.new_zeros((rows, buffer.size(1), capacity, buffer.size(3)))
+                    new_buffer[:buffer.size(0), :, :self.capacity] = buffer
+                    buffers[layer] = new_buffer
+        self.capacity = capacity
+
+    def update(self, key_states: torch.Tensor, value_states: torch.Tensor, layer_idx: int, cache_kwargs: Dict = None):
+        if len(self.key_buffers) <= layer_idx:
+            shape = (len(self.rows), key_states.size(1), self.capacity, key_states.size(3))
+            self.key_buffers.append(key_states.new_zeros(shape))
+            self.value_buffers.append(value_states.new_zeros(shape))
+        key_buffer, value_buffer = self.key_buffers[layer_idx], self.value_buffers[layer_idx]
+        key_buffer[self.row_index, :, self.write_index] = key_states.transpose(1, 2)
+        value_buffer[self.row_index, :, self.write_index] = value_states.transpose(1, 2)
+        return key_buffer[:self.batch_size, :, :self.kv_len], value_buffer[:self.batch_size, :, :self.kv_len]
+
+    def get_seq_length(self, layer_idx: int = 0) -> int:
+        return self.past_len
+
+
+def batch_forward_one_step(llm: torch.nn.Module, lm_inputs: List[torch.Tensor], sessions: List, cache: BatchKVCache) -> List[torch.Tensor]:
+    """Run one Qwen2 forward for sessions with different input and kv cache length.
+
+    Inputs are left aligned and each session reads and writes its own row of cache. A 4d attention mask with explicit
+    position_ids restricts query j of a session to its own past and inputs up to j, queries of padding only see
+    stale positions of their row and are dropped, logp is taken at the last valid input of each session.
+    """
+    input_lens = [i.size(1) for i in lm_inputs]
+    B, T = len(lm_inputs), max(input_lens)
+    device, dtype = lm_inputs[0].device, lm_inputs[0].dtype
+    past_lens = cache.prepare(sessions, T, device)
+    xs = torch.zeros((B, T, lm_inputs[0].size(2)), dtype=dtype, device=device)
+    for i in range(B):
+        xs[i, :input_lens[i]] = lm_inputs[i][0]
+    position_ids = torch.tensor(past_lens, device=device).unsqueeze(dim=1) + torch.arange(T, device=device)
+    allowed = torch.arange(cache.kv_len, device=device).view(1, 1, -1) <= position_ids.unsqueeze(dim=2)
+    masks = torch.zeros(allowed.shape, dtype=dtype, device=device).masked_fill_(~allowed, torch.finfo(dtype).min).unsqueeze(dim=1)
+    outs = llm.llm.model.model(
+        inputs_embeds=xs,
+        attention_mask=masks,
+        position_ids=position_ids,
+        past_key_values=cache,
+        use_cache=True,
+        return_dict=True,
+    )
+    cache.commit(input_lens)
+    hidden = outs.last_hidden_state[torch.arange(B, device=device), torch.tensor(input_lens, device=device) - 1]
+    logp = llm.llm_decoder(hidden).log_softmax(dim=-1)
+    return [logp[i: i + 1] for i in range(B)]
+
+
+class BistreamSessionManager:
+    """Run many bistream sessions in one batched decode loop.
+
+    Every session gets a feeder thread pulling and embedding its text generator, a single decode thread batches
+    one step of all ready sessions (those not waiting for text) per iteration. Both run under context, the cuda
+    stream of the llm. vllm and onnxruntime backends fall back to per session Qwen2LM.inference_bistream, the
+    vllm engine already batches concurrent requests.
+    """
+
+    def __init__(self, llm: torch.nn.Module, fp16: bool = False, max_batch_size: int = 16, context: Callable = nullcontext):
+        self.llm = llm
+        self.fp16 = fp16
+        self.max_batch_size = max_batch_size
+        self.context = context
+        self.sessions = OrderedDict()
+        self.kv_cache = BatchKVCache()
+        self.cond = threading.Condition()
+        self.thread = None
+
+    def inference(self, text: Generator, prompt_text: torch.Tensor, prompt_speech_token: torch.Tensor, sampling: int = 25,
+                  max_token_text_ratio: float = 20, uuid: str = '') -> Generator[int, None, None]:
+        if hasattr(self.llm, 'vllm') or hasattr(self.llm, 'llm_onnx'):
+            for token in self.llm.inference_bistream(text=text,
+                                                     prompt_text=prompt_text,
+                                                     prompt_text_len=torch.tensor([prompt_text.shape[1]], dtype=torch.int32).to(prompt_text.device),
+                                                     prompt_speech_token=prompt_speech_token,
+                                                     prompt_speech_token_len=torch.tensor([prompt_speech_token.shape[1]], dtype=torch.int32).to(prompt_text.device),
+                                                     embedding=None,
+                                                     sampling=sampling,
+                                                     max_token_text_ratio=max_token_text_ratio,
+                                                     uuid=uuid):
+                yield token
+            return
+        with torch.inference_mode():
+            session = BistreamSession(self.llm, prompt_text, prompt_speech_token, sampling, max_token_text_ratio)
+            # NOTE embed prompt text here, the decode loop only embeds under self.cond
+            session._embed_text()
+        session.output_queue = queue.Queue()
+        with self.cond:
+            self.sessions[uuid] = session
+            if self.thread is None:
+                self.thread = threading.Thread(target=self.decode_loop, daemon=True)
+                self.thread.start()
+        threading.Thread(target=self.feed_text, args=(uuid, session, text), daemon=True).start()
+        try:
+            while True:
+                top_ids = session.output_queue.get()
+                if top_ids is None:
+                    break
+                if isinstance(top_ids, Exception):
+                    raise top_ids
+                yield top_ids
+        finally:
+            # NOTE generator may be closed early by decode guard, remove the session from decode loop
+            with self.cond:
+                if uuid in self.sessions:
+                    self.sessions.pop(uuid).finished = True
+
+    def feed_text(self, uuid: str, session: BistreamSession, text: Generator):
+        try:
+            with torch.inference_mode(), self.context():
+                for this_text in text:
+                    # session removed by consumer or failed, stop pulling text
+                    if session.finished is True:
+                        return
+                    text_emb = session.embed_text(this_text)
+                    with self.cond:
+                        session.push_text_emb(text_emb)
+                        self.cond.notify()
+        except Exception as e:
+            # NOTE a failed text generator must not finalize the session as if text ended
+            with self.cond:
+                if self.sessions.get(uuid) is session:
+                    self.finish_session(uuid, e)
+            return
+        with self.cond:
+            session.end_text()
+            self.cond.notify()
+
+    def decode_loop(self):
+        with torch.inference_mode(), self.context(), torch.cuda.amp.autocast(self.fp16):
+            while True:
+                with self.cond:
+                    self.kv_cache.release_finished()
+                    batch = []
+                    while len(batch) == 0:
+                        for uuid in list(self.sessions.keys()):
+                            session = self.sessions[uuid]
+                            try:
+                                if session.ready() is True:
+                                    batch.append((uuid, session))
+                            except Exception as e:
+                                self.finish_session(uuid, e)
+                            if len(batch) == self.max_batch_size:
+                                break
+                        if len(batch) == 0:
+                            self.cond.wait()
+                    # NOTE move decoded sessions to the end so that every session gets a chance when exceeding max_batch_size
+                    for uuid, _ in batch:
+                        self.sessions.move_to_end(uuid)
+                    lm_inputs = [session.pop_input() for _, session in batch]
+                try:
+                    outputs = batch_forward_one_step(self.llm, lm_inputs, [session for _, session in batch], self.kv_cache)
+                except Exception as e:
+                    with self.cond:
+                        for uuid, session in batch:
+                            if self.sessions.get(uuid) is session:
+                                self.finish_session(uuid, e)
+                    continue
+                with self.cond:
+                    for (uuid, session), logp in zip(batch, outputs):
+                        # session may be removed by consumer during forward
+                        if self.sessions.get(uuid) is not session:
+                            continue
+                        try:
+                            top_ids = session.sample(logp.squeeze(dim=0))
+                            if session.accept(top_ids) is True:
+                                session.output_queue.put(top_ids)
+                        except Exception as e:
+                            self.finish_session(uuid, e)
+                            continue
+                        if session.finished is True:
+                            self.finish_session(uuid)
+
+    def finish_session(self, uuid: str, error: Exception = None):
+        session = self.sessions.pop(uuid)
+        session.finished = True
+        if error is not None:
+            logging.error('bistream session {} failed, {}'.format(uuid, error))
+            session.output_queue.put(error)
+        session.output_queue.put(None)
@@ -0,0 +1,163 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import math
+import threading
+from typing import Dict, List, Optional
+from cosyvoice.utils.file_utils import logging
+
+KEEP, DROP, STOP = 0, 1, 2
+
+
+class DecodeGuardState:
+    """Per request decode guard, check speech token one by one and decide keep/drop/stop."""
+
+    def __init__(self, guard: 'DecodeGuard', uuid: str, text_len: Optional[int], language: str, options: Dict):
+        self.guard = guard
+        self.uuid = uuid
+        self.text_len = text_len
+        self.language = language
+        self.options = options
+        self.max_len = None if text_len is None else int(text_len * options['max_token_text_ratio'])
+        self.num_tokens = 0
+        self.cur_silent_token_num = 0
+        # match_len[p] is the number of trailing tokens equal to the token p steps before
+        self.match_len = [0] * (int(options['ngram_max_size']) + 1)
+        self.history = []
+        self.stop_reason = None
+
+    @property
+    def max_token_text_ratio(self) -> float:
+        return self.options['max_token_text_ratio']
+
+    @property
+    def min_token_text_ratio(self) -> float:
+        return self.options['min_token_text_ratio']
+
+    def check(self, token: int) -> int:
+        if not self.options['enable']:
+            self.num_tokens += 1
+            return KEEP
+        if self.max_len is not None and self.num_tokens >= self.max_len:
+            return self.stop('max_len')
+        # 1. silence run, drop silent token beyond max_silent_token_num and stop beyond max_silence_run
+        if token in self.guard.silent_tokens:
+            self.cur_silent_token_num += 1
+            if self.cur_silent_token_num > self.options['max_silence_run']:
+                return self.stop('silence')
+            if self.cur_silent_token_num > self.options['max_silent_token_num']:
+                with self.guard.lock:
+                    self.guard.counters['drop_silent_token'] += 1
+                return DROP
+            self.num_tokens += 1
+            return KEEP
+        self.cur_silent_token_num = 0
+        # 2. n-gram repetition over non silent token, tail of history is one n-gram repeated ngram_max_repeat times and longer than ngram_min_span
+        self.history.append(token)
+        for p in range(1, len(self.match_len)):
+            if len(self.history) > p and self.history[-1] == self.history[-1 - p]:
+                self.match_len[p] += 1
+                if self.match_len[p] + p >= max(p * self.options['ngram_max_repeat'], self.options['ngram_min_span']):
+                    return self.stop('ngram')
+            else:
+                self.match_len[p] = 0
+        if len(self.history) > len(self.match_len):
+            self.history = self.history[-len(self.match_len):]
+        self.num_tokens += 1
+        return KEEP
+
+    def stop(self, reason: str) -> int:
+        self.stop_reason = reason
+        logging.warning('decode guard stop {} reason {} after {} tokens, text_len {} language {}'.format(self.uuid, reason, self.num_tokens, self.text_len, self.language))
+        return STOP
+
+
+class DecodeGuard:
+    """Early stop policy for speech token decoding.
+
+    Per language token/text ratio statistics are accumulated from requests that end with eos, once enough samples
+    are collected max_len is tightened to mean + ratio_std_scale * std instead of the fixed max_token_text_ratio.
+    Degenerate generation is detected as n-gram repetition over speech tokens or a long silence run.
+    Every option can be overridden per request.
+    """
+
+    default_options = {
+        'enable': True,
+        'max_token_text_ratio': 20,
+        'min_token_text_ratio': 2,
+        'ngram_max_size': 20,
+        'ngram_max_repeat': 4,
+        'ngram_min_span': 50,
+        'max_silent_token_num': 5,
+        'max_silence_run': 100,
+    }
+
+    def __init__(self, silent_tokens: List[int], ratio_std_scale: float = 4, ratio_min_count: int = 20, ratio_min_text_len: int = 5, **kwargs):
+        self.silent_tokens = set(silent_tokens)
+        self.ratio_std_scale = ratio_std_scale
+        self.ratio_min_count = ratio_min_count
+        self.ratio_min_text_len = ratio_min_text_len
+        for k in kwargs:
+            assert k in self.default_options, 'unknown decode guard option {}'.format(k)
+        self.options = {**self.default_options, **kwargs}
+        self.lock = threading.Lock()
+        # language -> [count, mean, m2] of token/text ratio, welford online update
+        self.ratio_stats = {}
+        self.counters = {'request': 0, 'eos': 0, 'stop_max_len': 0, 'stop_ngram': 0, 'stop_silence': 0, 'drop_silent_token': 0}
+
+    def adaptive_max_ratio(self, language: str) -> float:
+        count, mean, m2 = self.ratio_stats.get(language, [0, 0.0, 0.0])
+        if count < self.ratio_min_count:
+            return self.options['max_token_text_ratio']
+        return min(self.options['max_token_text_ratio'], mean + self.ratio_std_scale * math.sqrt(m2 / (count - 1)))
+
+    def check_overrides(self, overrides: Optional[Dict]):
+        """Validate per request overrides, called by the caller before starting llm_job so that errors reach the client."""
+        for k in overrides or {}:
+            if k not in self.default_options:
+                raise ValueError('unknown decode guard option {}, expect one of {}'.format(k, list(self.default_options)))
+
+    def new_state(self, uuid: str, text_len: Optional[int] = None, language: str = 'unknown', overrides: Optional[Dict] = None) -> DecodeGuardState:
+        self.check_overrides(overrides)
+        overrides = {} if overrides is None else overrides
+        with self.lock:
+            self.counters['request'] += 1
+            options = {**self.options, 'max_token_text_ratio': self.adaptive_max_ratio(language)}
+        options.update(overrides)
+        return DecodeGuardState(self, uuid, text_len, language, options)
+
+    def finish(self, state: DecodeGuardState):
+        with self.lock:
+            if state.stop_reason is None and state.max_len is not None and state.num_tokens >= state.max_len:
+                state.stop_reason = 'max_len'
+            if state.stop_reason is not None:
+                self.counters['stop_{}'.format(state.stop_reason)] += 1
+                return
+            self.counters['eos'] += 1
+            if state.text_len is None or state.text_len < self.ratio_min_text_len:
+                return
+            count, mean, m2 = self.ratio_stats.get(state.language, [0, 0.0, 0.0])
+            ratio = state.num_tokens / state.text_len
+            count += 1
+            delta = ratio - mean
+            mean += delta / count
+            m2 += delta * (ratio - mean)
+            self.ratio_stats[state.language] = [count, mean, m2]
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            languages = {}
+            for language, (count, mean, m2) in self.ratio_stats.items():
+                languages[language] = {'count': count, 'mean': mean, 'std': math.sqrt(m2 / (count - 1)) if count > 1 else 0.0,
+                                       'max_token_text_ratio': self.adaptive_max_ratio(language)}
+            return {'counters': dict(self.counters), 'languages': languages}
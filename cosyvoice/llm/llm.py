@@ -28,6 +28,7 @@ from cosyvoice.transformer.label_smoothing_loss import LabelSmoothingLoss
 from cosyvoice.utils.common import th_accuracy
 from cosyvoice.utils.file_utils import logging
 from cosyvoice.utils.mask import make_pad_mask
+from cosyvoice.llm.bistream import BistreamSession
 
 
 class TransformerLM(torch.nn.Module):
@@ -245,19 +246,56 @@ class Qwen2Encoder(torch.nn.Module):
 
     def forward_one_step(self, xs, masks, cache=None):
         input_masks = masks[:, -1, :]
-        outs = self.model(
+        # NOTE call Qwen2Model directly, lm_head over the text vocabulary is never used in inference
+        outs = self.model.model(
             inputs_embeds=xs,
             attention_mask=input_masks,
-            output_hidden_states=True,
             return_dict=True,
             use_cache=True,
             past_key_values=cache,
         )
-        xs = outs.hidden_states[-1]
+        xs = outs.last_hidden_state
         new_cache = outs.past_key_values
         return xs, new_cache
 
 
+class Qwen2OnnxStep(torch.nn.Module):
+    """Qwen2 backbone + llm_decoder decode step with explicit kv cache, used for onnx export.
+
+    Inputs are inputs_embeds (B, T, D), attention_mask (B, past_len + T) and past_key_i/past_value_i
+    (B, kv_head, past_len, head_dim) for every layer, outputs are logp of the last position (B, V)
+    and present_key_i/present_value_i (B, kv_head, past_len + T, head_dim).
+    """
+    def __init__(self, llm: torch.nn.Module):
+        super().__init__()
+        self.model = llm.llm.model.model
+        self.llm_decoder = llm.llm_decoder
+        self.num_layers = self.model.config.num_hidden_layers
+
+    def forward(self, inputs_embeds: torch.Tensor, attention_mask: torch.Tensor, *past_key_values: torch.Tensor):
+        from transformers import DynamicCache
+        cache = DynamicCache.from_legacy_cache(tuple((past_key_values[2 * i], past_key_values[2 * i + 1]) for i in range(self.num_layers)))
+        outs = self.model(
+            inputs_embeds=inputs_embeds,
+            attention_mask=attention_mask,
+            return_dict=True,
+            use_cache=True,
+            past_key_values=cache,
+        )
+        logp = self.llm_decoder(outs.last_hidden_state[:, -1]).log_softmax(dim=-1)
+        present_key_values = []
+        for k, v in outs.past_key_values.to_legacy_cache():
+            present_key_values += [k, v]
+        return (logp, *present_key_values)
+
+    def get_io_names(self):
+        past_names, present_names = [], []
+        for i in range(self.num_layers):
+            past_names += ['past_key_{}'.format(i), 'past_value_{}'.format(i)]
+            present_names += ['present_key_{}'.format(i), 'present_value_{}'.format(i)]
+        return ['inputs_embeds', 'attention_mask'] + past_names, ['logp'] + present_names
+
+
 class Qwen2LM(TransformerLM):
     def __init__(
             self,
@@ -301,6 +339,12 @@ class Qwen2LM(TransformerLM):
         self.stop_token_ids = [speech_token_size + i for i in range(3)]
         self.vllm_output_queue = {}
 
+    def speech_token_embedding(self, token_id, device):
+        # NOTE speech_embedding may be replaced by int8 quantized embedding, which has no weight tensor
+        if isinstance(self.speech_embedding, torch.nn.Embedding):
+            return self.speech_embedding.weight[token_id].reshape(1, 1, -1)
+        return self.speech_embedding(torch.tensor([[token_id]], dtype=torch.long, device=device))
+
     def prepare_lm_input_target(self, sos_emb, text_token, text_token_emb, text_token_len, task_id_emb, speech_token, speech_token_emb, speech_token_len, instruct_token=None, instruct_token_emb=None, instruct_token_len=None):
         lm_target, lm_input = [], []
         text_token = unpad_sequence(text_token, text_token_len.cpu(), batch_first=True)
@@ -477,6 +521,25 @@ class Qwen2LM(TransformerLM):
         for token in self.inference_wrapper(lm_input, sampling, min_len, max_len, uuid):
             yield token
 
+    def forward_one_step_onnx(self, lm_input, cache=None):
+        # NOTE cache is a list of numpy past_key/past_value arrays, empty past is fed as zero length arrays
+        if cache is None:
+            cache = [np.zeros((lm_input.shape[0], self.llm_onnx_kv_head, 0, self.llm_onnx_head_dim), dtype=np.float32)] * len(self.llm_onnx_past_names)
+        ort_inputs = {'inputs_embeds': lm_input.float().cpu().numpy(),
+                      'attention_mask': np.ones((lm_input.shape[0], cache[0].shape[2] + lm_input.shape[1]), dtype=np.int64)}
+        ort_inputs.update(zip(self.llm_onnx_past_names, cache))
+        outs = self.llm_onnx.run(None, ort_inputs)
+        return torch.from_numpy(outs[0]).to(lm_input.device), outs[1:]
+
+    def forward_one_step_logp(self, lm_input, cache=None):
+        if hasattr(self, 'llm_onnx'):
+            return self.forward_one_step_onnx(lm_input, cache)
+        seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
+        y_pred, cache = self.llm.forward_one_step(lm_input,
+                                                  masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
+                                                  cache=cache)
+        return self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1), cache
+
     @torch.inference_mode()
     def inference_wrapper(self, lm_input, sampling, min_len, max_len, uuid):
         if hasattr(self, 'vllm'):
@@ -488,26 +551,45 @@ class Qwen2LM(TransformerLM):
             with self.lock:
                 self.vllm.add_request(uuid, {"prompt_embeds": lm_input.squeeze(0).to(torch.bfloat16).to(lm_input.device)}, sampling_params)
                 self.vllm_output_queue[uuid] = queue.Queue()
-            out_tokens = []
-            while True:
+            out_tokens, finished = [], False
+            try:
+                while True:
+                    with self.lock:
+                        if self.vllm_output_queue[uuid].empty() is True:
+                            request_outputs: List[RequestOutput] = self.vllm.step()
+                            for request_output in request_outputs:
+                                top_ids = list(request_output.outputs[0].token_ids)[-1]
+                                self.vllm_output_queue[request_output.request_id].put(top_ids)
+                    if self.vllm_output_queue[uuid].empty() is False:
+                        top_ids = self.vllm_output_queue[uuid].get()
+                        if top_ids in self.stop_token_ids:
+                            finished = True
+                            break
+                        # in stream mode, yield token one by one
+                        yield top_ids
+                        out_tokens.append(top_ids)
+                        if len(out_tokens) == max_len:
+                            finished = True
+                            break
+                    time.sleep(0.001)
+            finally:
+                # NOTE generator may be closed early by decode guard, abort the request so that it does not occupy vllm
                 with self.lock:
-                    if self.vllm_output_queue[uuid].empty() is True:
-                        request_outputs: List[RequestOutput] = self.vllm.step()
-                        for request_output in request_outputs:
-                            top_ids = list(request_output.outputs[0].token_ids)[-1]
-                            self.vllm_output_queue[request_output.request_id].put(top_ids)
-                if self.vllm_output_queue[uuid].empty() is False:
-                    top_ids = self.vllm_output_queue[uuid].get()
-                    if top_ids in self.stop_token_ids:
-                        break
-                    # in stream mode, yield token one by one
-                    yield top_ids
-                    out_tokens.append(top_ids)
-                    if len(out_tokens) == max_len:
-                        break
-                time.sleep(0.001)
-            with self.lock:
-                self.vllm_output_queue.pop(uuid)
+                    if finished is False:
+                        self.vllm.abort_request(uuid)
+                    self.vllm_output_queue.pop(uuid)
+        elif hasattr(self, 'llm_onnx'):
+            out_tokens = []
+            cache = None
+            for i in range(max_len):
+                logp, cache = self.forward_one_step_onnx(lm_input, cache)
+                top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True if i < min_len else False)
+                if top_ids in self.stop_token_ids:
+                    break
+                # in stream mode, yield token one by one
+                yield top_ids
+                out_tokens.append(top_ids)
+                lm_input = self.speech_token_embedding(top_ids, lm_input.device)
         else:
             out_tokens = []
             cache = None
@@ -522,7 +604,7 @@ class Qwen2LM(TransformerLM):
                 # in stream mode, yield token one by one
                 yield top_ids
                 out_tokens.append(top_ids)
-                lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+                lm_input = self.speech_token_embedding(top_ids, lm_input.device)
 
     @torch.inference_mode()
     def inference_bistream(
@@ -536,93 +618,38 @@ class Qwen2LM(TransformerLM):
             sampling: int = 25,
             max_token_text_ratio: float = 20,
             min_token_text_ratio: float = 2,
+            uuid: str = '',
     ) -> Generator[torch.Tensor, None, None]:
-
-        device = prompt_text.device
-        # 1. prepare input
-        sos_emb = self.llm_embedding.weight[self.sos].reshape(1, 1, -1)
-        task_id_emb = self.llm_embedding.weight[self.task_id].reshape(1, 1, -1)
-        if prompt_speech_token_len != 0:
-            prompt_speech_token_emb = self.speech_embedding(prompt_speech_token)
-        else:
-            prompt_speech_token_emb = torch.zeros(1, 0, self.llm_input_size, dtype=prompt_text.dtype).to(device)
-        lm_input = torch.concat([sos_emb], dim=1)
-
-        # 2. iterate text
-        out_tokens = []
-        cache = None
-        # NOTE init prompt_text as text_cache as it is basically impossible prompt_speech_token/prompt_text < 15/5
-        text_cache = self.llm.model.model.embed_tokens(prompt_text)
-        next_fill_index = (int(prompt_speech_token.shape[1] / self.mix_ratio[1]) + 1) * self.mix_ratio[1] - prompt_speech_token.shape[1]
-        for this_text in text:
-            text_cache = torch.concat([text_cache, self.llm.model.model.embed_tokens(this_text)], dim=1)
-            # prompt_speech_token_emb not empty, try append to lm_input
-            while prompt_speech_token_emb.size(1) != 0:
-                if text_cache.size(1) >= self.mix_ratio[0]:
-                    lm_input_text, lm_input_speech = text_cache[:, :self.mix_ratio[0]], prompt_speech_token_emb[:, :self.mix_ratio[1]]
-                    logging.info('append {} text token {} speech token'.format(lm_input_text.size(1), lm_input_speech.size(1)))
-                    lm_input = torch.concat([lm_input, lm_input_text, lm_input_speech], dim=1)
-                    text_cache, prompt_speech_token_emb = text_cache[:, self.mix_ratio[0]:], prompt_speech_token_emb[:, self.mix_ratio[1]:]
+        session = BistreamSession(self, prompt_text, prompt_speech_token, sampling, max_token_text_ratio)
+        text = iter(text)
+        while session.finished is False:
+            if session.ready() is False:
+                this_text = next(text, None)
+                if this_text is None:
+                    session.end_text()
                 else:
-                    logging.info('not enough text token to decode, wait for more')
+                    session.push_text(this_text)
+                continue
+            if hasattr(self, 'vllm'):
+                # NOTE vllm has no kv cache reuse across requests, resubmit all fed embeddings for every segment
+                session.history.append(session.pop_input())
+                segment_len = session.segment_len()
+                for top_ids in self.inference_wrapper(torch.concat(session.history, dim=1), sampling,
+                                                      0 if session.final else segment_len, segment_len, '{}_{}'.format(uuid, len(session.out_tokens))):
+                    if session.accept(top_ids) is True:
+                        yield top_ids
+                if session.final is True:
                     break
-            # no prompt_speech_token_emb remain, can decode some speech token
-            if prompt_speech_token_emb.size(1) == 0:
-                if (len(out_tokens) != 0 and out_tokens[-1] == self.fill_token) or (len(out_tokens) == 0 and lm_input.size(1) == 1):
-                    logging.info('get fill token, need to append more text token')
-                    if text_cache.size(1) >= self.mix_ratio[0]:
-                        lm_input_text = text_cache[:, :self.mix_ratio[0]]
-                        logging.info('append {} text token'.format(lm_input_text.size(1)))
-                        if len(out_tokens) != 0 and out_tokens[-1] == self.fill_token:
-                            lm_input = lm_input_text
-                        else:
-                            lm_input = torch.concat([lm_input, lm_input_text], dim=1)
-                        text_cache = text_cache[:, self.mix_ratio[0]:]
-                    else:
-                        logging.info('not enough text token to decode, wait for more')
-                        continue
-                while True:
-                    seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-                    y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                              masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                              cache=cache)
-                    logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-                    if next_fill_index != -1 and len(out_tokens) == next_fill_index:
-                        top_ids = self.fill_token
-                        next_fill_index += (self.mix_ratio[1] + 1)
-                    else:
-                        top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=True)
-                    if top_ids == self.fill_token:
-                        next_fill_index = len(out_tokens) + self.mix_ratio[1] + 1
-                        logging.info('fill_token index {} next fill_token index {}'.format(len(out_tokens), next_fill_index))
-                    out_tokens.append(top_ids)
-                    if top_ids >= self.speech_token_size:
-                        if top_ids == self.fill_token:
-                            break
-                        else:
-                            raise ValueError('should not get token {}'.format(top_ids))
+                session.history.append(session.pop_input())
+                session.accept(self.fill_token)
+            else:
+                logp, session.cache = self.forward_one_step_logp(session.pop_input(), session.cache)
+                top_ids = session.sample(logp.squeeze(dim=0))
+                if session.accept(top_ids) is True:
                     yield top_ids
-                    lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
 
-        # 3. final decode
-        lm_input = torch.concat([lm_input, text_cache, task_id_emb], dim=1)
-        logging.info('no more text token, decode until met eos')
-        while True:
-            seq_len = lm_input.shape[1] if cache is None else lm_input.shape[1] + cache[0][0].size(2)
-            y_pred, cache = self.llm.forward_one_step(lm_input,
-                                                      masks=torch.tril(torch.ones((1, seq_len, seq_len), device=lm_input.device)).to(torch.bool),
-                                                      cache=cache)
-            logp = self.llm_decoder(y_pred[:, -1]).log_softmax(dim=-1)
-            top_ids = self.sampling_ids(logp.squeeze(dim=0), out_tokens, sampling, ignore_eos=False)
-            out_tokens.append(top_ids)
-            if top_ids >= self.speech_token_size:
-                if top_ids == self.eos_token:
-                    break
-                else:
-                    raise ValueError('should not get token {}'.format(top_ids))
-            # in stream mode, yield token one by one
-            yield top_ids
-            lm_input = self.speech_embedding.weight[top_ids].reshape(1, 1, -1)
+    def sos_task_id_embedding(self, device):
+        return self.llm_embedding.weight[self.sos].reshape(1, 1, -1), self.llm_embedding.weight[self.task_id].reshape(1, 1, -1)
 
 
 class CosyVoice3LM(Qwen2LM):
@@ -667,6 +694,9 @@ class CosyVoice3LM(Qwen2LM):
         self.stop_token_ids = [speech_token_size + i for i in range(200)]
         self.vllm_output_queue = {}
 
+    def sos_task_id_embedding(self, device):
+        return self.speech_token_embedding(self.sos, device), self.speech_token_embedding(self.task_id, device)
+
     def forward(
             self,
             batch: dict,
@@ -731,8 +761,8 @@ class CosyVoice3LM(Qwen2LM):
         text = self.llm.model.model.embed_tokens(text)
 
         # 3. concat llm_input
-        sos_emb = self.speech_embedding.weight[self.sos].reshape(1, 1, -1)
-        task_id_emb = self.speech_embedding.weight[self.task_id].reshape(1, 1, -1)
+        sos_emb = self.speech_token_embedding(self.sos, device)
+        task_id_emb = self.speech_token_embedding(self.task_id, device)
         if prompt_speech_token_len != 0:
             prompt_speech_token_emb = self.speech_embedding(prompt_speech_token)
         else:
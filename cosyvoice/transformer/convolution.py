@@ -146,6 +146,16 @@ class ConvolutionModule(nn.Module):
         return x.transpose(1, 2), new_cache
 
 
+def conv1d_chunk(conv: torch.nn.Conv1d, x: torch.Tensor) -> Tuple[torch.Tensor, torch.Tensor]:
+    """Unpadded conv over every complete window of x, return output and the input frames later windows still need."""
+    receptive_field = conv.dilation[0] * (conv.kernel_size[0] - 1) + 1
+    num_frames = max(0, (x.shape[2] - receptive_field) // conv.stride[0] + 1)
+    if num_frames == 0:
+        return torch.zeros(x.shape[0], conv.out_channels, 0).to(x), x
+    y = torch.nn.Conv1d.forward(conv, x[:, :, :(num_frames - 1) * conv.stride[0] + receptive_field])
+    return y, x[:, :, num_frames * conv.stride[0]:]
+
+
 # NOTE(Xiang Lyu) causal conv module used in convolution-based vocoder
 class CausalConv1d(torch.nn.Conv1d):
     def __init__(
@@ -186,6 +196,20 @@ class CausalConv1d(torch.nn.Conv1d):
         assert x.shape[2] == input_timestep
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0), finalize: bool = False) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        cache: (batch_size, in_channels, T) input frames not consumed by previous chunks, for causal_type left empty cache
+            means zero padding, for causal_type right it holds the frames still waiting for their right context
+        finalize: zero pad the right context of causal_type right like forward does at the end of input
+        """
+        if cache.size(2) == 0 and self.causal_type == 'left':
+            cache = torch.zeros(x.shape[0], x.shape[1], self.causal_padding).to(x)
+        if cache.size(2) != 0:
+            x = torch.concat([cache.to(x), x], dim=2)
+        if finalize is True and self.causal_type == 'right':
+            x = F.pad(x, (0, self.causal_padding), value=0.0)
+        return conv1d_chunk(self, x)
+
 
 class CausalConv1dDownSample(torch.nn.Conv1d):
     def __init__(
@@ -220,6 +244,14 @@ class CausalConv1dDownSample(torch.nn.Conv1d):
         x = super(CausalConv1dDownSample, self).forward(x)
         return x
 
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        cache: (batch_size, in_channels, T) input frames not consumed by previous chunks, empty cache means zero padding
+        """
+        if cache.size(2) == 0:
+            cache = torch.zeros(x.shape[0], x.shape[1], self.causal_padding).to(x)
+        return conv1d_chunk(self, torch.concat([cache.to(x), x], dim=2))
+
 
 class CausalConv1dUpsample(torch.nn.Conv1d):
     def __init__(
@@ -256,3 +288,13 @@ class CausalConv1dUpsample(torch.nn.Conv1d):
         x = super(CausalConv1dUpsample, self).forward(x)
         assert input_timestep == x.shape[2]
         return x
+
+    def forward_chunk(self, x: torch.Tensor, cache: torch.Tensor = torch.zeros(0, 0, 0)) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        cache: (batch_size, in_channels, causal_padding) upsampled input frames before x, empty cache means zero padding
+        """
+        if x.shape[2] != 0:
+            x = self.upsample(x)
+        if cache.size(2) == 0:
+            cache = torch.zeros(x.shape[0], x.shape[1], self.causal_padding).to(x)
+        return conv1d_chunk(self, torch.concat([cache.to(x), x], dim=2))
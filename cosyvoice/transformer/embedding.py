@@ -230,12 +230,16 @@ class EspnetRelPositionalEncoding(torch.nn.Module):
                 if self.pe.dtype != x.dtype or self.pe.device != x.device:
                     self.pe = self.pe.to(dtype=x.dtype, device=x.device)
                 return
+        self.pe = self.build_pe(x.size(1), x.device, x.dtype)
+
+    def build_pe(self, length: int, device: torch.device, dtype: torch.dtype) -> torch.Tensor:
+        """Positional encodings of relative positions (-length, length), shape (1, 2 * length - 1, d_model)."""
         # Suppose `i` means to the position of query vecotr and `j` means the
         # position of key vector. We use position relative positions when keys
         # are to the left (i>j) and negative relative positions otherwise (i<j).
-        pe_positive = torch.zeros(x.size(1), self.d_model)
-        pe_negative = torch.zeros(x.size(1), self.d_model)
-        position = torch.arange(0, x.size(1), dtype=torch.float32).unsqueeze(1)
+        pe_positive = torch.zeros(length, self.d_model)
+        pe_negative = torch.zeros(length, self.d_model)
+        position = torch.arange(0, length, dtype=torch.float32).unsqueeze(1)
         div_term = torch.exp(
             torch.arange(0, self.d_model, 2, dtype=torch.float32)
             * -(math.log(10000.0) / self.d_model)
@@ -251,7 +255,7 @@ class EspnetRelPositionalEncoding(torch.nn.Module):
         pe_positive = torch.flip(pe_positive, [0]).unsqueeze(0)
         pe_negative = pe_negative[1:].unsqueeze(0)
         pe = torch.cat([pe_positive, pe_negative], dim=1)
-        self.pe = pe.to(device=x.device, dtype=x.dtype)
+        return pe.to(device=device, dtype=dtype)
 
     def forward(self, x: torch.Tensor, offset: Union[int, torch.Tensor] = 0) \
             -> Tuple[torch.Tensor, torch.Tensor]:
@@ -290,9 +294,14 @@ class EspnetRelPositionalEncoding(torch.nn.Module):
         # How to subscript a Union type:
         #   https://github.com/pytorch/pytorch/issues/69434
         if isinstance(offset, int):
-            pos_emb = self.pe[
+            # NOTE read self.pe once and never resize it here, streaming sessions share this module across threads,
+            # a pe too short for this call is built locally instead
+            pe = self.pe
+            if pe.size(1) // 2 + 1 < size + offset:
+                pe = self.build_pe(size + offset, pe.device, pe.dtype)
+            pos_emb = pe[
                 :,
-                self.pe.size(1) // 2 - size - offset + 1: self.pe.size(1) // 2 + size + offset,
+                pe.size(1) // 2 - size - offset + 1: pe.size(1) // 2 + size + offset,
             ]
         elif isinstance(offset, torch.Tensor):
             pos_emb = self.pe[
@@ -15,7 +15,7 @@
 # limitations under the License.
 # Modified from ESPnet(https://github.com/espnet/espnet)
 """Encoder definition."""
-from typing import Tuple
+from typing import Dict, List, Tuple
 
 import torch
 from torch import nn
@@ -31,7 +31,7 @@ from cosyvoice.utils.class_utils import (
     COSYVOICE_ACTIVATION_CLASSES,
 )
 from cosyvoice.utils.mask import make_pad_mask
-from cosyvoice.utils.mask import add_optional_chunk_mask
+from cosyvoice.utils.mask import add_optional_chunk_mask, subsequent_chunk_mask
 
 
 class Upsample1D(nn.Module):
@@ -62,6 +62,18 @@ class Upsample1D(nn.Module):
         outputs = self.conv(outputs)
         return outputs, input_lengths * self.stride
 
+    def forward_chunk(self, inputs: torch.Tensor, cache: torch.Tensor, num_commit: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, channels, seq_len)
+        cache: (batch_size, channels, stride) inputs before this chunk, empty cache means zero padding
+        """
+        if cache.size(2) == 0:
+            cache = torch.zeros(inputs.size(0), inputs.size(1), self.stride, device=inputs.device, dtype=inputs.dtype)
+        inputs = torch.concat([cache, inputs], dim=2)
+        outputs = F.interpolate(inputs, scale_factor=float(self.stride), mode="nearest")
+        outputs = self.conv(outputs)
+        return outputs, inputs[:, :, num_commit: num_commit + self.stride]
+
 
 class PreLookaheadLayer(nn.Module):
     def __init__(self, in_channels: int, channels: int, pre_lookahead_len: int = 1):
@@ -102,6 +114,29 @@ class PreLookaheadLayer(nn.Module):
         outputs = outputs + inputs
         return outputs
 
+    def forward_chunk(self, inputs: torch.Tensor, context: torch.Tensor, cache: torch.Tensor, num_commit: int) -> Tuple[torch.Tensor, torch.Tensor]:
+        """
+        inputs: (batch_size, seq_len, channels)
+        context: (batch_size, pre_lookahead_len, channels) lookahead inputs, seq_len 0 for the last chunk
+        cache: (batch_size, channels, conv2 kernel_size - 1) conv1 outputs before this chunk, empty cache means zero padding
+        """
+        outputs = torch.concat([inputs, context], dim=1).transpose(1, 2).contiguous()
+        # look ahead
+        outputs = F.pad(outputs, (0, self.pre_lookahead_len - context.size(1)), mode='constant', value=0.0)
+        outputs = F.leaky_relu(self.conv1(outputs))
+        # outputs
+        if cache.size(2) == 0:
+            outputs = F.pad(outputs, (self.conv2.kernel_size[0] - 1, 0), mode='constant', value=0.0)
+        else:
+            outputs = torch.concat([cache, outputs], dim=2)
+        cache = outputs[:, :, num_commit: num_commit + self.conv2.kernel_size[0] - 1]
+        outputs = self.conv2(outputs)
+        outputs = outputs.transpose(1, 2).contiguous()
+
+        # residual connection
+        outputs = outputs + inputs
+        return outputs, cache
+
 
 class UpsampleConformerEncoder(torch.nn.Module):
 
@@ -319,3 +354,68 @@ class UpsampleConformerEncoder(torch.nn.Module):
         for layer in self.up_encoders:
             xs, chunk_masks, _, _ = layer(xs, chunk_masks, pos_emb, mask_pad)
         return xs
+
+    def forward_chunk(
+        self,
+        xs: torch.Tensor,
+        context: torch.Tensor,
+        cache: Dict,
+        offset: int,
+        num_commit: int,
+    ) -> torch.Tensor:
+        """Streaming encode of tokens [offset, offset + T), tokens before offset are only visited through cache.
+
+        The result equals the frames [offset * stride, (offset + T) * stride) of forward(streaming=True) over the
+        whole sequence, as static chunk attention never looks into later chunks and all convs are causal.
+
+        Args:
+            xs: input after cached tokens (1, T, D)
+            context: lookahead input (1, pre_lookahead_len, D), (1, 0, D) for the last chunk
+            cache: lookahead/upsample conv inputs and per layer attention key/value of tokens before offset,
+                empty dict for the first chunk, updated in place
+            offset: number of tokens in cache, must be a multiple of static_chunk_size
+            num_commit: number of leading tokens of xs which complete their chunks and are appended to cache
+        Returns:
+            xs: output tensor (1, T * stride, D)
+        """
+        assert xs.size(0) == 1
+        assert self.static_chunk_size > 0 and offset % self.static_chunk_size == 0
+        if len(cache) == 0:
+            cache['pre_lookahead'], cache['up_layer'] = torch.zeros(0, 0, 0), torch.zeros(0, 0, 0)
+            cache['encoders'] = [torch.zeros(0, 0, 0, 0)] * len(self.encoders)
+            cache['up_encoders'] = [torch.zeros(0, 0, 0, 0)] * len(self.up_encoders)
+        if self.global_cmvn is not None:
+            xs = self.global_cmvn(xs)
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.embed(xs, masks, offset)
+        if context.size(1) != 0:
+            context_masks = torch.ones(1, 1, context.size(1)).to(masks)
+            context, _, _ = self.embed(context, context_masks, offset=offset + xs.size(1))
+        # lookahead + conformer encoder
+        xs, cache['pre_lookahead'] = self.pre_lookahead_layer.forward_chunk(xs, context, cache['pre_lookahead'], num_commit)
+        xs = self.forward_layers_chunk(self.embed, self.encoders, xs, cache['encoders'], offset, self.static_chunk_size, num_commit)
+
+        # upsample + conformer encoder
+        stride = self.up_layer.stride
+        xs = xs.transpose(1, 2).contiguous()
+        xs, cache['up_layer'] = self.up_layer.forward_chunk(xs, cache['up_layer'], num_commit)
+        xs = xs.transpose(1, 2).contiguous()
+        masks = torch.ones(1, 1, xs.size(1), dtype=torch.bool, device=xs.device)
+        xs, _, _ = self.up_embed(xs, masks, offset * stride)
+        xs = self.forward_layers_chunk(self.up_embed, self.up_encoders, xs, cache['up_encoders'], offset * stride,
+                                       self.static_chunk_size * stride, num_commit * stride)
+
+        if self.normalize_before:
+            xs = self.after_norm(xs)
+        return xs
+
+    def forward_layers_chunk(self, embed: torch.nn.Module, layers: torch.nn.ModuleList, xs: torch.Tensor,
+                             att_cache: List[torch.Tensor], offset: int, chunk_size: int, num_commit: int) -> torch.Tensor:
+        attention_key_size = offset + xs.size(1)
+        # NOTE chunk input is shorter than the whole sequence, position_encoding covers all keys without resizing the shared pe
+        pos_emb = embed.position_encoding(offset=0, size=attention_key_size)
+        chunk_masks = subsequent_chunk_mask(attention_key_size, chunk_size, device=xs.device)[offset:].unsqueeze(0)
+        for i, layer in enumerate(layers):
+            xs, _, new_att_cache, _ = layer(xs, chunk_masks, pos_emb, att_cache=att_cache[i])
+            att_cache[i] = new_att_cache[:, :, :offset + num_commit]
+        return xs
@@ -167,14 +167,47 @@ def random_sampling(weighted_scores, decoded_tokens, sampling):
 
 
 def fade_in_out(fade_in_mel, fade_out_mel, window):
-    device = fade_in_mel.device
-    fade_in_mel, fade_out_mel = fade_in_mel.cpu(), fade_out_mel.cpu()
+    """Cross fade the head of fade_in_mel with the tail of fade_out_mel on their own device, window is a 2 * overlap_len
+    numpy array or tensor. Models reuse their window through CrossFade instead of converting it on every call.
+    """
+    if not isinstance(window, torch.Tensor):
+        window = torch.from_numpy(window)
+    window = window.to(fade_in_mel)
     mel_overlap_len = int(window.shape[0] / 2)
-    if fade_in_mel.device == torch.device('cpu'):
-        fade_in_mel = fade_in_mel.clone()
-    fade_in_mel[..., :mel_overlap_len] = fade_in_mel[..., :mel_overlap_len] * window[:mel_overlap_len] + \
-        fade_out_mel[..., -mel_overlap_len:] * window[mel_overlap_len:]
-    return fade_in_mel.to(device)
+    fade_in_mel = fade_in_mel.clone()
+    fade_in_mel[..., :mel_overlap_len].mul_(window[:mel_overlap_len]).addcmul_(fade_out_mel[..., -mel_overlap_len:].to(fade_in_mel), window[mel_overlap_len:])
+    return fade_in_mel
+
+
+class CrossFade:
+    """Hamming cross fade over overlap_len frames between the tail of the previous chunk and the head of the next one.
+
+    The window is built once, copies matching the device and dtype of the faded tensors are cached, so a streamed
+    chunk is faded where it lives without host round trips, numpy -> tensor conversion or temporary allocations.
+    """
+
+    def __init__(self, overlap_len: int):
+        self.overlap_len = overlap_len
+        self.window = torch.from_numpy(np.hamming(2 * overlap_len))
+        self.windows = {}
+
+    def get_window(self, device: torch.device, dtype: torch.dtype):
+        """(fade in, fade out) halves of the window on device with dtype."""
+        key = (device, dtype)
+        if key not in self.windows:
+            window = self.window.to(device=device, dtype=dtype)
+            self.windows[key] = (window[:self.overlap_len], window[self.overlap_len:])
+        return self.windows[key]
+
+    def __call__(self, fade_in: torch.Tensor, fade_out: torch.Tensor, inplace: bool = False) -> torch.Tensor:
+        """Fade the first overlap_len frames of fade_in with the last overlap_len frames of fade_out along the last dim,
+        inplace=True writes into fade_in, for callers owning it.
+        """
+        if inplace is False:
+            fade_in = fade_in.clone()
+        fade_in_window, fade_out_window = self.get_window(fade_in.device, fade_in.dtype)
+        fade_in[..., :self.overlap_len].mul_(fade_in_window).addcmul_(fade_out[..., -self.overlap_len:].to(fade_in), fade_out_window)
+        return fade_in
 
 
 def set_all_random_seed(seed):
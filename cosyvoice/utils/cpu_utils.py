@@ -0,0 +1,142 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+from typing import List
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+def get_numa_node_cpus(numa_node: int) -> List[int]:
+    """Parse /sys/devices/system/node/node{N}/cpulist, e.g. '0-15,32-47'."""
+    cpulist_file = '/sys/devices/system/node/node{}/cpulist'.format(numa_node)
+    if not os.path.exists(cpulist_file):
+        raise ValueError('numa node {} not found, check {}'.format(numa_node, cpulist_file))
+    cpus = []
+    with open(cpulist_file, 'r') as f:
+        for i in f.read().strip().split(','):
+            if i == '':
+                continue
+            if '-' in i:
+                start, end = i.split('-')
+                cpus.extend(range(int(start), int(end) + 1))
+            else:
+                cpus.append(int(i))
+    return cpus
+
+
+def set_cpu_threads(intra_op_num_threads: int = 0, inter_op_num_threads: int = 0, numa_node: int = -1):
+    """Configure torch cpu thread pools, optionally pin current process to one numa node.
+
+    Args:
+        intra_op_num_threads: threads used inside one op (gemm etc.), <=0 means keep torch default,
+            or all cpus of numa_node if numa_node >= 0
+        inter_op_num_threads: threads used to run independent ops, <=0 means keep torch default
+        numa_node: pin process to cpus of this numa node, <0 means no pinning
+    """
+    if numa_node >= 0:
+        cpus = get_numa_node_cpus(numa_node)
+        os.sched_setaffinity(0, cpus)
+        logging.info('pin process to numa node {} cpus {}'.format(numa_node, cpus))
+        if intra_op_num_threads <= 0:
+            intra_op_num_threads = len(cpus)
+    if intra_op_num_threads > 0:
+        torch.set_num_threads(intra_op_num_threads)
+    if inter_op_num_threads > 0:
+        # NOTE set_num_interop_threads can only be called once and before any inter-op parallel work is started
+        try:
+            torch.set_num_interop_threads(inter_op_num_threads)
+        except RuntimeError as e:
+            logging.warning('failed to set inter op threads {}, {}'.format(inter_op_num_threads, e))
+    logging.info('torch intra op threads {} inter op threads {}'.format(torch.get_num_threads(), torch.get_num_interop_threads()))
+
+
+def quantize_llm_int8(llm: torch.nn.Module) -> torch.nn.Module:
+    """Dynamic int8 quantization of Qwen2LM for cpu inference.
+
+    Linear layers of the Qwen2 backbone and llm_decoder use per-tensor dynamic activation quantization
+    with int8 weights, speech_embedding uses int8 weight-only quantization with per-row float qparams.
+    Text embed_tokens and llm_embedding are kept in fp32 as they are accessed by weight directly.
+    """
+    from torch.ao.quantization import quantize_dynamic, default_dynamic_qconfig, float_qparams_weight_only_qconfig
+    qconfig_spec = {
+        'llm': default_dynamic_qconfig,
+        'llm.model.model.embed_tokens': None,
+        'llm_decoder': default_dynamic_qconfig,
+        'speech_embedding': float_qparams_weight_only_qconfig,
+    }
+    llm = quantize_dynamic(llm, qconfig_spec=qconfig_spec, dtype=torch.qint8, inplace=True)
+    return llm
+
+
+def is_bf16_supported(device: torch.device) -> bool:
+    """Whether device has native bf16 kernels, on cpu onednn needs avx512_bf16/amx, otherwise bf16 is emulated and slow."""
+    if device.type == 'cuda':
+        return torch.cuda.is_bf16_supported()
+    return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+
+
+class Int8Conv(torch.nn.Module):
+    """quantize -> int8 conv1d -> dequantize copy of a Conv1d, padding of causal convs stays outside."""
+
+    def __init__(self, conv: torch.nn.Conv1d):
+        super().__init__()
+        from torch.ao.quantization import QuantStub, DeQuantStub
+        self.quant, self.dequant = QuantStub(), DeQuantStub()
+        self.conv = torch.nn.Conv1d(conv.in_channels, conv.out_channels, conv.kernel_size, stride=conv.stride, padding=conv.padding,
+                                    dilation=conv.dilation, groups=conv.groups, bias=conv.bias is not None)
+        self.conv.load_state_dict({k: v.detach().clone() for k, v in conv.state_dict().items()})
+
+    def forward(self, x: torch.Tensor) -> torch.Tensor:
+        return self.dequant(self.conv(self.quant(x.float())))
+
+
+def quantize_hift_int8(hift: torch.nn.Module, calib_mels: List[torch.Tensor]) -> int:
+    """Static int8 quantization of the HiFT conv stack for cpu inference.
+
+    Every Conv1d of ups, source_downs, source_resblocks and resblocks gets an Int8Conv with per-channel int8 weights
+    and per-tensor activation ranges from histograms of running hift.inference on calib_mels, which should be real
+    mels. Only _conv_forward of the conv is swapped, so causal padding, chunk caches and Snake/fusion adds keep fp32.
+    conv_pre, conv_post whose output is exp'ed into magnitude, f0_predictor and source are not quantized, neither are
+    ConvTranspose1d upsamplers of HiFTGenerator as quantized conv_transpose1d of the x86/onednn engine is unreliable.
+    weight_norm is folded first. Return the number of quantized convs.
+    """
+    from torch.ao.quantization import QConfig, HistogramObserver, default_per_channel_weight_observer, prepare, convert
+    from cosyvoice.hifigan.generator import fold_weight_norm
+    fold_weight_norm(hift)
+    qconfig = QConfig(activation=HistogramObserver.with_args(reduce_range=torch.backends.quantized.engine in ['x86', 'fbgemm']),
+                      weight=default_per_channel_weight_observer)
+    int8_convs = {}
+    for name in ['ups', 'source_downs', 'source_resblocks', 'resblocks']:
+        for k, m in getattr(hift, name).named_modules(prefix=name):
+            if not isinstance(m, torch.nn.Conv1d):
+                continue
+            int8_conv = Int8Conv(m).eval()
+            int8_conv.qconfig = qconfig
+            prepare(int8_conv, inplace=True)
+            m._conv_forward = lambda x, weight, bias, int8_conv=int8_conv: int8_conv(x)
+            int8_convs[k] = (m, int8_conv)
+    # observers record activation ranges of the fp32 convs
+    for mel in calib_mels:
+        hift.inference(mel.float().cpu())
+    for m, int8_conv in int8_convs.values():
+        convert(int8_conv, inplace=True)
+    hift.int8_convs = int8_convs
+    return len(int8_convs)
+
+
+def dequantize_hift_int8(hift: torch.nn.Module):
+    """Undo quantize_hift_int8, the fp32 convs are untouched by it."""
+    for m, _ in getattr(hift, 'int8_convs', {}).values():
+        m.__dict__.pop('_conv_forward', None)
+    hift.int8_convs = {}
@@ -116,3 +116,105 @@ def export_cosyvoice2_vllm(model, model_path, device):
     model.llm.model.config.vocab_size = tmp_vocab_size
     model.llm.model.config.tie_word_embeddings = tmp_tie_embedding
     model.llm.model.set_input_embeddings(embed_tokens)
+
+
+# NOTE only Qwen2 backbone and llm_decoder are exported, text/speech embedding lookup is still done by pytorch
+def export_cosyvoice2_onnx(model, onnx_model, device):
+    if os.path.exists(onnx_model):
+        return
+
+    from cosyvoice.llm.llm import Qwen2OnnxStep
+    step = Qwen2OnnxStep(model)
+    step.eval()
+    config = step.model.config
+    kv_head, head_dim = config.num_key_value_heads, config.hidden_size // config.num_attention_heads
+    # NOTE use non-empty past during export, zero length past works at runtime for prefill
+    batch_size, seq_len, past_len = 1, 4, 8
+    inputs_embeds = torch.rand((batch_size, seq_len, config.hidden_size), dtype=torch.float32, device=device)
+    attention_mask = torch.ones((batch_size, past_len + seq_len), dtype=torch.int64, device=device)
+    past_key_values = [torch.rand((batch_size, kv_head, past_len, head_dim), dtype=torch.float32, device=device) for _ in range(2 * step.num_layers)]
+    input_names, output_names = step.get_io_names()
+    dynamic_axes = {
+        'inputs_embeds': {0: 'batch_size', 1: 'seq_len'},
+        'attention_mask': {0: 'batch_size', 1: 'total_len'},
+        'logp': {0: 'batch_size'},
+    }
+    dynamic_axes.update({i: {0: 'batch_size', 2: 'past_len'} for i in input_names[2:]})
+    dynamic_axes.update({i: {0: 'batch_size', 2: 'total_len'} for i in output_names[1:]})
+    with torch.no_grad():
+        torch.onnx.export(
+            step,
+            (inputs_embeds, attention_mask, *past_key_values),
+            onnx_model,
+            export_params=True,
+            opset_version=18,
+            do_constant_folding=True,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes=dynamic_axes,
+        )
+    logging.info("Succesfully export llm to onnx...")
+
+
+def export_hift_onnx(model, onnx_model, device):
+    if os.path.exists(onnx_model):
+        return
+
+    from cosyvoice.hifigan.generator import HiFTDecodeOnnx
+    decode = HiFTDecodeOnnx(model).to(device)
+    decode.eval()
+    batch_size, seq_len = 1, 64
+    x = torch.rand((batch_size, model.conv_pre.in_channels, seq_len), dtype=torch.float32, device=device)
+    s = torch.rand((batch_size, 1, seq_len * int(model.f0_upsamp.scale_factor)), dtype=torch.float32, device=device)
+    input_names, output_names = decode.get_io_names()
+    with torch.no_grad():
+        torch.onnx.export(
+            decode,
+            (x, s),
+            onnx_model,
+            export_params=True,
+            opset_version=18,
+            do_constant_folding=True,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes={
+                'x': {0: 'batch_size', 2: 'seq_len'},
+                's': {0: 'batch_size', 2: 'source_len'},
+                'speech': {0: 'batch_size', 1: 'speech_len'},
+            }
+        )
+    logging.info("Succesfully export hift decode to onnx...")
+
+
+def export_causal_hift_onnx(model, onnx_model, device):
+    if os.path.exists(onnx_model):
+        return
+
+    from cosyvoice.hifigan.generator import CausalHiFTDecodeOnnx
+    # NOTE state lengths of decode_chunk are fixed after the first chunks, export the steady state step with them
+    cache, seq_len = model.init_cache(), 64
+    for _ in range(2):
+        model.inference_chunk(torch.rand((1, model.conv_pre.in_channels, seq_len), dtype=torch.float32, device=device), cache)
+    states = [i.clone().to(device) for i in model.get_decode_states(cache)]
+    step = CausalHiFTDecodeOnnx(model, [i.size(-1) for i in states]).to(device)
+    step.eval()
+    x = torch.rand((1, model.conv_pre.in_channels, seq_len), dtype=torch.float32, device=device)
+    s = torch.rand((1, 1, seq_len * int(model.f0_upsamp.scale_factor)), dtype=torch.float32, device=device)
+    input_names, output_names = step.get_io_names()
+    with torch.no_grad():
+        torch.onnx.export(
+            step,
+            (x, s, *[i for i in states if i.size(-1) != 0]),
+            onnx_model,
+            export_params=True,
+            opset_version=18,
+            do_constant_folding=True,
+            input_names=input_names,
+            output_names=output_names,
+            dynamic_axes={
+                'x': {2: 'seq_len'},
+                's': {2: 'source_len'},
+                'speech': {1: 'speech_len'},
+            }
+        )
+    logging.info("Succesfully export causal hift decode_chunk to onnx...")
@@ -1,5 +1,7 @@
+import math
 import torch
 import torch.nn.functional as F
+import torchaudio
 from typing import Tuple
 
 
@@ -55,3 +57,33 @@ class DPOLoss(torch.nn.Module):
         rejected_rewards = self.beta * (policy_rejected_logps - reference_rejected_logps).detach()
 
         return loss, chosen_rewards, rejected_rewards
+
+
+def log_spectral_distance(ref_speech: torch.Tensor, speech: torch.Tensor, n_fft: int = 1024, hop_len: int = 256, top_db: float = 80.0) -> float:
+    """Log spectral distance in dB between speech and ref_speech (B, T), root mean square over bins, mean over frames.
+
+    Power is floored top_db below the peak of ref_speech, so bins both signals leave near silent do not dominate.
+    """
+    window = torch.hann_window(n_fft).to(ref_speech)
+    length = min(ref_speech.shape[1], speech.shape[1])
+    ref_power, power = [torch.stft(x[:, :length], n_fft, hop_len, window=window, return_complex=True).abs() ** 2 for x in [ref_speech, speech]]
+    floor = ref_power.amax(dim=(1, 2), keepdim=True) * 10 ** (-top_db / 10) + 1e-20
+    diff = 10 * torch.log10(torch.maximum(ref_power, floor)) - 10 * torch.log10(torch.maximum(power, floor))
+    return torch.sqrt((diff ** 2).mean(dim=1)).mean().item()
+
+
+def mel_cepstral_distance(ref_speech: torch.Tensor, speech: torch.Tensor, sample_rate: int, n_fft: int = 1024, hop_len: int = 256,
+                          num_mels: int = 80, num_ceps: int = 13, top_db: float = 80.0) -> float:
+    """Mel cepstral distance in dB between speech and ref_speech (B, T) of aligned frames, c0 (energy) excluded.
+
+    Cepstra are the dct of log mel amplitude, mel power is floored top_db below the peak of ref_speech.
+    """
+    window = torch.hann_window(n_fft).to(ref_speech)
+    fbank = torchaudio.functional.melscale_fbanks(n_fft // 2 + 1, 0.0, sample_rate / 2, num_mels, sample_rate).to(ref_speech)
+    dct = torchaudio.functional.create_dct(num_ceps, num_mels, 'ortho').to(ref_speech)
+    length = min(ref_speech.shape[1], speech.shape[1])
+    ref_power, power = [torch.matmul((torch.stft(x[:, :length], n_fft, hop_len, window=window, return_complex=True).abs() ** 2).transpose(1, 2), fbank)
+                        for x in [ref_speech, speech]]
+    floor = ref_power.amax(dim=(1, 2), keepdim=True) * 10 ** (-top_db / 10) + 1e-20
+    diff = torch.matmul(0.5 * torch.log(torch.maximum(ref_power, floor)) - 0.5 * torch.log(torch.maximum(power, floor)), dct)[..., 1:]
+    return (10 / math.log(10) * torch.sqrt(2 * (diff ** 2).sum(dim=-1))).mean().item()
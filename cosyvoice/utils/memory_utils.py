@@ -0,0 +1,105 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+import os
+import threading
+from typing import Dict, Optional
+import torch
+from cosyvoice.utils.file_utils import logging
+
+
+def get_rss() -> int:
+    """Resident set size of current process in bytes, 0 if /proc is not available."""
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def get_module_memory(module: torch.nn.Module) -> Dict[str, int]:
+    """Bytes held by parameters, buffers and plain tensor attributes (not registered as buffer) of module."""
+    memory = {'parameters': 0, 'buffers': 0, 'tensors': 0}
+    for p in module.parameters():
+        memory['parameters'] += p.numel() * p.element_size()
+    for b in module.buffers():
+        memory['buffers'] += b.numel() * b.element_size()
+    for m in module.modules():
+        for v in vars(m).values():
+            if isinstance(v, torch.Tensor):
+                memory['tensors'] += v.numel() * v.element_size()
+    return memory
+
+
+class MemoryPolicy:
+    """When to give cached cuda memory back to the driver.
+
+    Calling torch.cuda.empty_cache() after every request makes the next request pay cudaMalloc again and stalls
+    other active streams, so the cache is only trimmed after a request once reserved memory exceeds high_watermark
+    of device memory, or cached but unallocated memory exceeds max_free_cache bytes. reserve() warms the cache with
+    one large block at startup. On cpu every method is a no-op apart from statistics.
+    """
+
+    def __init__(self, device: torch.device, high_watermark: float = 0.9, max_free_cache: Optional[int] = None):
+        assert 0 < high_watermark <= 1
+        self.device = device
+        self.high_watermark = high_watermark
+        self.max_free_cache = max_free_cache
+        self.lock = threading.Lock()
+        self.counters = {'request': 0, 'trim': 0}
+
+    @property
+    def enabled(self) -> bool:
+        return self.device.type == 'cuda'
+
+    def should_trim(self) -> bool:
+        reserved, allocated = torch.cuda.memory_reserved(self.device), torch.cuda.memory_allocated(self.device)
+        if reserved > self.high_watermark * torch.cuda.get_device_properties(self.device).total_memory:
+            return True
+        return self.max_free_cache is not None and reserved - allocated > self.max_free_cache
+
+    def after_request(self):
+        """Called at the end of each request instead of torch.cuda.empty_cache()."""
+        with self.lock:
+            self.counters['request'] += 1
+        if not self.enabled or not self.should_trim():
+            return
+        reserved = torch.cuda.memory_reserved(self.device)
+        # NOTE empty_cache only releases blocks no stream is using, so active sessions keep running
+        torch.cuda.empty_cache()
+        with self.lock:
+            self.counters['trim'] += 1
+        logging.info('trim cuda cache, reserved {:.1f}MB -> {:.1f}MB'.format(reserved / 2 ** 20, torch.cuda.memory_reserved(self.device) / 2 ** 20))
+
+    def reserve(self, nbytes: int):
+        """Allocate and free one block of nbytes, the caching allocator keeps it and splits it for later requests."""
+        if not self.enabled or nbytes <= 0:
+            return
+        block = torch.empty(nbytes, dtype=torch.uint8, device=self.device)
+        del block
+        logging.info('reserve {:.1f}MB cuda cache'.format(torch.cuda.memory_reserved(self.device) / 2 ** 20))
+
+    def get_stats(self) -> Dict:
+        with self.lock:
+            stats = {'device': str(self.device), 'rss': get_rss(), 'counters': dict(self.counters),
+                     'high_watermark': self.high_watermark, 'max_free_cache': self.max_free_cache}
+        if self.enabled:
+            allocator_stats = torch.cuda.memory_stats(self.device)
+            stats['cuda'] = {'allocated': allocator_stats.get('allocated_bytes.all.current', 0),
+                             'allocated_peak': allocator_stats.get('allocated_bytes.all.peak', 0),
+                             'reserved': allocator_stats.get('reserved_bytes.all.current', 0),
+                             'reserved_peak': allocator_stats.get('reserved_bytes.all.peak', 0),
+                             'num_alloc_retries': allocator_stats.get('num_alloc_retries', 0),
+                             'num_ooms': allocator_stats.get('num_ooms', 0),
+                             'total': torch.cuda.get_device_properties(self.device).total_memory}
+        return stats
@@ -0,0 +1,56 @@
+# Copyright (c) 2025 Alibaba Inc (authors: Xiang Lyu)
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#   http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Speed change of mel by linear interpolation along time, chunk by chunk.
+
+Output frame j of an utterance of T input frames reads input position max((j + 0.5) * speed - 0.5, 0), as
+F.interpolate(mode='linear') with scale speed, and an utterance has int(T / speed) output frames. A position only
+depends on speed and j, so each chunk emits the output frames whose two neighbouring input frames have arrived and
+keeps the input frames from the next position on. Streamed chunks concatenate to the whole utterance output, without
+seams at chunk boundaries.
+"""
+from typing import Dict
+import numpy as np
+import torch
+
+
+def init_speed_cache() -> Dict:
+    """State of speed_change_chunk, input frames from 'offset' on and number of output frames emitted so far."""
+    return {'mel': None, 'offset': 0, 'num_output': 0}
+
+
+def speed_change_chunk(mel: torch.Tensor, speed: float, cache: Dict, finalize: bool = False) -> torch.Tensor:
+    """mel (B, C, T) of the next chunk -> speed changed frames (B, C, T') available so far, finalize flushes the rest."""
+    assert speed > 0
+    if cache['mel'] is not None:
+        mel = torch.concat([cache['mel'], mel], dim=2)
+    offset, num_input = cache['offset'], cache['offset'] + mel.shape[2]
+    # NOTE the utterance length is only known at finalize, until then both neighbours of a position must have arrived
+    index = np.arange(cache['num_output'], int(num_input / speed))
+    position = np.maximum((index + 0.5) * speed - 0.5, 0)
+    if finalize is False:
+        index, position = index[position < num_input - 1], position[position < num_input - 1]
+    left = np.floor(position).astype(np.int64)
+    right = np.minimum(left + 1, num_input - 1)
+    weight = torch.from_numpy(position - left).to(mel)
+    output = torch.lerp(mel[:, :, left - offset], mel[:, :, right - offset], weight)
+    # keep input frames from the left neighbour of the next output frame on
+    cache['num_output'] += len(index)
+    next_offset = min(int(max((cache['num_output'] + 0.5) * speed - 0.5, 0)), num_input)
+    cache['mel'], cache['offset'] = mel[:, :, next_offset - offset:], next_offset
+    return output
+
+
+def speed_change(mel: torch.Tensor, speed: float) -> torch.Tensor:
+    """Whole utterance speed change, same frames as streaming it through speed_change_chunk."""
+    return speed_change_chunk(mel, speed, init_speed_cache(), finalize=True)
@@ -0,0 +1,5 @@
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, '{}/..'.format(ROOT_DIR))
@@ -0,0 +1,176 @@
+import functools
+import inspect
+import random
+
+import pytest
+import torch
+
+from cosyvoice.cli.model import CosyVoice3Model, CosyVoiceModel
+from cosyvoice.hifigan.f0_predictor import CausalConvRNNF0Predictor, ConvRNNF0Predictor
+from cosyvoice.hifigan.generator import CausalHiFTGenerator, HiFTGenerator
+
+
+@pytest.fixture(scope='module')
+def hift():
+    torch.manual_seed(0)
+    hift = CausalHiFTGenerator(in_channels=80, base_channels=64, nb_harmonics=8, sampling_rate=24000, upsample_rates=[8, 5, 3],
+                               upsample_kernel_sizes=[16, 11, 7], source_resblock_kernel_sizes=[7, 7, 11],
+                               source_resblock_dilation_sizes=[[1, 3, 5]] * 3, conv_pre_look_right=4,
+                               f0_predictor=CausalConvRNNF0Predictor(cond_channels=64))
+    with torch.no_grad():
+        # voiced f0 so that the sine source is exercised
+        hift.f0_predictor.classifier.bias.fill_(150.)
+    return hift.eval()
+
+
+def random_splits(rng, num_frames):
+    """Chunk lengths summing to num_frames, with empty chunks in between and sometimes as the finalize chunk."""
+    splits = []
+    while sum(splits) < num_frames:
+        splits.append(0 if rng.random() < 0.2 else min(rng.randint(1, 60), num_frames - sum(splits)))
+    if rng.random() < 0.5:
+        splits.append(0)
+    return splits
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2, 3])
+def test_inference_chunk_matches_inference(hift, seed):
+    rng = random.Random(seed)
+    mel = torch.randn(1, 80, 157, generator=torch.Generator().manual_seed(seed))
+    ref, _ = hift.inference(mel, finalize=True)
+    cache, outputs, start = hift.init_cache(), [], 0
+    splits = random_splits(rng, mel.shape[2])
+    for i, num_frames in enumerate(splits):
+        speech, _ = hift.inference_chunk(mel[:, :, start:start + num_frames], cache, finalize=i == len(splits) - 1)
+        outputs.append(speech)
+        start += num_frames
+    speech = torch.concat(outputs, dim=1)
+    assert speech.shape == ref.shape
+    # NOTE source phase is accumulated per chunk, fp32 rounding grows slowly along the utterance
+    torch.testing.assert_close(speech, ref, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+    assert cache['offset'] == ref.shape[1]
+
+
+def test_inference_chunk_single_finalize_chunk(hift):
+    mel = torch.randn(1, 80, 40, generator=torch.Generator().manual_seed(4))
+    ref, _ = hift.inference(mel, finalize=True)
+    speech, _ = hift.inference_chunk(mel, hift.init_cache(), finalize=True)
+    torch.testing.assert_close(speech, ref, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+
+
+def test_inference_chunk_empty_chunk_keeps_cache(hift):
+    cache = hift.init_cache()
+    speech, source = hift.inference_chunk(torch.zeros(1, 80, 0), cache, finalize=False)
+    assert speech.shape == (1, 0) and source.shape[2] == 0
+    assert hift._is_initial_cache(cache)
+
+
+def test_set_f0_device_auto_falls_back_to_cpu_on_cpu_vocoder(hift):
+    assert hift.set_f0_device('auto') == 0.0
+    assert hift.f0_device == 'cpu'
+    assert next(hift.f0_predictor.parameters()).device.type == 'cpu'
+
+
+def test_predict_f0_does_not_move_f0_predictor(hift, monkeypatch):
+    def to(*args, **kwargs):
+        raise AssertionError('predict_f0 must not move f0_predictor')
+    monkeypatch.setattr(hift.f0_predictor, 'to', to)
+    mel = torch.randn(1, 80, 30)
+    f0, _ = hift.predict_f0(mel)
+    assert f0.shape == (1, 30) and f0.device == mel.device
+    speech, _ = hift.inference_chunk(mel, hift.init_cache(), finalize=True)
+    assert speech.shape[1] != 0
+
+
+def test_conv_stft_backend_matches_torch(hift):
+    mel = torch.randn(1, 80, 157, generator=torch.Generator().manual_seed(5))
+    ref, _ = hift.inference(mel, finalize=True)
+    try:
+        assert hift.set_stft_backend('conv') <= 1e-4
+        assert hift.stft_backend == 'conv'
+        speech, _ = hift.inference(mel, finalize=True)
+        cache, outputs, start = hift.init_cache(), [], 0
+        for i, num_frames in enumerate([25, 50, 0, 82]):
+            outputs.append(hift.inference_chunk(mel[:, :, start:start + num_frames], cache, finalize=i == 3)[0])
+            start += num_frames
+    finally:
+        hift.set_stft_backend('torch')
+    torch.testing.assert_close(speech, ref, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+    torch.testing.assert_close(torch.concat(outputs, dim=1), ref, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+
+
+def test_conv_stft_backend_falls_back_over_tolerance(hift):
+    assert hift.set_stft_backend('conv', tolerance=-1.0) > -1.0
+    assert hift.stft_backend == 'torch'
+
+
+@pytest.mark.skipif(not torch.cuda.is_available(), reason='needs cuda')
+@pytest.mark.parametrize('tolerance, f0_device', [(1.0, 'auto'), (-1.0, 'cpu')])
+def test_set_f0_device_auto_on_cuda(hift, tolerance, f0_device):
+    hift.cuda()
+    try:
+        hift.set_f0_device('auto', tolerance=tolerance)
+        assert hift.f0_device == f0_device
+        assert next(hift.f0_predictor.parameters()).device.type == ('cuda' if f0_device == 'auto' else 'cpu')
+        mel = torch.randn(1, 80, 30, device='cuda')
+        speech, _ = hift.inference(mel)
+        assert speech.device.type == 'cuda'
+    finally:
+        hift.cpu()
+        hift.set_f0_device('cpu')
+
+
+@pytest.fixture
+def torchscript_onnx_export(monkeypatch):
+    """Hift graphs are exported with the torchscript onnx exporter, the default before torch added dynamo export."""
+    pytest.importorskip('onnx')
+    pytest.importorskip('onnxruntime')
+    if 'dynamo' in inspect.signature(torch.onnx.export).parameters:
+        monkeypatch.setattr(torch.onnx, 'export', functools.partial(torch.onnx.export, dynamo=False))
+
+
+def test_decode_onnx_matches_eager(torchscript_onnx_export, tmp_path):
+    torch.manual_seed(0)
+    hift = HiFTGenerator(in_channels=80, base_channels=64, nb_harmonics=8, sampling_rate=24000, upsample_rates=[8, 5, 3],
+                         upsample_kernel_sizes=[16, 11, 7], source_resblock_kernel_sizes=[7, 7, 11],
+                         source_resblock_dilation_sizes=[[1, 3, 5]] * 3, f0_predictor=ConvRNNF0Predictor(cond_channels=64)).eval()
+    hift.optimize_for_inference()
+    model = CosyVoiceModel.__new__(CosyVoiceModel)
+    model.device, model.hift = torch.device('cpu'), hift
+    mel = torch.randn(1, 80, 150)
+    # NOTE the sine source adds random noise, reseed so that eager and onnx decode the same source
+    torch.manual_seed(1)
+    ref, _ = hift.inference(mel)
+    model.load_hift_onnx(str(tmp_path / 'hift.fp32.onnx'))
+    torch.manual_seed(1)
+    speech, _ = hift.inference(mel)
+    torch.testing.assert_close(speech, ref, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+
+
+def test_decode_chunk_onnx_matches_eager(hift, torchscript_onnx_export, tmp_path, monkeypatch):
+    mel = torch.randn(1, 80, 300, generator=torch.Generator().manual_seed(5))
+
+    def stream(splits):
+        cache, outputs, start = hift.init_cache(), [], 0
+        for i, num_frames in enumerate(splits):
+            speech, _ = hift.inference_chunk(mel[:, :, start:start + num_frames], cache, finalize=i == len(splits) - 1)
+            outputs.append(speech)
+            start += num_frames
+        return torch.concat(outputs, dim=1)
+
+    splits = [[25, 50, 50, 50, 50, 50, 25], [3, 1, 7, 100, 1, 2, 80, 106], [300]]
+    refs = [stream(i) for i in splits]
+    model = CosyVoice3Model.__new__(CosyVoice3Model)
+    model.device, model.hift = torch.device('cpu'), hift
+    model.load_hift_onnx(str(tmp_path / 'hift.fp32.onnx'), str(tmp_path / 'hift.chunk.fp32.onnx'))
+    try:
+        onnx_calls = []
+        decode_chunk_onnx = hift._decode_chunk_onnx
+        monkeypatch.setattr(hift, '_decode_chunk_onnx', lambda *args: onnx_calls.append(1) or decode_chunk_onnx(*args))
+        for i, ref in zip(splits, refs):
+            speech = stream(i)
+            torch.testing.assert_close(speech, ref, rtol=1e-3, atol=1e-3 * ref.abs().max().item())
+        # steady state chunks of the first split run the exported step graph
+        assert len(onnx_calls) != 0
+    finally:
+        del hift.decode_onnx, hift.decode_chunk_onnx, hift.decode_chunk_onnx_state_lengths
@@ -0,0 +1,32 @@
+import pytest
+import torch
+import torch.nn.functional as F
+
+from cosyvoice.utils.speed_utils import init_speed_cache, speed_change, speed_change_chunk
+
+
+@pytest.fixture(scope='module')
+def mel():
+    return torch.randn(1, 80, 500, generator=torch.Generator().manual_seed(0))
+
+
+@pytest.mark.parametrize('speed', [0.5, 0.8, 1.0, 1.2, 1.5, 2.0])
+def test_speed_change_matches_interpolate(mel, speed):
+    whole = speed_change(mel, speed)
+    reference = F.interpolate(mel, scale_factor=1 / speed, mode='linear', recompute_scale_factor=False)
+    assert whole.shape[2] == int(mel.shape[2] / speed)
+    # NOTE interpolate computes positions in fp32, speed_change in fp64
+    torch.testing.assert_close(whole, reference[:, :, :whole.shape[2]], rtol=0, atol=1e-3)
+
+
+@pytest.mark.parametrize('speed', [0.5, 0.8, 1.2, 1.5, 2.0])
+@pytest.mark.parametrize('chunk_sizes', [[100] * 5, [37, 1, 0, 62, 200, 200], [3] * 166 + [2], [500, 0]])
+def test_speed_change_chunk_matches_whole(mel, speed, chunk_sizes):
+    cache, chunks, start = init_speed_cache(), [], 0
+    for i, size in enumerate(chunk_sizes):
+        chunks.append(speed_change_chunk(mel[:, :, start:start + size], speed, cache, finalize=i == len(chunk_sizes) - 1))
+        start += size
+    whole = speed_change(mel, speed)
+    streamed = torch.concat(chunks, dim=2)
+    assert streamed.shape == whole.shape
+    torch.testing.assert_close(streamed, whole)
@@ -0,0 +1,44 @@
+import pytest
+import torch
+
+from cosyvoice.hifigan.stft import ConvISTFT, ConvSTFT, polar
+
+N_FFT, HOP_LEN = 16, 4
+
+
+@pytest.fixture(scope='module')
+def window():
+    return torch.hann_window(N_FFT, periodic=True)
+
+
+@pytest.fixture(params=[False, True], ids=['eager', 'onnx_export'])
+def in_onnx_export(request, monkeypatch):
+    # onnx export runs the conv1d/conv_transpose1d branch instead of matmul and fold
+    monkeypatch.setattr(torch.onnx, 'is_in_onnx_export', lambda: request.param)
+    return request.param
+
+
+@pytest.mark.parametrize('center', [True, False])
+def test_conv_stft_matches_torch_stft(window, in_onnx_export, center):
+    x = torch.randn(2, 24000, generator=torch.Generator().manual_seed(0))
+    spec = torch.view_as_real(torch.stft(x, N_FFT, HOP_LEN, N_FFT, window=window, center=center, return_complex=True))
+    ref = torch.concat([spec[..., 0], spec[..., 1]], dim=1)
+    torch.testing.assert_close(ConvSTFT(N_FFT, HOP_LEN, window)(x, center=center), ref, rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('num_frames', [2, 3, 4, 5, 6000])
+def test_conv_istft_matches_torch_istft(window, in_onnx_export, num_frames):
+    generator = torch.Generator().manual_seed(num_frames)
+    magnitude = torch.rand(2, N_FFT // 2 + 1, num_frames, generator=generator) * 10
+    phase = torch.randn(2, N_FFT // 2 + 1, num_frames, generator=generator)
+    ref = torch.istft(torch.polar(magnitude, phase), N_FFT, HOP_LEN, N_FFT, window=window)
+    speech = ConvISTFT(N_FFT, HOP_LEN, window)(polar(magnitude, phase))
+    assert speech.shape == ref.shape
+    torch.testing.assert_close(speech, ref, rtol=1e-4, atol=1e-4 * ref.abs().max().item())
+
+
+@pytest.mark.parametrize('num_frames', range(1, 10))
+def test_envelope_matches_overlap_added_window(window, num_frames):
+    istft = ConvISTFT(N_FFT, HOP_LEN, window)
+    ref = torch.nn.functional.conv_transpose1d(torch.ones(1, 1, num_frames), istft.window_square, stride=HOP_LEN).squeeze(1)
+    torch.testing.assert_close(istft.envelope(num_frames), ref)
@@ -0,0 +1,49 @@
+import random
+
+import pytest
+import torch
+
+from cosyvoice.transformer.embedding import EspnetRelPositionalEncoding
+from cosyvoice.transformer.upsample_encoder import UpsampleConformerEncoder
+
+
+@pytest.fixture(scope='module')
+def encoder():
+    torch.manual_seed(0)
+    encoder = UpsampleConformerEncoder(input_size=512, output_size=512, attention_heads=8, linear_units=256, num_blocks=2, dropout_rate=0.0,
+                                       positional_dropout_rate=0.0, attention_dropout_rate=0.0, input_layer='linear',
+                                       pos_enc_layer_type='rel_pos_espnet', selfattention_layer_type='rel_selfattn',
+                                       use_cnn_module=False, macaron_style=False, static_chunk_size=5)
+    return encoder.eval()
+
+
+@pytest.mark.parametrize('seed', [0, 1, 2])
+@torch.inference_mode()
+def test_forward_chunk_matches_full_context(encoder, seed):
+    """Chunked encoding over random hops equals forward(streaming=True) over the same prefix and lookahead."""
+    rng = random.Random(seed)
+    chunk_size, lookahead, stride = encoder.static_chunk_size, encoder.pre_lookahead_layer.pre_lookahead_len, encoder.up_layer.stride
+    xs = torch.randn(1, 47, 512)
+    cache, offset, num_tokens = {}, 0, 0
+    while num_tokens < xs.size(1):
+        num_tokens = min(num_tokens + rng.randint(1, 2 * chunk_size), xs.size(1))
+        finalize = num_tokens == xs.size(1)
+        token_len = num_tokens if finalize else num_tokens - lookahead
+        if token_len <= offset:
+            continue
+        context = xs[:, token_len:num_tokens]
+        num_commit = token_len // chunk_size * chunk_size - offset
+        chunk = encoder.forward_chunk(xs[:, offset:token_len], context, cache, offset, num_commit)
+        full, _ = encoder(xs[:, :token_len], torch.tensor([token_len]), context=context, streaming=True)
+        assert chunk.shape[1] == (token_len - offset) * stride
+        torch.testing.assert_close(chunk, full[:, offset * stride:], rtol=1e-4, atol=1e-4)
+        offset += num_commit
+
+
+def test_position_encoding_does_not_resize_shared_pe():
+    pos_enc = EspnetRelPositionalEncoding(16, 0.0, max_len=4)
+    pe = pos_enc.pe
+    pos_emb = pos_enc.position_encoding(offset=3, size=6)
+    assert pos_enc.pe is pe
+    torch.testing.assert_close(pos_emb, pos_enc.build_pe(9, pe.device, pe.dtype))
+    torch.testing.assert_close(pos_enc.position_encoding(offset=0, size=4), pe)